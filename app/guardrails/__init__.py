@@ -2,11 +2,16 @@ from app.guardrails.policies import (
     ConfidenceScorer,
     GuardrailPolicyEvaluator,
     GuardrailViolation,
+    PromptScan,
+    merge_violations,
 )
+from app.guardrails.streaming import StreamingGuardrailEvaluator
 
 __all__ = [
     "ConfidenceScorer",
     "GuardrailPolicyEvaluator",
     "GuardrailViolation",
+    "PromptScan",
+    "StreamingGuardrailEvaluator",
+    "merge_violations",
 ]
-
@@ -84,12 +84,12 @@ Most requests handled entirely by AWS Layer 1 without local policy checks.
 from __future__ import annotations
 import json
 import re
-import unicodedata
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Any, Dict, Iterable, List, Optional, Tuple
+from typing import Any, Dict, Iterable, List, Optional, Pattern, Set, Tuple
 import yaml
 
+from app.utils.aho_corasick import AhoCorasick
 from app.utils.text_match import norm_text, unique
 
 @dataclass
@@ -270,6 +270,231 @@ class ConfidenceScorer:
         return penalty, penalties
 
 
+# Pattern có backreference / group có tên / conditional không ghép được vào pattern chung
+_STANDALONE_PATTERN_RE = re.compile(r"\\[1-9]|\(\?P|\(\?\(")
+# Atom đầu pattern dùng làm tiền tố: \s+, ký tự escape hoặc ký tự thường (không phải metachar)
+_PREFIX_ATOM_RE = re.compile(r"\\s\+|\\(.)|([^\\.^$*+?{}\[\]|()])", re.DOTALL)
+_WHITESPACE_PREFIX = r"\s+"
+
+
+def _findall_item(match: re.Match) -> Any:
+    """Phần tử findall trả về cho một match (chuỗi, group duy nhất hoặc tuple group)."""
+    n_groups = match.re.groups
+    if n_groups == 0:
+        return match.group(0)
+    if n_groups == 1:
+        return match.group(1) or ''
+    return tuple(g or '' for g in match.groups())
+
+
+def _has_top_level_alternation(pattern: str) -> bool:
+    depth, pos, in_class = 0, 0, False
+    while pos < len(pattern):
+        ch = pattern[pos]
+        if ch == '\\':
+            pos += 2
+            continue
+        if in_class:
+            in_class = ch != ']'
+        elif ch == '[':
+            in_class = True
+            # ']' ngay sau '[' hoặc '[^' là ký tự trong lớp
+            if pattern[pos + 1:pos + 2] == '^':
+                pos += 1
+            if pattern[pos + 1:pos + 2] == ']':
+                pos += 1
+        elif ch == '(':
+            depth += 1
+        elif ch == ')':
+            depth -= 1
+        elif ch == '|' and depth == 0:
+            return True
+        pos += 1
+    return False
+
+
+def _literal_prefix(pattern: str) -> Tuple[str, ...]:
+    """
+    Các atom bắt buộc ở đầu pattern — ký tự literal (casefold) hoặc \\s+ — mà mọi match đều
+    bắt đầu bằng; bỏ qua \\b và ^ ở đầu. Dừng ở atom đầu tiên không chắc chắn (group, lớp ký
+    tự, quantifier tuỳ chọn, khoảng trắng literal, ký tự casefold thành nhiều ký tự...);
+    () nếu pattern không có tiền tố như vậy. Khoảng trắng literal bị loại và \\s+ không đứng
+    liền nhau nên các nhánh của trie không bao giờ cùng khớp một ký tự.
+    """
+    if _has_top_level_alternation(pattern):
+        return ()
+    pos = 0
+    while pattern.startswith(('\\b', '^'), pos):
+        pos += 1 if pattern[pos] == '^' else 2
+    atoms: List[str] = []
+    while pos < len(pattern):
+        m = _PREFIX_ATOM_RE.match(pattern, pos)
+        if m is None:
+            break
+        if m.group(0) == _WHITESPACE_PREFIX:
+            if atoms and atoms[-1] == _WHITESPACE_PREFIX:
+                break  # \s+\s+: trie tham lam không thử mọi cách chia khoảng trắng
+            atom = _WHITESPACE_PREFIX
+        else:
+            escaped, ch = m.group(1), m.group(2)
+            if escaped is not None and escaped.isalnum():
+                break  # \d, \w, \1, \n...
+            atom = (ch if escaped is None else escaped).casefold()
+            if len(atom) != 1 or atom.isspace():
+                break
+        following = pattern[m.end():m.end() + 1]
+        if following in ('*', '?', '{'):
+            break
+        atoms.append(atom)
+        if following == '+':
+            break
+        pos = m.end()
+    return tuple(atoms)
+
+
+class _CombinedRegex:
+    """
+    Quét mọi pattern regex của các rule trong một lượt trên mỗi văn bản:
+
+    - tiền tố bắt buộc của từng pattern (_literal_prefix) gom thành một regex dạng trie
+      (IGNORECASE, chạy thẳng trên văn bản); mỗi nút kết thúc một tiền tố có một group rỗng
+      tên _t<i>, lastgroup của match cho tiền tố dài nhất khớp tại vị trí đó;
+    - tại mỗi vị trí đó, pattern chung của các pattern có cùng tiền tố vừa khớp
+      (?=(?P<_p0>p0))?(?=(?P<_p1>p1))?... cho span khớp của từng pattern (như pattern.match(text, pos));
+    - findall của từng pattern được dựng lại chính xác từ các span (match kế tiếp bắt đầu từ cuối
+      match trước).
+
+    Fallback: pattern không có tiền tố bắt buộc (email, số điện thoại...), không ghép được
+    (backreference, group có tên...) hoặc dùng cờ VERBOSE chạy findall riêng như cũ, nên chi
+    phí vẫn tăng theo số pattern loại này và theo số vị trí khớp tiền tố.
+    """
+
+    def __init__(self, patterns: List[Pattern]) -> None:
+        self.patterns = patterns
+        self._standalone: List[int] = []
+        buckets: Dict[Tuple[Tuple[str, ...], int], List[int]] = {}
+        for idx, pattern in enumerate(patterns):
+            prefix: Tuple[str, ...] = ()
+            if not _STANDALONE_PATTERN_RE.search(pattern.pattern) and not pattern.flags & re.VERBOSE:
+                try:
+                    re.compile(f"(?:{pattern.pattern})", pattern.flags)
+                    prefix = _literal_prefix(pattern.pattern)
+                except re.error:
+                    prefix = ()
+            if prefix:
+                buckets.setdefault((prefix, pattern.flags), []).append(idx)
+            else:
+                self._standalone.append(idx)
+
+        # Tiền tố -> các pattern chung (mỗi nhóm cờ một pattern)
+        self._buckets: Dict[Tuple[str, ...], List[Tuple[Pattern, List[Tuple[int, str]]]]] = {}
+        for (prefix, flags), indices in buckets.items():
+            try:
+                regex = re.compile(
+                    ''.join(f"(?=(?P<_p{idx}>{patterns[idx].pattern}))?" for idx in indices), flags
+                )
+            except re.error:
+                self._standalone.extend(indices)
+                continue
+            self._buckets.setdefault(prefix, []).append((regex, [(idx, f"_p{idx}") for idx in indices]))
+        self._standalone.sort()
+
+        # Group kết thúc _t<i> -> mọi tiền tố (trong bucket) là tiền tố của nó, kể cả chính nó
+        prefixes = sorted(self._buckets)
+        self._terminals: Dict[str, List[Tuple[str, ...]]] = {
+            f"_t{i}": [prefix[:n] for n in range(1, len(prefix) + 1) if prefix[:n] in self._buckets]
+            for i, prefix in enumerate(prefixes)
+        }
+        self._finder = re.compile(self._trie_pattern(prefixes), re.IGNORECASE) if prefixes else None
+
+    @staticmethod
+    def _trie_pattern(prefixes: List[Tuple[str, ...]]) -> str:
+        trie: Dict[str, Any] = {}
+        for i, prefix in enumerate(prefixes):
+            node = trie
+            for atom in prefix:
+                node = node.setdefault(atom, {})
+            node[''] = i
+
+        def build(node: Dict[str, Any]) -> str:
+            children = [
+                (atom if atom == _WHITESPACE_PREFIX else re.escape(atom)) + build(child)
+                for atom, child in sorted(node.items()) if atom
+            ]
+            if not children:
+                body = ''
+            elif len(children) == 1:
+                body = children[0]
+            else:
+                body = '(?:' + '|'.join(children) + ')'
+            if '' not in node:
+                return body
+            # Tiền tố kết thúc tại đây; phần dài hơn là tuỳ chọn (lùi lại thì group vẫn giữ)
+            return f"(?P<_t{node['']}>)" + (f"(?:{body})?" if body else '')
+
+        return build(trie)
+
+    def findall(self, text: str) -> Dict[int, List[Any]]:
+        """Chỉ số pattern -> kết quả pattern.findall(text) (chỉ pattern có match)."""
+        results: Dict[int, List[Any]] = {}
+        if self._finder is not None:
+            spans: Dict[int, List[Tuple[int, int]]] = {}
+            search, buckets, terminals = self._finder.search, self._buckets, self._terminals
+            m = search(text)
+            while m is not None:
+                pos = m.start()
+                for prefix in terminals[m.lastgroup]:
+                    for regex, groups in buckets[prefix]:
+                        bucket_match = regex.match(text, pos)
+                        for idx, name in groups:
+                            start, end = bucket_match.span(name)
+                            if start >= 0:
+                                spans.setdefault(idx, []).append((start, end))
+                m = search(text, pos + 1)
+            for idx in sorted(spans):
+                found = self._replay(self.patterns[idx], text, spans[idx])
+                if found:
+                    results[idx] = found
+        for idx in self._standalone:
+            found = self.patterns[idx].findall(text)
+            if found:
+                results[idx] = found
+        return results
+
+    @staticmethod
+    def _replay(pattern: Pattern, text: str, spans: List[Tuple[int, int]]) -> List[Any]:
+        found: List[Any] = []
+        cursor = 0
+        for start, end in spans:
+            if start < cursor:
+                continue
+            if start == end:
+                # Match rỗng: quy tắc tiến vị trí của findall phức tạp hơn, chạy trực tiếp
+                return pattern.findall(text)
+            if pattern.groups:
+                found.append(_findall_item(pattern.match(text, start)))
+            else:
+                found.append(text[start:end])
+            cursor = end
+        return found
+
+
+class _KeywordMatcher:
+    """Mọi keyword (đã norm_text) của các rule trong một automaton Aho-Corasick (so khớp chuỗi con)."""
+
+    def __init__(self, keywords: Iterable[str]) -> None:
+        self.keywords: List[str] = sorted(set(keywords))
+        self._matcher = AhoCorasick(self.keywords)
+
+    def found(self, text: str) -> set:
+        if not self.keywords:
+            return set()
+        found = {self.keywords[idx] for _, _, idx in self._matcher.iter_matches(text)}
+        if '' in self.keywords:
+            found.add('')
+        return found
+
+
 @dataclass
 class GuardrailViolation:
     policy_id: str
@@ -299,6 +524,33 @@ class GuardrailViolation:
         return payload
 
 
+@dataclass
+class PromptScan:
+    """Kết quả quét prompt một lần (scan_prompt), dùng lại khi đánh giá response theo từng chunk."""
+    text: str
+    regex_hits: Dict[int, List[Any]]
+    keyword_hits: Set[str]
+    allergy_triggered: bool
+    allergens: Set[str]
+    markers: Set[Tuple[str, str]] = field(default_factory=set)
+
+
+def merge_violations(*groups: Iterable[GuardrailViolation]) -> List[GuardrailViolation]:
+    """Gộp nhiều danh sách vi phạm; cùng policy/rule thì gộp matches (giữ thứ tự xuất hiện)."""
+    merged: Dict[Tuple[str, str], GuardrailViolation] = {}
+    for group in groups:
+        for violation in group:
+            key = (violation.policy_id, violation.rule_id)
+            existing = merged.get(key)
+            if existing is None:
+                merged[key] = violation
+                continue
+            for match in violation.matches:
+                if match not in existing.matches:
+                    existing.matches.append(match)
+    return list(merged.values())
+
+
 class GuardrailPolicyEvaluator:
     """
     Evaluate text against YAML guardrail policies for domain-specific checks.
@@ -310,6 +562,7 @@ class GuardrailPolicyEvaluator:
 
     _SUSPICIOUS_CHARS = {'†', '‡', '※', '‧', '•'}
     _ALLERGY_TRIGGERS = {'dị ứng', 'di ung', 'allergy', 'allergic'}
+    _DANGER_KEYWORDS = ('ngoai tu lanh', 'nhiet do phong', 'thit song', 'uop thit')
 
     def __init__(
         self,
@@ -321,9 +574,32 @@ class GuardrailPolicyEvaluator:
         self._rules: List[Dict[str, Any]] = []
 
         self._load_policies()
+        self._compile_matchers()
+
 
+    def scan_prompt(self, prompt_text: str, markers: bool = True) -> PromptScan:
+        """
+        Quét phía prompt một lần: hit regex / keyword, trigger và allergen dị ứng, dấu
+        hiệu homoglyph (markers=True). Stream truyền kết quả vào evaluate cho mọi chunk
+        nên chi phí mỗi chunk chỉ phụ thuộc cửa sổ response, không phụ thuộc độ dài prompt.
+        """
+        prompt_text = prompt_text or ''
+        normalized = norm_text(prompt_text)
+        return PromptScan(
+            text=prompt_text,
+            regex_hits=self._regex_matcher.findall(prompt_text),
+            keyword_hits=self._keyword_matcher.found(normalized),
+            allergy_triggered=any(trigger in normalized for trigger in self._ALLERGY_TRIGGERS),
+            allergens={term for term in self._allergen_terms if term in normalized},
+            markers=self._homoglyph_markers(prompt_text, always=True) if markers else set(),
+        )
 
-    def evaluate(self, prompt_text: str, response_text: str) -> List[GuardrailViolation]:
+    def evaluate(
+        self,
+        prompt_text: str | PromptScan,
+        response_text: str,
+        seen: Optional[Set[Tuple[str, str]]] = None,
+    ) -> List[GuardrailViolation]:
         """
         Evaluate prompt and response against domain-specific policies.
         
@@ -334,26 +610,47 @@ class GuardrailPolicyEvaluator:
         - Nutrition policies
         - Ethics policies
         - Unicode homoglyph attacks
+
+        `prompt_text` có thể là PromptScan (scan_prompt) để không quét lại prompt.
+        `seen`: khi response được đánh giá theo từng đoạn (streaming), tập dấu hiệu
+        allergen / homoglyph của các đoạn trước; được cập nhật tại chỗ để các rule cần
+        toàn bộ response vẫn bắt được khi dấu hiệu nằm ở những chunk khác nhau.
         """
-        prompt_text = prompt_text or ''
         response_text = response_text or ''
-        normalized_prompt = norm_text(prompt_text)
         normalized_response = norm_text(response_text)
 
+        # Dấu hiệu cho rule cần nhìn toàn văn bản (homoglyph, allergen trong response)
+        if isinstance(prompt_text, PromptScan):
+            prompt = prompt_text
+            markers = prompt.markers | self._homoglyph_markers(response_text, always=True)
+        else:
+            prompt = self.scan_prompt(prompt_text, markers=False)
+            markers = self._homoglyph_markers(prompt.text + response_text, always=seen is not None)
+        markers.update(('allergen', term) for term in self._allergen_terms if term in normalized_response)
+        if seen is not None:
+            seen.update(markers)
+            markers = seen
+
         violations: List[GuardrailViolation] = []
 
         # Unicode homoglyph detection (advanced attack vector)
-        violations.extend(self._detect_homoglyphs(prompt_text + response_text, normalized_response))
+        violations.extend(self._detect_homoglyphs(markers))
+
+        # Mỗi văn bản chỉ quét một lượt cho mọi rule regex / keyword
+        regex_hits = (prompt.regex_hits, self._regex_matcher.findall(response_text))
+        keyword_hits = prompt.keyword_hits | self._keyword_matcher.found(normalized_response)
 
         # Domain-specific policy checks
         for rule in self._rules:
             matches: List[str] = []
             if rule['type'] == 'regex':
-                matches = self._match_regex(rule, prompt_text, response_text)
+                for idx in rule.get('pattern_indices', []):
+                    for hits in regex_hits:
+                        matches.extend(self._extract_matches(hits.get(idx, ())))
             elif rule['type'] == 'keyword':
-                matches = self._match_keywords(rule, normalized_prompt, normalized_response)
+                matches = [kw for kw in rule.get('keywords') or [] if kw in keyword_hits]
             elif rule['type'] == 'allergy':
-                matches = self._match_allergy(rule, normalized_prompt, normalized_response)
+                matches = self._match_allergy(rule, prompt, markers)
             else:
                 continue
 
@@ -413,9 +710,9 @@ class GuardrailPolicyEvaluator:
         return json.dumps(payload, ensure_ascii=False)
 
 
-    def redact_text(self, raw_text: str, violations: Iterable[GuardrailViolation]) -> str:
+    def apply_redactions(self, raw_text: str, violations: Iterable[GuardrailViolation]) -> str:
+        """Chỉ thay các đoạn khớp pattern của rule có redaction, không đổi cấu trúc văn bản."""
         text = raw_text or ''
-        violations = list(violations)
         for violation in violations:
             redaction = violation.metadata.get('redaction')
             if not redaction:
@@ -426,6 +723,12 @@ class GuardrailPolicyEvaluator:
                 except re.error:
                     continue
                 text = compiled.sub(redaction, text)
+        return text
+
+
+    def redact_text(self, raw_text: str, violations: Iterable[GuardrailViolation]) -> str:
+        violations = list(violations)
+        text = self.apply_redactions(raw_text, violations)
 
         # Enrich JSON payloads with warnings when possible
         try:
@@ -455,6 +758,26 @@ class GuardrailPolicyEvaluator:
         return json.dumps(data, ensure_ascii=False)
 
 
+    def _compile_matchers(self) -> None:
+        """Gộp pattern của mọi rule regex vào một _CombinedRegex và keyword vào một automaton."""
+        patterns: List[Pattern] = []
+        keywords: List[str] = []
+        allergen_terms: Set[str] = set()
+        for rule in self._rules:
+            if rule['type'] == 'regex':
+                compiled = rule.get('compiled_patterns', [])
+                rule['pattern_indices'] = list(range(len(patterns), len(patterns) + len(compiled)))
+                patterns.extend(compiled)
+            elif rule['type'] == 'keyword':
+                keywords.extend(rule.get('keywords') or [])
+            elif rule['type'] == 'allergy':
+                rule['allergen_terms'] = [(allergen, norm_text(allergen)) for allergen in rule['allergens']]
+                allergen_terms.update(term for _, term in rule['allergen_terms'])
+        self._allergen_terms = frozenset(allergen_terms)
+        self._regex_matcher = _CombinedRegex(patterns)
+        self._keyword_matcher = _KeywordMatcher(keywords)
+
+
     def _load_policies(self) -> None:
         if not self.policy_dir.exists():
             return
@@ -492,6 +815,7 @@ class GuardrailPolicyEvaluator:
                     'redaction': rule.get('redaction'),
                     'raw_patterns': rule.get('patterns', []),
                     'allergens': [a for a in rule.get('allergens', []) if a],
+                    'prewarm_prompt': rule.get('prewarm_prompt', ''),
                 }
                 if rule_type == 'regex':
                     patterns = []
@@ -509,22 +833,25 @@ class GuardrailPolicyEvaluator:
     # Domain-specific detection methods
     # ------------------------------------------------------------------
 
-    def _detect_homoglyphs(self, text: str, normalized: str) -> List[GuardrailViolation]:
+    def _homoglyph_markers(self, text: str, always: bool = False) -> Set[Tuple[str, str]]:
+        """Ký tự lạ có trong text và cụm nguy hiểm còn lại sau khi bỏ chúng ('char' / 'danger')."""
         suspicious = [char for char in self._SUSPICIOUS_CHARS if char in text]
-        if not suspicious:
-            return []
+        if not suspicious and not always:
+            return set()
+        markers = {('char', char) for char in suspicious}
         # Sau khi loại ký tự lạ, kiểm tra cụm liên quan an toàn thực phẩm
         simplified = text
         for char in suspicious:
             simplified = simplified.replace(char, '')
         simplified_norm = norm_text(simplified)
-        danger_keywords = [
-            'ngoai tu lanh',
-            'nhiet do phong',
-            'thit song',
-            'uop thit',
-        ]
-        if not any(keyword in simplified_norm for keyword in danger_keywords):
+        markers.update(('danger', keyword) for keyword in self._DANGER_KEYWORDS if keyword in simplified_norm)
+        return markers
+
+    def _detect_homoglyphs(self, markers: Set[Tuple[str, str]]) -> List[GuardrailViolation]:
+        suspicious = [char for char in self._SUSPICIOUS_CHARS if ('char', char) in markers]
+        if not suspicious:
+            return []
+        if not any(('danger', keyword) in markers for keyword in self._DANGER_KEYWORDS):
             return []
         violation = GuardrailViolation(
             policy_id='food_safety',
@@ -538,35 +865,17 @@ class GuardrailPolicyEvaluator:
         )
         return [violation]
 
-    def _match_regex(self, rule: Dict[str, Any], prompt_text: str, response_text: str) -> List[str]:
-        matches: List[str] = []
-        for pattern in rule.get('compiled_patterns', []):
-            matches.extend(self._extract_matches(pattern.findall(prompt_text)))
-            matches.extend(self._extract_matches(pattern.findall(response_text)))
-        return matches
-
-    def _match_keywords(
-        self,
-        rule: Dict[str, Any],
-        normalized_prompt: str,
-        normalized_response: str,
-    ) -> List[str]:
-        keywords = rule.get('keywords') or []
-        matches = [kw for kw in keywords if kw in normalized_prompt or kw in normalized_response]
-        return matches
-
     def _match_allergy(
         self,
         rule: Dict[str, Any],
-        normalized_prompt: str,
-        normalized_response: str,
+        prompt: PromptScan,
+        markers: Set[Tuple[str, str]],
     ) -> List[str]:
-        if not any(trigger in normalized_prompt for trigger in self._ALLERGY_TRIGGERS):
+        if not prompt.allergy_triggered:
             return []
         matches = []
-        for allergen in rule.get('allergens', []):
-            allergen_norm = norm_text(allergen)
-            if allergen_norm in normalized_prompt and allergen_norm in normalized_response:
+        for allergen, allergen_norm in rule.get('allergen_terms', []):
+            if allergen_norm in prompt.allergens and ('allergen', allergen_norm) in markers:
                 matches.append(allergen)
         return matches
 
@@ -0,0 +1,139 @@
+"""
+Streaming guardrail evaluation - kiểm tra output của model theo từng chunk.
+
+Mỗi chunk mới được nối vào phần chưa phát (pending) và đánh giá lại trên một cửa sổ
+[lookbehind ký tự đã phát + pending] nên chi phí mỗi chunk không phụ thuộc độ dài output.
+Luôn giữ lại `holdback` ký tự cuối: match dài không quá holdback luôn được nhìn thấy đủ
+trước khi bất kỳ ký tự nào của nó được phát ra (kể cả khi nằm vắt qua ranh giới chunk).
+Prompt được quét một lần khi bắt đầu stream (PromptScan) và dùng lại cho mọi chunk; rule cần
+nhìn toàn bộ response (allergen nhắc trong prompt, ký tự homoglyph + cụm nguy hiểm) dùng tập
+dấu hiệu tích luỹ qua các chunk thay vì chỉ cửa sổ. Chỉ giữ `lookbehind` ký tự cuối đã phát.
+
+- block / safe-completion: dừng phát (halted), caller thay phần còn lại bằng safe completion;
+- redact: thay thế trong pending trước khi phát. Match chạm cuối cửa sổ có thể còn dài thêm
+  khi chunk sau tới (email, địa chỉ tới hết dòng) nên chưa thay và chưa phát từ vị trí đó.
+"""
+from __future__ import annotations
+
+import re
+from typing import Callable, List, Optional, Set, Tuple
+
+from app.guardrails.policies import GuardrailPolicyEvaluator, GuardrailViolation, merge_violations
+
+#: Số ký tự cuối luôn giữ lại (độ dài match tối đa được bảo đảm bắt trọn)
+DEFAULT_HOLDBACK = 64
+#: Số ký tự đã phát đưa lại vào cửa sổ đánh giá (ngữ cảnh \b, lookbehind của pattern)
+DEFAULT_LOOKBEHIND = 256
+
+_ACTION_PRIORITY = ('block', 'safe-completion', 'redact')
+
+
+def _default_resolve_action(violations: List[GuardrailViolation]) -> str:
+    if not violations:
+        return 'allow'
+    actions = {violation.action for violation in violations}
+    for action in _ACTION_PRIORITY:
+        if action in actions:
+            return action
+    return 'safe-completion'
+
+
+class StreamingGuardrailEvaluator:
+    """Đánh giá guardrail tăng dần trên output stream; feed() trả về phần text đã an toàn để phát."""
+
+    def __init__(
+        self,
+        evaluator: GuardrailPolicyEvaluator,
+        prompt_text: str = '',
+        holdback: int = DEFAULT_HOLDBACK,
+        lookbehind: int = DEFAULT_LOOKBEHIND,
+        resolve_action: Optional[Callable[[List[GuardrailViolation]], str]] = None,
+    ) -> None:
+        self.evaluator = evaluator
+        self.prompt_text = prompt_text or ''
+        self.holdback = max(0, int(holdback))
+        self.lookbehind = max(0, int(lookbehind))
+        self.resolve_action = resolve_action or _default_resolve_action
+
+        self._prompt_scan = evaluator.scan_prompt(self.prompt_text)
+        self._released_tail = ''
+        self.violations: List[GuardrailViolation] = []
+        self.action = 'allow'
+        self.halted = False
+        self._pending = ''
+        self._hold_from: Optional[int] = None
+        self._seen: Set[Tuple[str, str]] = set()
+
+    def feed(self, chunk: str) -> str:
+        if self.halted or not chunk:
+            return ''
+        self._pending += chunk
+        self._check(self._pending)
+        if self.halted:
+            return ''
+        cut = len(self._pending) - self.holdback
+        if self._hold_from is not None:
+            cut = min(cut, self._hold_from)
+        return self._release(cut) if cut > 0 else ''
+
+    def flush(self) -> str:
+        """Kết thúc stream: đánh giá lần cuối rồi phát toàn bộ phần còn giữ."""
+        if self.halted:
+            return ''
+        self._check(self._pending, final=True)
+        if self.halted:
+            return ''
+        return self._release(len(self._pending))
+
+    def _check(self, pending: str, final: bool = False) -> None:
+        context = self._released_tail
+        window = context + pending
+        self._hold_from = None
+        violations = self.evaluator.evaluate(self._prompt_scan, window, seen=self._seen)
+        if not violations:
+            return
+
+        self.violations = merge_violations(self.violations, violations)
+        self.action = self.resolve_action(self.violations)
+        if self.action in {'block', 'safe-completion'}:
+            self.halted = True
+            self._pending = ''
+        elif self.action == 'redact':
+            unstable = None if final else self._unstable_start(window, violations)
+            if unstable is not None:
+                unstable = max(unstable, len(context))
+                head, tail = window[:unstable], window[unstable:]
+            else:
+                head, tail = window, ''
+            redacted = self.evaluator.apply_redactions(head, violations)
+            if redacted.startswith(context):
+                redacted = redacted[len(context):]
+            else:
+                redacted = self.evaluator.apply_redactions(head[len(context):], violations)
+            self._pending = redacted + tail
+            if unstable is not None:
+                self._hold_from = len(redacted)
+
+    @staticmethod
+    def _unstable_start(window: str, violations: List[GuardrailViolation]) -> Optional[int]:
+        """Vị trí bắt đầu sớm nhất của match redaction chạm cuối cửa sổ (None nếu không có)."""
+        starts = []
+        for violation in violations:
+            if not violation.metadata.get('redaction'):
+                continue
+            for pattern in violation.metadata.get('patterns', []):
+                try:
+                    compiled = re.compile(pattern, re.IGNORECASE)
+                except re.error:
+                    continue
+                starts.extend(m.start() for m in compiled.finditer(window) if m.end() == len(window))
+        return min(starts) if starts else None
+
+    def _release(self, cut: int) -> str:
+        text, self._pending = self._pending[:cut], self._pending[cut:]
+        if self.lookbehind:
+            self._released_tail = (self._released_tail + text)[-self.lookbehind:]
+        return text
+
+
+__all__ = ["DEFAULT_HOLDBACK", "DEFAULT_LOOKBEHIND", "StreamingGuardrailEvaluator"]
@@ -1,5 +1,5 @@
 from dotenv import load_dotenv
-from typing import Dict, List
+from typing import Dict, List, Optional
 import json
 
 from app.services.invoke_model_service import BedrockModelService
@@ -7,19 +7,21 @@ from app.services.bedrock_kb_service import BedrockKBService
 from app.services.validation_service import ValidationService
 from app.services.ontology_service import OntologyService
 from app.services.unit_converter_service import UnitConverterService 
-from app.utils import fuzzy_score, tokenize
 from app.services.conflict_service import ConflictDetectionService
+from app.services.preload import preload_services
 
 load_dotenv()
 
 class ShoppingCartPipeline:
     def __init__(self):
+        # Dựng các service dữ liệu dùng chung một lần mỗi process (master khi server preload trước fork)
+        preload_services()
         self.extractor = BedrockModelService()
         self.kb_service = BedrockKBService()
         self.converter = UnitConverterService()
         self.validator = ValidationService()
         self.ontology = OntologyService()
-        self.conflicts = ConflictDetectionService()
+        self.conflicts = ConflictDetectionService(ontology=self.ontology)
 
 
     def process(self, user_input: str) -> dict:
@@ -87,12 +89,19 @@ class ShoppingCartPipeline:
                 'warnings': self._unique_warnings(warnings),
             }
         
-        recipe_ing = self._normalize_recipe_items(recipe.get('ingredients', []))
-        extra_norm = self._normalize_extra(extra_ingredients)
+        # Resolve toàn bộ tên nguyên liệu của request trong một lượt matching
+        resolved = self._resolve_names(
+            self._recipe_item_names(recipe.get('ingredients', []))
+            + self._item_names(extra_ingredients)
+            + self._item_names(excluded_ingredients)
+        )
+
+        recipe_ing = self._normalize_recipe_items(recipe.get('ingredients', []), resolved)
+        extra_norm = self._normalize_extra(extra_ingredients, resolved)
         
         # Filter out excluded ingredients
         if excluded_ingredients:
-            recipe_ing = self._filter_excluded_ingredients(recipe_ing, excluded_ingredients)
+            recipe_ing = self._filter_excluded_ingredients(recipe_ing, excluded_ingredients, resolved)
         
         # Merge: công thức + nguyên liệu thêm
         all_ingredients = recipe_ing + [it for it in extra_norm if it.get('ingredient_id')]
@@ -114,20 +123,24 @@ class ShoppingCartPipeline:
         # Similar dishes
         similar = self.ontology.search_similar_dishes(
             [item['ingredient_id'] for item in all_ingredients], 
-            min_match=3
+            min_match=3,
+            top_k=3,
         )
 
         # Conflict detection warnings
+        # Nguyên liệu trong giỏ kiểm tra theo id, tên thêm thô (chưa resolve) so khớp chuỗi
         ingredient_names: List[str] = []
+        ingredient_ids: List[Optional[str]] = []
         ingredient_names.extend([item.get('name_vi') or item.get('name') or '' for item in cart_items])
-        ingredient_names.extend(
-            [
-                ing.get('name', '')
-                for ing in extra_ingredients
-                if isinstance(ing, dict)
-            ]
-        )
-        conflict_results = self.conflicts.check_conflicts(dish_name, ingredient_names)
+        ingredient_ids.extend([item.get('ingredient_id') for item in cart_items])
+        extra_names = [
+            ing.get('name', '')
+            for ing in extra_ingredients
+            if isinstance(ing, dict)
+        ]
+        ingredient_names.extend(extra_names)
+        ingredient_ids.extend([None] * len(extra_names))
+        conflict_results = self.conflicts.check_conflicts(dish_name, ingredient_names, ingredient_ids)
         conflict_warnings = [
             {
                 'message': conflict.get('message', ''),
@@ -263,12 +276,14 @@ class ShoppingCartPipeline:
         # return local if local else {'ingredients': []}
         return {'ingredients': []}
     
-    def _normalize_extra(self, extra_ingredients: list) -> list:
+    def _normalize_extra(self, extra_ingredients: list, resolved: Optional[Dict[str, Optional[str]]] = None) -> list:
         """
         Map extra ingredients sang ontology format - SỬ DỤNG FUZZY MATCHING
         Input: [{"name": "trứng cút", "quantity": "", "unit": ""}]
         Output: [{"ingredient_id": "ing_xxx", "name_vi": "Trứng cút", ...}]
         """
+        if resolved is None:
+            resolved = self._resolve_names(self._item_names(extra_ingredients))
         normalized = []
         
         for item in extra_ingredients:
@@ -277,7 +292,7 @@ class ShoppingCartPipeline:
                 continue
             
             # Sử dụng fuzzy matching như recipe ingredients
-            matched_id = self._resolve_name_to_ingredient_id(name)
+            matched_id = resolved.get(name)
             if matched_id:
                 ing_data = self.ontology.ingredients.get(matched_id, {})
                 normalized.append({
@@ -289,20 +304,27 @@ class ShoppingCartPipeline:
         
         return normalized
     
-    def _filter_excluded_ingredients(self, recipe_items: list, excluded: list) -> list:
+    def _filter_excluded_ingredients(
+        self,
+        recipe_items: list,
+        excluded: list,
+        resolved: Optional[Dict[str, Optional[str]]] = None,
+    ) -> list:
         """
         Filter out excluded ingredients from recipe using fuzzy matching
         Input excluded: [{"name": "hành lá", "reason": "dị ứng"}]
         """
         if not excluded:
             return recipe_items
+        if resolved is None:
+            resolved = self._resolve_names(self._item_names(excluded))
         
         # Resolve excluded names to ingredient_ids using fuzzy matching
         excluded_ids = set()
         for exc in excluded:
             name = exc.get('name', '').strip()
             if name:
-                matched_id = self._resolve_name_to_ingredient_id(name)
+                matched_id = resolved.get(name)
                 if matched_id:
                     excluded_ids.add(matched_id)
         
@@ -347,73 +369,37 @@ class ShoppingCartPipeline:
         return suggestions
     
     def _resolve_name_to_ingredient_id(self, name: str):
-        if not name:
-            return None
-
-        THRESHOLD_A = 0.70  # ngưỡng cho name_vi
-        THRESHOLD_B = 0.65  # ngưỡng cho synonyms 
-        q_tokens = set(tokenize(name))
-
-        ing_dict = getattr(self.ontology, 'ingredients', {}) or {}
-
-        # ---------- Stage A: chỉ xét name_vi ----------
-        best_id = None
-        best_score = -1.0
-        best_extras = 10**9
-        best_len = 10**9
-
-        for ing_id, ing in ing_dict.items():
-            cand = ing.get('name_vi') or ''
-            if not cand:
-                continue
-            sc = fuzzy_score(name, cand)
-            extras = len(set(tokenize(cand)) - q_tokens)  # ít từ dư hơn thì tốt hơn
-            clen = len(cand)
-
-            if (sc > best_score) or (sc == best_score and (extras < best_extras or (extras == best_extras and clen < best_len))):
-                best_id, best_score, best_extras, best_len = ing_id, sc, extras, clen
+        # Stage A (name_vi, 0.70) / Stage B (synonyms, 0.65) chạy trên IngredientIndex
+        return self.ontology.resolve_ingredient_id(name)
 
-        if best_score >= THRESHOLD_A:
-            return best_id
+    def _resolve_names(self, names: List[str]) -> Dict[str, Optional[str]]:
+        """Resolve một lô tên -> ingredient_id bằng một lượt matching duy nhất."""
+        names = [nm for nm in dict.fromkeys(names) if nm]
+        matches = self.ontology.resolve_many(names)
+        return {nm: match.ingredient_id for nm, match in zip(names, matches)}
 
-        # ---------- Stage B: xét synonyms nếu Stage A không đủ ----------
-        best_id = None
-        best_score = -1.0
-        best_extras = 10**9
-        best_len = 10**9
-
-        for ing_id, ing in ing_dict.items():
-            syns = [s for s in ing.get('synonyms', []) if s]
-            if not syns:
-                continue
-
-            # lấy synonym tốt nhất cho ingredient này
-            local_best_sc = -1.0
-            local_best_extras = 10**9
-            local_best_len = 10**9
-            for s in syns:
-                sc = fuzzy_score(name, s)
-                extras = len(set(tokenize(s)) - q_tokens)
-                slen = len(s)
-                if (sc > local_best_sc) or (sc == local_best_sc and (extras < local_best_extras or (extras == local_best_extras and slen < local_best_len))):
-                    local_best_sc, local_best_extras, local_best_len = sc, extras, slen
-
-            if (local_best_sc > best_score) or (local_best_sc == best_score and (local_best_extras < best_extras or (local_best_extras == best_extras and local_best_len < best_len))):
-                best_id, best_score, best_extras, best_len = ing_id, local_best_sc, local_best_extras, local_best_len
-
-        if best_score >= THRESHOLD_B:
-            return best_id
+    @staticmethod
+    def _recipe_item_names(items: list) -> List[str]:
+        return [it.get('name_vi') or it.get('name') or '' for it in items or []]
 
-        return None
+    @staticmethod
+    def _item_names(items: list) -> List[str]:
+        return [
+            it.get('name', '').strip()
+            for it in items or []
+            if isinstance(it, dict)
+        ]
 
 
-    def _normalize_recipe_items(self, items: list) -> list:
+    def _normalize_recipe_items(self, items: list, resolved: Optional[Dict[str, Optional[str]]] = None) -> list:
         if not items:
             return []
+        if resolved is None:
+            resolved = self._resolve_names(self._recipe_item_names(items))
         normalized = []
         for it in items:
             nm = it.get('name_vi') or it.get('name') or ''
-            ing_id = self._resolve_name_to_ingredient_id(nm)
+            ing_id = resolved.get(nm)
             if not ing_id:
                 continue
             normalized.append({
@@ -439,7 +425,7 @@ class ShoppingCartPipeline:
         # thêm các id suy ra từ tên/synonyms của các id hiện có
         for iid in list(current_ids):
             ing = self.ontology.ingredients.get(iid, {})
-            names = [ing.get('name_vi', '')] + ing.get('synonyms', [])
+            names = [ing.get('name_vi', '')] + list(ing.get('synonyms', []))
             for n in names:
                 mid = name_to_id.get(str(n).strip().lower())
                 if mid:
@@ -447,18 +433,8 @@ class ShoppingCartPipeline:
         return exclude
     
     def _allowed_categories_for_dish(self, dish_name: str) -> set:
-        cats = set()
-        dish = self.ontology.get_dish_by_name(dish_name) or {}
-        
-        # Lấy category từ ingredient knowledge base
-        for it in dish.get('ingredients', []):
-            ing_id = it.get('ingredient_id')
-            if ing_id:
-                ing_data = self.ontology.get_ingredient(ing_id)
-                if ing_data:
-                    cat = ing_data.get('category')
-                    if cat:
-                        cats.add(cat)
+        # Category nguyên liệu của món đã được tính sẵn trong ontology
+        cats = self.ontology.get_dish_categories(dish_name)
         
         if cats:
             return cats
@@ -0,0 +1,98 @@
+import json
+import re
+import shutil
+import tempfile
+import timeit
+from pathlib import Path
+
+import yaml
+
+from app.guardrails import GuardrailPolicyEvaluator
+from app.utils.text_match import norm_text
+
+POLICY_DIR = Path("app/guardrails")
+
+
+def legacy_match_regex(rule, prompt_text, response_text):
+    """Bản cũ: findall riêng từng pattern của rule trên prompt rồi response."""
+    matches = []
+    for pattern in rule.get('compiled_patterns', []):
+        matches.extend(GuardrailPolicyEvaluator._extract_matches(pattern.findall(prompt_text)))
+        matches.extend(GuardrailPolicyEvaluator._extract_matches(pattern.findall(response_text)))
+    return matches
+
+
+def legacy_match_keywords(rule, normalized_prompt, normalized_response):
+    """Bản cũ: kiểm tra từng keyword của rule bằng phép tìm chuỗi con."""
+    keywords = rule.get('keywords') or []
+    return [kw for kw in keywords if kw in normalized_prompt or kw in normalized_response]
+
+
+def legacy_evaluate(evaluator, prompt_text, response_text):
+    """Bản cũ: mỗi rule regex chạy findall riêng từng pattern, mỗi keyword kiểm tra riêng."""
+    normalized_prompt = norm_text(prompt_text)
+    normalized_response = norm_text(response_text)
+    matched = []
+    for rule in evaluator._rules:
+        if rule['type'] == 'regex':
+            matches = legacy_match_regex(rule, prompt_text, response_text)
+        elif rule['type'] == 'keyword':
+            matches = legacy_match_keywords(rule, normalized_prompt, normalized_response)
+        else:
+            continue
+        if matches:
+            matched.append(rule['rule_id'])
+    return matched
+
+
+def _write_synthetic_policy(policy_dir, names, n_rules):
+    """n_rules rule tổng hợp (nửa regex, nửa keyword) từ tên nguyên liệu."""
+    rules = []
+    step = max(1, len(names) // n_rules)
+    for i, name in enumerate(names[::step][:n_rules]):
+        if i % 2 == 0:
+            pattern = r"\s+".join(re.escape(w) for w in name.split()) + r"\s+(?:sống|tái)"
+            rules.append({'id': f'synthetic-regex-{i}', 'type': 'regex', 'patterns': [pattern], 'action': 'safe-completion'})
+        else:
+            rules.append({'id': f'synthetic-keyword-{i}', 'type': 'keyword', 'keywords': [f"{name} ôi thiu"], 'action': 'safe-completion'})
+    config = {'policy_id': 'synthetic', 'name': 'Synthetic benchmark rules', 'rules': rules}
+    (Path(policy_dir) / 'synthetic_policy.yaml').write_text(yaml.safe_dump(config, allow_unicode=True), encoding='utf-8')
+
+
+def benchmark_guardrails(rule_counts=(0, 50, 200, 800, 3200), number=20):
+    """So sánh thời gian evaluate theo số rule: vòng lặp từng rule vs quét gộp một lượt"""
+
+    print("⏱️  Benchmarking guardrail policy evaluation...")
+
+    with open("app/data/knowledge_base/ingredient_knowledge_base.json", 'r', encoding='utf-8') as f:
+        names = [ing['name_vi'] for ing in json.load(f) if ing.get('name_vi')]
+
+    prompt = "Cho tôi công thức phở bò, liên hệ 0912345678"
+    # Giống một response dài của mô hình (JSON nguyên liệu + giải thích)
+    response = " ".join(f"{name} 200 g," for name in names[:1500])
+
+    print(f"   - Response {len(response)} ký tự, {number} lượt")
+    for n_rules in rule_counts:
+        policy_dir = Path(tempfile.mkdtemp(prefix="guardrail-bench-"))
+        try:
+            for path in POLICY_DIR.glob('*_policy.yaml'):
+                shutil.copy(path, policy_dir)
+            if n_rules:
+                _write_synthetic_policy(policy_dir, names, n_rules)
+            evaluator = GuardrailPolicyEvaluator(policy_dir=policy_dir)
+        finally:
+            shutil.rmtree(policy_dir, ignore_errors=True)
+
+        expected = legacy_evaluate(evaluator, prompt, response)
+        got = [v.rule_id for v in evaluator.evaluate(prompt, response) if v.rule_id != 'unicode-homoglyph']
+        legacy_ms = min(timeit.repeat(lambda: legacy_evaluate(evaluator, prompt, response), number=number, repeat=3)) / number * 1000
+        combined_ms = min(timeit.repeat(lambda: evaluator.evaluate(prompt, response), number=number, repeat=3)) / number * 1000
+        print(
+            f"   - {len(evaluator._rules):4d} rules: per-rule {legacy_ms:8.2f} ms  "
+            f"single-pass {combined_ms:8.2f} ms  (x{legacy_ms / combined_ms:.1f})"
+            f"{'' if got == expected else '  ❌ kết quả khác nhau'}"
+        )
+
+
+if __name__ == "__main__":
+    benchmark_guardrails()
@@ -0,0 +1,69 @@
+import json
+import timeit
+import unicodedata
+from pathlib import Path
+
+from app.utils.text_match import _strip_accents, norm_text
+
+
+def legacy_norm_text(s):
+    """Bản cũ: NFKD + generator Python trên từng ký tự, không map đ -> d."""
+    if s is None:
+        return ""
+    nfkd = unicodedata.normalize("NFKD", str(s))
+    return "".join(ch for ch in nfkd if not unicodedata.combining(ch)).lower().strip()
+
+
+def benchmark_normalizer(number: int = 20):
+    """So sánh tốc độ chuẩn hoá: bản cũ vs translate table (+ memo)"""
+
+    print("⏱️  Benchmarking Vietnamese normalizer...")
+
+    kb_path = Path("app/data/knowledge_base")
+    with open(kb_path / "ingredient_knowledge_base.json", 'r', encoding='utf-8') as f:
+        ingredients = json.load(f)
+
+    names = [ing['name_vi'] for ing in ingredients]
+    names += [syn for ing in ingredients for syn in ing.get('synonyms', [])]
+    hot = names[:500] * 20  # tập tên lặp lại nhiều lần (cùng các món/nguyên liệu phổ biến)
+    long_text = " ".join(names[:400])  # giống một response dài của mô hình
+
+    cases = {
+        'legacy': lambda: [legacy_norm_text(n) for n in names],
+        'translate (no memo)': lambda: [_strip_accents(n).lower().strip() for n in names],
+        'translate + memo': lambda: [norm_text(n) for n in names],
+    }
+    hot_cases = {
+        'legacy': lambda: [legacy_norm_text(n) for n in hot],
+        'translate (no memo)': lambda: [_strip_accents(n).lower().strip() for n in hot],
+        'translate + memo': lambda: [norm_text(n) for n in hot],
+    }
+    long_cases = {
+        'legacy': lambda: legacy_norm_text(long_text),
+        'translate': lambda: norm_text(long_text),
+    }
+
+    print(f"   - {len(names)} tên nguyên liệu/synonym, {number} lượt")
+    baseline = None
+    for label, fn in cases.items():
+        elapsed = min(timeit.repeat(fn, number=number, repeat=3)) / number
+        baseline = baseline or elapsed
+        print(f"   - {label:<22} {elapsed * 1000:8.2f} ms/lượt  (x{baseline / elapsed:.1f})")
+
+    print(f"   - {len(hot)} lượt tra trên 500 tên lặp lại:")
+    baseline = None
+    for label, fn in hot_cases.items():
+        elapsed = min(timeit.repeat(fn, number=number, repeat=3)) / number
+        baseline = baseline or elapsed
+        print(f"   - {label:<22} {elapsed * 1000:8.2f} ms/lượt  (x{baseline / elapsed:.1f})")
+
+    print(f"   - Văn bản dài {len(long_text)} ký tự:")
+    baseline = None
+    for label, fn in long_cases.items():
+        elapsed = min(timeit.repeat(fn, number=number, repeat=3)) / number
+        baseline = baseline or elapsed
+        print(f"   - {label:<22} {elapsed * 1000:8.2f} ms/lượt  (x{baseline / elapsed:.1f})")
+
+
+if __name__ == "__main__":
+    benchmark_normalizer()
@@ -0,0 +1,75 @@
+import random
+import time
+
+from app.services.ontology_service import OntologyService
+from app.utils.minhash import MinHashLSH
+
+
+def sample_carts(ontology, n_carts, seed=0):
+    """Giỏ giả lập: ~70% nguyên liệu của 1-2 món + vài nguyên liệu ngẫu nhiên."""
+    rnd = random.Random(seed)
+    dishes = [d for d in ontology.dishes.values() if d.get('ingredients')]
+    all_ids = list(ontology.ingredients)
+    carts = []
+    for _ in range(n_carts):
+        picked = rnd.sample(dishes, rnd.randint(1, 2))
+        cart = [
+            ing['ingredient_id']
+            for dish in picked
+            for ing in dish['ingredients']
+            if rnd.random() < 0.7
+        ]
+        cart += rnd.sample(all_ids, 2)
+        carts.append(cart)
+    return carts
+
+
+def benchmark_similar_dishes_lsh(n_carts=300, min_match=3, ks=(3, 10)):
+    """So sánh recall@k và latency của LSH với đường chấm chính xác"""
+
+    print("⏱️  Benchmarking MinHash/LSH similar-dish candidates...")
+
+    ontology = OntologyService()
+    carts = sample_carts(ontology, n_carts)
+    top = max(ks)
+
+    start = time.perf_counter()
+    exact = [ontology.search_similar_dishes(c, min_match, top_k=top, approximate=False) for c in carts]
+    exact_ms = (time.perf_counter() - start) * 1000 / len(carts)
+    print(f"   - {len(ontology.dishes)} món, {len(carts)} giỏ, min_match={min_match}")
+    print(f"   - exact (posting list)       {exact_ms:7.3f} ms/giỏ")
+
+    configs = [(16, 1), (32, 2), (64, 2), (32, 3), (64, 3)]
+    for bands, rows in configs:
+        start = time.perf_counter()
+        ontology._dish_lsh = MinHashLSH(
+            [ontology.dish_profiles[dish_id]['importance_map'] for dish_id in ontology._dish_ids],
+            bands=bands,
+            rows=rows,
+        )
+        build_s = time.perf_counter() - start
+
+        n_candidates = sum(len(ontology.dish_lsh.query(set(c))) for c in carts) / len(carts)
+        start = time.perf_counter()
+        approx = [ontology.search_similar_dishes(c, min_match, top_k=top, approximate=True) for c in carts]
+        approx_ms = (time.perf_counter() - start) * 1000 / len(carts)
+
+        recalls = []
+        for k in ks:
+            hits = total = 0
+            for e, a in zip(exact, approx):
+                expected = {m['dish_id'] for m in e[:k]}
+                hits += len(expected & {m['dish_id'] for m in a[:k]})
+                total += len(expected)
+            recalls.append(f"recall@{k}={hits / total if total else 1.0:.3f}")
+
+        print(
+            f"   - LSH bands={bands:<3} rows={rows}  {approx_ms:7.3f} ms/giỏ  "
+            f"{n_candidates:7.1f} ứng viên  {'  '.join(recalls)}  (build {build_s:.2f}s)"
+        )
+
+    ontology._dish_lsh = None
+
+
+if __name__ == "__main__":
+    benchmark_similar_dishes_lsh()
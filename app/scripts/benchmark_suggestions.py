@@ -0,0 +1,60 @@
+import random
+import time
+
+from app.scripts.benchmark_similar_dishes_lsh import sample_carts
+from app.services.ontology_service import OntologyService
+from app.services.validation_service import ValidationService
+
+
+def _run(validator, queries, ingredients, mode, top_k):
+    start = time.perf_counter()
+    results = [
+        validator.suggest_ingredients(cart, allowed, cart, top_k, ingredients, mode=mode)
+        for cart, allowed in queries
+    ]
+    return results, (time.perf_counter() - start) * 1000 / len(queries)
+
+
+def benchmark_suggestions(n_carts=300, top_k=5):
+    """So sánh latency và độ trùng top-k giữa gợi ý PMI và gợi ý bằng embeddings"""
+
+    print("⏱️  Benchmarking ingredient suggestions (PMI vs embedding)...")
+
+    ontology = OntologyService()
+    validator = ValidationService()
+    embeddings = validator.cooccurrence.embeddings
+    if embeddings is None:
+        print("❌ Matrix has no embeddings, run: python -m app.scripts.build_cooccurrence")
+        return
+
+    ingredients = ontology.ingredients
+    carts = sample_carts(ontology, n_carts)
+    rnd = random.Random(1)
+    # Warm-up: dựng cache ứng viên trước khi đo
+    validator.suggest_ingredients(carts[0], None, None, top_k, ingredients)
+
+    print(f"   - {len(validator.cooccurrence)} nguyên liệu, embeddings {embeddings.shape[1]} chiều, {len(carts)} giỏ")
+    for label, with_categories in (("không lọc category", False), ("lọc category", True)):
+        queries = []
+        for cart in carts:
+            allowed = None
+            if with_categories:
+                picked = rnd.sample(cart, min(2, len(cart)))
+                allowed = {ingredients[i].get('category') for i in picked if i in ingredients}
+            queries.append((cart, allowed))
+
+        pmi, pmi_ms = _run(validator, queries, ingredients, 'pmi', top_k)
+        emb, emb_ms = _run(validator, queries, ingredients, 'embedding', top_k)
+
+        hits = total = 0
+        for p, e in zip(pmi, emb):
+            expected = {s['id'] for s in p}
+            hits += len(expected & {s['id'] for s in e})
+            total += len(expected)
+        print(f"   - {label}:")
+        print(f"       pmi        {pmi_ms:7.3f} ms/giỏ")
+        print(f"       embedding  {emb_ms:7.3f} ms/giỏ  overlap@{top_k}={hits / total if total else 1.0:.3f}")
+
+
+if __name__ == "__main__":
+    benchmark_suggestions()
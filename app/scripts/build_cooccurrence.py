@@ -1,56 +1,293 @@
 import json
-from collections import defaultdict
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from datetime import datetime
 
-def build_cooccurrence_matrix():
-    """Build ma trận co-occurrence từ knowledge base"""
-    
+import numpy as np
+from scipy import sparse
+
+from app.services.cooccurrence import (
+    EMBEDDING_DIM,
+    METADATA_FILE,
+    NEIGHBOR_TOP_K,
+    CooccurrenceMatrix,
+    read_metadata,
+)
+
+#: Cặp có count nhỏ hơn ngưỡng này bị loại khi ghi ma trận. Mặc định giữ mọi cặp
+#: (suggest_ingredients chấm PMI cả cặp hiếm; _suggest tự bỏ count < 3 lúc truy vấn trên
+#: dòng count đầy đủ). Top-K láng giềng vì thế gồm cả cặp hiếm — không dùng để lọc theo count.
+#: Tỉa là tuỳ chọn qua COOCCURRENCE_MIN_COUNT: file nhỏ hơn nhưng cặp bị tỉa được
+#: coi như không đồng xuất hiện (chỉ còn điểm prior)
+MIN_PAIR_COUNT = 1
+#: Số món mỗi lô gửi cho worker đếm cặp
+CHUNK_DISHES = 2000
+#: Cập nhật tăng dần giữ embeddings cũ cho đến khi số món thêm/xoá/sửa cộng dồn từ lần
+#: SVD trước vượt tỉ lệ này của tổng số món (COOCCURRENCE_SVD_REFRESH; 0 = SVD mỗi lần)
+SVD_REFRESH_RATIO = 0.05
+
+KB_PATH = "app/data/knowledge_base"
+OUTPUT_PATH = "app/data/cooccurrence"
+#: Trạng thái build đầy đủ cho cập nhật tăng dần (update_cooccurrence)
+STATE_FILE = "build_state.npz"
+
+
+def iter_json_array(path, buffer_size=1 << 20):
+    """Đọc lần lượt từng phần tử của file JSON dạng mảng, không nạp cả file vào bộ nhớ."""
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8') as f:
+        buf, pos, eof, started = '', 0, False, False
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n':
+                pos += 1
+            if pos == len(buf) and not eof:
+                chunk = f.read(buffer_size)
+                buf, pos, eof = chunk, 0, not chunk
+                continue
+            if pos == len(buf):
+                raise ValueError(f"Unexpected end of JSON array in {path}")
+
+            if not started:
+                if buf[pos] != '[':
+                    raise ValueError(f"{path} is not a JSON array")
+                pos, started = pos + 1, True
+                continue
+            if buf[pos] == ']':
+                return
+            if buf[pos] == ',':
+                pos += 1
+                continue
+
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                end = None
+            # Phần tử bị cắt ngang ở cuối buffer: đọc thêm rồi parse lại
+            if (end is None or end == len(buf)) and not eof:
+                chunk = f.read(buffer_size)
+                buf, pos, eof = buf[pos:] + chunk, 0, not chunk
+                continue
+            if end is None:
+                raise ValueError(f"Invalid JSON element in {path} at offset {pos}")
+            yield item
+            pos = end
+
+
+def _count_pairs(flat_ids, lengths):
+    """
+    Đếm cặp đồng xuất hiện của một lô món (id số nối liền + số nguyên liệu mỗi món).
+    Trả về (khoá, count) đã gộp, khoá = a << 32 | b cho cả hai chiều (a, b) và (b, a)
+    như vòng lặp dict cũ (id trùng trong một món cộng 2 vào ô (a, a)).
+    """
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    parts = []
+    for k in np.unique(lengths):
+        if k < 2:
+            continue
+        # Các món cùng số nguyên liệu k: ma trận (số món x k), lấy mọi cặp i < j
+        rows = flat_ids[starts[lengths == k][:, None] + np.arange(k)]
+        iu, ju = np.triu_indices(k, 1)
+        a = rows[:, iu].ravel()
+        b = rows[:, ju].ravel()
+        parts.append((a << 32) | b)
+        parts.append((b << 32) | a)
+    if not parts:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    keys, counts = np.unique(np.concatenate(parts), return_counts=True)
+    return keys, counts.astype(np.int64)
+
+
+def _merge_counts(parts):
+    keys = np.concatenate([p[0] for p in parts])
+    counts = np.concatenate([p[1] for p in parts])
+    merged, inverse = np.unique(keys, return_inverse=True)
+    return merged, np.bincount(inverse, weights=counts).astype(np.int64)
+
+
+def _iter_chunks(dish_path, vocab, dish_keys, chunk_size):
+    """Gom món thành lô (id số nối liền, số nguyên liệu mỗi món); cập nhật vocab và khoá món."""
+    flat, lengths = [], []
+    for dish in iter_json_array(dish_path):
+        ids = [vocab.setdefault(ing['ingredient_id'], len(vocab)) for ing in dish.get('ingredients', [])]
+        dish_keys.append(str(dish.get('id', f"#{len(dish_keys)}")))
+        flat.extend(ids)
+        lengths.append(len(ids))
+        if len(lengths) >= chunk_size:
+            yield np.asarray(flat, dtype=np.int64), np.asarray(lengths, dtype=np.int64)
+            flat, lengths = [], []
+    if lengths:
+        yield np.asarray(flat, dtype=np.int64), np.asarray(lengths, dtype=np.int64)
+
+
+def _add_frequency(frequency, flat, size, sign=1):
+    out = np.zeros(size, dtype=np.int64)
+    out[:len(frequency)] = frequency
+    out += sign * np.bincount(flat, minlength=size)
+    return out
+
+
+def write_build_state(output_path, ids, frequency, keys, counts, dish_keys, dish_flat, dish_lengths):
+    """
+    Lưu trạng thái build đầy đủ (cặp chưa lọc min_count + nguyên liệu từng món) để
+    update_cooccurrence áp delta chính xác mà không đếm lại toàn bộ KB.
+    Chỉ script build đọc file này, service không nạp.
+    """
+    indptr = np.zeros(len(dish_lengths) + 1, dtype=np.int64)
+    np.cumsum(dish_lengths, out=indptr[1:])
+    tmp = Path(output_path) / f".{STATE_FILE}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        np.savez(
+            f,
+            ids=np.asarray(ids, dtype=str),
+            frequency=np.asarray(frequency, dtype=np.int64),
+            pair_keys=keys,
+            pair_counts=counts,
+            dish_keys=np.asarray(dish_keys, dtype=str),
+            dish_indptr=indptr,
+            dish_ingredients=np.asarray(dish_flat, dtype=np.int64),
+        )
+    os.replace(tmp, Path(output_path) / STATE_FILE)
+
+
+def read_build_state(output_path):
+    """Trạng thái build (dict mảng numpy) hoặc None nếu chưa có."""
+    state_path = Path(output_path) / STATE_FILE
+    if not state_path.exists():
+        return None
+    with np.load(state_path, allow_pickle=False) as data:
+        return {name: data[name] for name in data.files}
+
+
+def save_outputs(
+    output_path, ids, frequency, keys, counts, total_dishes, min_count, top_k,
+    embedding_dim=EMBEDDING_DIM, previous=None, touched=None, changed_dishes=0, **metadata,
+):
+    """
+    Lọc cặp theo min_count, dựng top-K láng giềng và embeddings (SVD của PPMI, bỏ qua
+    nếu embedding_dim = 0), ghi ma trận runtime (phiên bản mới); trả về (số cặp giữ
+    lại, phiên bản).
+
+    Cập nhật tăng dần truyền previous (ma trận phiên bản hiện tại, cùng min_count/top_k)
+    và touched (id số của nguyên liệu trong món thêm/xoá/sửa): chỉ tính lại láng giềng
+    của touched và các dòng có cột thuộc touched; embeddings cũ được giữ (nguyên liệu
+    mới nhận vector 0) cho đến khi changed_dishes cộng dồn vượt SVD_REFRESH_RATIO.
+    """
+    keep = counts >= min_count
+    keys, counts = keys[keep], counts[keep]
+    n = len(ids)
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys >> 32, minlength=n), out=indptr[1:])
+    csr = sparse.csr_matrix((counts, keys & 0xFFFFFFFF, indptr), shape=(n, n))
+
+    if previous is not None and touched is not None:
+        previous_neighbors = (previous.neighbor_indptr, previous.neighbor_indices, previous.neighbor_counts)
+        matrix = CooccurrenceMatrix(
+            ids, csr, np.asarray(frequency, dtype=np.int64), total_dishes, previous_neighbors,
+        )
+        # Thứ tự láng giềng của một dòng chỉ phụ thuộc count của dòng và tần suất các cột
+        touched = np.unique(np.asarray(touched, dtype=np.int64))
+        rows = [touched] + [csr.indices[csr.indptr[i]:csr.indptr[i + 1]] for i in touched.tolist()]
+        matrix.refresh_neighbors(previous_neighbors, np.concatenate(rows), top_k)
+    else:
+        matrix = CooccurrenceMatrix(
+            ids, csr, np.asarray(frequency, dtype=np.int64), total_dishes, neighbor_top_k=top_k,
+        )
+
+    output_path = Path(output_path)
+    previous_metadata = read_metadata(output_path) if (output_path / METADATA_FILE).exists() else {}
+    version = int(previous_metadata.get('version', 0)) + 1
+
+    stale = 0
+    if embedding_dim:
+        ratio = float(os.getenv("COOCCURRENCE_SVD_REFRESH", SVD_REFRESH_RATIO))
+        stale = int(previous_metadata.get('embedding_stale_dishes', 0)) + changed_dishes
+        old = previous.embeddings if previous is not None else None
+        if old is not None and old.shape[1] == min(embedding_dim, n - 1) and stale <= ratio * total_dishes:
+            matrix.embeddings = np.zeros((n, old.shape[1]), dtype=np.float32)
+            matrix.embeddings[:len(old)] = old
+        else:
+            matrix.embeddings = matrix.build_embeddings(embedding_dim)
+            stale = 0
+
+    matrix.save(
+        output_path,
+        version=version,
+        min_count=min_count,
+        neighbor_top_k=top_k,
+        build_date=datetime.now().isoformat(),
+        embedding_stale_dishes=stale,
+        **metadata,
+    )
+    return len(counts), version
+
+
+def build_cooccurrence_matrix(
+    top_k=NEIGHBOR_TOP_K,
+    min_count=None,
+    workers=None,
+    chunk_size=CHUNK_DISHES,
+    embedding_dim=EMBEDDING_DIM,
+):
+    """Build ma trận co-occurrence (và top-K láng giềng PMI) từ knowledge base"""
+
     print("🔨 Building co-occurrence matrix...")
-    
-    # Load data
-    kb_path = Path("app/data/knowledge_base")
-    with open(kb_path / "dish_knowledge_base.json", 'r', encoding='utf-8') as f:
-        dishes = json.load(f)
-    
-    # Build matrix
-    cooccurrence = defaultdict(lambda: defaultdict(int))
-    frequency = defaultdict(int)
-    
-    for dish in dishes:
-        ing_ids = [ing['ingredient_id'] for ing in dish.get('ingredients', [])]
-        
-        # Count frequency
-        for ing_id in ing_ids:
-            frequency[ing_id] += 1
-        
-        # Count co-occurrence
-        for i, id1 in enumerate(ing_ids):
-            for id2 in ing_ids[i+1:]:
-                cooccurrence[id1][id2] += 1
-                cooccurrence[id2][id1] += 1
-    
-    # Save to files
-    output_path = Path("app/data/cooccurrence")
+
+    dish_path = Path(KB_PATH) / "dish_knowledge_base.json"
+    workers = workers or os.cpu_count() or 1
+    if min_count is None:
+        min_count = int(os.getenv("COOCCURRENCE_MIN_COUNT", MIN_PAIR_COUNT))
+
+    # Đọc món theo luồng; các lô được đếm song song, kết quả gộp dần
+    vocab = {}
+    dish_keys = []
+    dish_parts = []
+    frequency = np.zeros(0, dtype=np.int64)
+    accumulated = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    pending = []
+
+    def collect(result):
+        nonlocal accumulated
+        pending.append(result)
+        if len(pending) >= 16:
+            accumulated = _merge_counts([accumulated, *pending])
+            pending.clear()
+
+    pool = ProcessPoolExecutor(workers) if workers > 1 else None
+    try:
+        in_flight = deque()
+        for flat, lengths in _iter_chunks(dish_path, vocab, dish_keys, chunk_size):
+            dish_parts.append((flat, lengths))
+            frequency = _add_frequency(frequency, flat, len(vocab))
+            if pool is None:
+                collect(_count_pairs(flat, lengths))
+                continue
+            in_flight.append(pool.submit(_count_pairs, flat, lengths))
+            if len(in_flight) >= 2 * workers:
+                collect(in_flight.popleft().result())
+        while in_flight:
+            collect(in_flight.popleft().result())
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    keys, counts = _merge_counts([accumulated, *pending])
+
+    output_path = Path(OUTPUT_PATH)
     output_path.mkdir(parents=True, exist_ok=True)
-    
-    with open(output_path / "matrix.json", 'w', encoding='utf-8') as f:
-        json.dump(cooccurrence, f, ensure_ascii=False, indent=2)
-    
-    with open(output_path / "frequency.json", 'w', encoding='utf-8') as f:
-        json.dump(frequency, f, ensure_ascii=False, indent=2)
-    
-    with open(output_path / "metadata.json", 'w', encoding='utf-8') as f:
-        json.dump({
-            'total_dishes': len(dishes),
-            'total_ingredients': len(frequency),
-            'build_date': datetime.now().isoformat()
-        }, f, ensure_ascii=False, indent=2)
-    
-    print(f"✅ Matrix built successfully!")
-    print(f"   - {len(dishes)} dishes")
-    print(f"   - {len(frequency)} ingredients")
+    dish_flat = np.concatenate([p[0] for p in dish_parts]) if dish_parts else np.zeros(0, dtype=np.int64)
+    dish_lengths = np.concatenate([p[1] for p in dish_parts]) if dish_parts else np.zeros(0, dtype=np.int64)
+    write_build_state(output_path, list(vocab), frequency, keys, counts, dish_keys, dish_flat, dish_lengths)
+    n_pairs, version = save_outputs(
+        output_path, list(vocab), frequency, keys, counts, len(dish_keys), min_count, top_k,
+        embedding_dim=embedding_dim,
+    )
+
+    print(f"✅ Matrix built successfully! (version {version})")
+    print(f"   - {len(dish_keys)} dishes")
+    print(f"   - {len(vocab)} ingredients")
+    print(f"   - {n_pairs} pairs (count >= {min_count})")
     print(f"   - Saved to: {output_path}")
 
 if __name__ == "__main__":
-    build_cooccurrence_matrix()
\ No newline at end of file
+    build_cooccurrence_matrix()
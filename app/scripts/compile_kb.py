@@ -0,0 +1,29 @@
+import os
+import time
+
+
+def compile_kb():
+    """Biên dịch knowledge base JSON thành snapshot nhị phân cho OntologyService"""
+
+    print("🔨 Compiling knowledge base snapshot...")
+
+    snapshot_dir = os.getenv("KB_SNAPSHOT_PATH") or "app/data/snapshot"
+    # Luôn dựng lại từ JSON, không đọc snapshot cũ
+    os.environ["KB_SNAPSHOT_PATH"] = ""
+    from app.services.ontology_service import OntologyService
+
+    start = time.perf_counter()
+    ontology = OntologyService()
+    build_s = time.perf_counter() - start
+
+    out = ontology.write_snapshot(snapshot_dir)
+    size = sum(f.stat().st_size for f in out.iterdir())
+
+    print(f"✅ Snapshot saved to {out}")
+    print(f"   - {len(ontology.ingredients)} ingredients, {len(ontology.dishes)} dishes")
+    print(f"   - Build from JSON: {build_s:.2f}s")
+    print(f"   - Size: {size / 1024 / 1024:.1f} MB")
+
+
+if __name__ == "__main__":
+    compile_kb()
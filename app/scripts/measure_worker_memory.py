@@ -0,0 +1,100 @@
+import gc
+import multiprocessing as mp
+import random
+import sys
+
+from app.services.ontology_service import OntologyService
+from app.services.preload import preload_services
+
+# Instance đã preload ở process cha; worker fork dùng lại (không dựng mới)
+_preloaded_ontology = None
+
+
+def read_smaps_rollup():
+    """Rss / Pss / Private (kB) của process hiện tại (Linux /proc/self/smaps_rollup)."""
+    fields = {}
+    with open("/proc/self/smaps_rollup", "r") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                fields[parts[0].rstrip(":")] = int(parts[1])
+    return {
+        "rss": fields.get("Rss", 0),
+        "pss": fields.get("Pss", 0),
+        "private": fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0),
+    }
+
+
+def _workload(ontology, seed):
+    # Mô phỏng request: resolve tên, tìm món tương tự, rồi một lần GC đầy đủ
+    rnd = random.Random(seed)
+    names = [ing.get('name_vi', '') for ing in rnd.sample(list(ontology.ingredients.values()), 50)]
+    ontology.resolve_many(names)
+    dishes = rnd.sample(list(ontology.dishes.values()), 20)
+    for dish in dishes:
+        ontology.search_similar_dishes([i['ingredient_id'] for i in dish.get('ingredients', [])], 3, top_k=3)
+    gc.collect()
+
+
+def _forked_worker(conn, seed):
+    # Dùng lại đúng object của process cha: trang bộ nhớ chia sẻ copy-on-write
+    _workload(_preloaded_ontology, seed)
+    conn.send(read_smaps_rollup())
+    conn.close()
+
+
+def _spawned_worker(conn, seed):
+    # Worker độc lập (kiểu spawn): tự preload bản riêng trong process của nó
+    preload_services(freeze=False)
+    _workload(OntologyService(), seed)
+    conn.send(read_smaps_rollup())
+    conn.close()
+
+
+def _run_workers(ctx, target, n_workers):
+    results = []
+    for seed in range(n_workers):
+        parent_conn, child_conn = ctx.Pipe()
+        proc = ctx.Process(target=target, args=(child_conn, seed))
+        proc.start()
+        results.append((proc, parent_conn))
+    stats = [conn.recv() for _, conn in results]
+    for proc, _ in results:
+        proc.join()
+    return stats
+
+
+def _report(label, stats):
+    n = len(stats)
+    avg = {key: sum(s[key] for s in stats) / n / 1024 for key in ("rss", "pss", "private")}
+    print(
+        f"   - {label:<26} RSS {avg['rss']:7.1f} MB  PSS {avg['pss']:7.1f} MB  "
+        f"private {avg['private']:7.1f} MB  (x{n} ≈ {avg['pss'] * n:.0f} MB PSS)"
+    )
+
+
+def measure_worker_memory(n_workers=4):
+    """So sánh bộ nhớ mỗi worker: spawn độc lập / fork / fork + gc.freeze()"""
+    global _preloaded_ontology
+
+    if not sys.platform.startswith("linux"):
+        print("❌ Cần Linux (/proc/self/smaps_rollup)")
+        return
+
+    print(f"📏 Measuring per-worker memory ({n_workers} workers)...")
+
+    _report("spawn (mỗi worker 1 bản)", _run_workers(mp.get_context("spawn"), _spawned_worker, n_workers))
+
+    # Như master chạy server với preload trước fork: dựng hết bản ghi lười để worker dùng chung
+    preload_services(freeze=False, materialize=True)
+    _preloaded_ontology = OntologyService()
+    fork_ctx = mp.get_context("fork")
+    _report("fork sau preload", _run_workers(fork_ctx, _forked_worker, n_workers))
+
+    gc.freeze()
+    _report("fork + gc.freeze()", _run_workers(fork_ctx, _forked_worker, n_workers))
+    gc.unfreeze()
+
+
+if __name__ == "__main__":
+    measure_worker_memory()
@@ -0,0 +1,207 @@
+import json
+import sys
+from collections import defaultdict, deque
+from pathlib import Path
+
+import numpy as np
+
+from app.scripts.build_cooccurrence import (
+    CHUNK_DISHES,
+    KB_PATH,
+    MIN_PAIR_COUNT,
+    OUTPUT_PATH,
+    _add_frequency,
+    _count_pairs,
+    _iter_chunks,
+    _merge_counts,
+    build_cooccurrence_matrix,
+    read_build_state,
+    save_outputs,
+    write_build_state,
+)
+from app.services.cooccurrence import EMBEDDING_DIM, NEIGHBOR_TOP_K, CooccurrenceMatrix, read_metadata
+
+
+def _concat(parts):
+    if not parts:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(parts), np.asarray([len(p) for p in parts], dtype=np.int64)
+
+
+def _diff_kb(state, vocab):
+    """
+    So dish_knowledge_base.json hiện tại với trạng thái build (theo id món).
+    Trả về (dish_keys, dish_flat, dish_lengths, added, removed, (n_added, n_removed, n_changed)).
+    """
+    old_indptr = state['dish_indptr']
+    old_ingredients = state['dish_ingredients']
+    previous = defaultdict(deque)
+    for i, key in enumerate(state['dish_keys'].tolist()):
+        previous[key].append(old_ingredients[old_indptr[i]:old_indptr[i + 1]])
+
+    # Đọc KB hiện tại (chỉ map id, không đếm cặp) và so với từng món cũ
+    dish_keys = []
+    chunks = list(_iter_chunks(Path(KB_PATH) / "dish_knowledge_base.json", vocab, dish_keys, CHUNK_DISHES))
+    dish_flat = np.concatenate([c[0] for c in chunks]) if chunks else np.zeros(0, dtype=np.int64)
+    dish_lengths = np.concatenate([c[1] for c in chunks]) if chunks else np.zeros(0, dtype=np.int64)
+    starts = np.concatenate(([0], np.cumsum(dish_lengths)))
+
+    added, removed = [], []
+    n_added = n_changed = 0
+    for i, key in enumerate(dish_keys):
+        current = dish_flat[starts[i]:starts[i + 1]]
+        if not previous.get(key):
+            added.append(current)
+            n_added += 1
+            continue
+        before = previous[key].popleft()
+        if not np.array_equal(np.sort(before), np.sort(current)):
+            removed.append(before)
+            added.append(current)
+            n_changed += 1
+    n_removed = 0
+    for spans in previous.values():
+        removed.extend(spans)
+        n_removed += len(spans)
+    return dish_keys, dish_flat, dish_lengths, added, removed, (n_added, n_removed, n_changed)
+
+
+def _apply_changes(state, vocab, changes_path):
+    """
+    Áp file thay đổi {"upsert": [món...], "delete": [id món...]} lên trạng thái build
+    mà không đọc lại KB; cùng kết quả trả về như _diff_kb. Món trong "upsert" phải có
+    "id" (thay mọi bản ghi cùng id); id vừa upsert vừa delete được coi là xoá.
+    """
+    with open(changes_path, 'r', encoding='utf-8') as f:
+        changes = json.load(f)
+    deleted = {str(key) for key in changes.get('delete', [])}
+    upserts = {}
+    for dish in changes.get('upsert', []):
+        if 'id' not in dish:
+            raise ValueError(f"Dish without 'id' in {changes_path}")
+        key = str(dish['id'])
+        if key not in deleted:
+            upserts[key] = np.asarray(
+                [vocab.setdefault(ing['ingredient_id'], len(vocab)) for ing in dish.get('ingredients', [])],
+                dtype=np.int64,
+            )
+
+    old_keys = state['dish_keys'].tolist()
+    old_indptr = state['dish_indptr']
+    old_ingredients = state['dish_ingredients']
+    spans = defaultdict(list)
+    for i, key in enumerate(old_keys):
+        if key in deleted or key in upserts:
+            spans[key].append(i)
+
+    drop = np.zeros(len(old_keys), dtype=bool)
+    added, removed = [], []
+    new_keys, new_parts = [], []
+    n_added = n_removed = n_changed = 0
+    for key in deleted:
+        for i in spans.get(key, ()):
+            drop[i] = True
+            removed.append(old_ingredients[old_indptr[i]:old_indptr[i + 1]])
+            n_removed += 1
+    for key, current in upserts.items():
+        rows = spans.get(key, [])
+        if len(rows) == 1:
+            before = old_ingredients[old_indptr[rows[0]]:old_indptr[rows[0] + 1]]
+            if np.array_equal(np.sort(before), np.sort(current)):
+                continue
+        for i in rows:
+            drop[i] = True
+            removed.append(old_ingredients[old_indptr[i]:old_indptr[i + 1]])
+        added.append(current)
+        new_keys.append(key)
+        new_parts.append(current)
+        if rows:
+            n_changed += 1
+        else:
+            n_added += 1
+
+    keep = ~drop
+    lengths = np.diff(old_indptr)
+    dish_keys = [key for key, kept in zip(old_keys, keep.tolist()) if kept] + new_keys
+    dish_flat = np.concatenate([old_ingredients[np.repeat(keep, lengths)], *new_parts])
+    dish_lengths = np.concatenate([lengths[keep], np.asarray([len(p) for p in new_parts], dtype=np.int64)])
+    return dish_keys, dish_flat, dish_lengths, added, removed, (n_added, n_removed, n_changed)
+
+
+def _load_previous(output_path, ids):
+    """Ma trận phiên bản hiện tại nếu khớp vocab của trạng thái build, ngược lại None."""
+    try:
+        previous = CooccurrenceMatrix.load(output_path)
+    except Exception:
+        return None
+    return previous if previous.ids == ids else None
+
+
+def update_cooccurrence_matrix(embedding_dim=EMBEDDING_DIM, changes_path=None):
+    """
+    Cập nhật ma trận co-occurrence theo delta thay vì build lại toàn bộ:
+    so dish_knowledge_base.json hiện tại với trạng thái build trước (theo id món) —
+    hoặc, nếu có changes_path, đọc thẳng danh sách món thêm/sửa/xoá từ file đó —
+    trừ cặp/tần suất của món bị xoá hoặc sửa, cộng của món mới hoặc đã sửa,
+    rồi ghi một phiên bản mới (ValidationService tự nạp ở nền). Láng giềng chỉ được
+    tính lại cho dòng bị ảnh hưởng; SVD chạy lại theo SVD_REFRESH_RATIO.
+    """
+
+    print("🔄 Updating co-occurrence matrix (incremental)...")
+
+    output_path = Path(OUTPUT_PATH)
+    state = read_build_state(output_path)
+    if state is None:
+        print("⚠️  No build state found, running a full build")
+        return build_cooccurrence_matrix(embedding_dim=embedding_dim)
+
+    metadata = read_metadata(output_path)
+    min_count = metadata.get('min_count', MIN_PAIR_COUNT)
+    top_k = metadata.get('neighbor_top_k', NEIGHBOR_TOP_K)
+
+    ids = state['ids'].tolist()
+    vocab = {ing_id: i for i, ing_id in enumerate(ids)}
+    if changes_path:
+        result = _apply_changes(state, vocab, changes_path)
+    else:
+        result = _diff_kb(state, vocab)
+    dish_keys, dish_flat, dish_lengths, added, removed, (n_added, n_removed, n_changed) = result
+
+    if not added and not removed:
+        print("✅ No dish changes, matrix is up to date")
+        return
+
+    # Áp delta lên cặp (chưa lọc) và tần suất đã lưu
+    added_flat, added_lengths = _concat(added)
+    removed_flat, removed_lengths = _concat(removed)
+    plus = _count_pairs(added_flat, added_lengths)
+    minus_keys, minus_counts = _count_pairs(removed_flat, removed_lengths)
+    keys, counts = _merge_counts([(state['pair_keys'], state['pair_counts']), plus, (minus_keys, -minus_counts)])
+    if (counts < 0).any():
+        raise ValueError("Build state is out of sync with the matrix, run build_cooccurrence instead")
+    nonzero = counts > 0
+    keys, counts = keys[nonzero], counts[nonzero]
+
+    frequency = _add_frequency(state['frequency'], added_flat, len(vocab))
+    frequency = _add_frequency(frequency, removed_flat, len(vocab), sign=-1)
+
+    previous = _load_previous(output_path, ids)
+    ids = list(vocab)
+    write_build_state(output_path, ids, frequency, keys, counts, dish_keys, dish_flat, dish_lengths)
+    n_pairs, version = save_outputs(
+        output_path, ids, frequency, keys, counts, len(dish_keys), min_count, top_k,
+        embedding_dim=embedding_dim,
+        previous=previous,
+        touched=np.concatenate((added_flat, removed_flat)),
+        changed_dishes=n_added + n_removed + n_changed,
+        incremental={'added': n_added, 'removed': n_removed, 'changed': n_changed},
+    )
+
+    print(f"✅ Matrix updated! (version {version})")
+    print(f"   - {n_added} added, {n_removed} removed, {n_changed} changed dishes")
+    print(f"   - {len(dish_keys)} dishes")
+    print(f"   - {n_pairs} pairs (count >= {min_count})")
+    print(f"   - Saved to: {output_path}")
+
+if __name__ == "__main__":
+    update_cooccurrence_matrix(changes_path=sys.argv[1] if len(sys.argv) > 1 else None)
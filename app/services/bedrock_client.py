@@ -2,13 +2,30 @@ import io
 import json
 import logging
 import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from datetime import datetime
-from typing import Any, Dict, Optional, List
+from threading import Lock
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, List, Tuple
 
 import boto3
 
-from app.guardrails import GuardrailPolicyEvaluator
-from app.utils.json_utils import extract_prompt_from_body, extract_textual_content
+from app.guardrails import GuardrailPolicyEvaluator, GuardrailViolation, StreamingGuardrailEvaluator, merge_violations
+from app.guardrails.streaming import DEFAULT_HOLDBACK, DEFAULT_LOOKBEHIND
+from app.utils.cache import TTLCache
+from app.utils.json_utils import extract_prompt_from_body, extract_textual_content, map_prompt_in_body
+
+SafeCompletionKey = Tuple[str, str, Tuple[str, ...]]
+
+#: Text Bedrock trả về thay cho output khi AWS Guardrails chặn
+AWS_BLOCKED_MESSAGE = "Sorry, the model cannot answer this question"
+#: Câu hỏi đại diện cho một rule khi prewarm (rule có thể ghi đè bằng `prewarm_prompt` trong YAML)
+PREWARM_PROMPT_TEMPLATE = "Câu hỏi thường gặp bị chặn bởi quy tắc \"{policy_name}\": {message}"
+#: Bản tĩnh khi câu hỏi bị AWS chặn mà không có safe completion từ LLM: model lỗi, quá
+#: SAFE_COMPLETION_TIMEOUT_MS hoặc hàng đợi đầy (SAFE_COMPLETION_MAX_PENDING)
+AWS_BLOCKED_FALLBACK = "Câu hỏi của bạn vi phạm chính sách an toàn. Vui lòng đặt câu hỏi khác hoặc tham khảo hướng dẫn từ các cơ quan y tế."
+#: Bản tĩnh khi model trả về response rỗng
+AWS_BLOCKED_EMPTY_FALLBACK = "Câu hỏi của bạn vi phạm chính sách an toàn thực phẩm. Vui lòng tham khảo hướng dẫn an toàn từ Bộ Y tế Việt Nam hoặc WHO."
 
 
 class GuardrailedBedrockClient:
@@ -30,6 +47,24 @@ class GuardrailedBedrockClient:
         self.guardrail_config = self._load_guardrail_config()
         self.behavior_override = (os.getenv('BEDROCK_GUARDRAIL_BEHAVIOR') or '').lower()
 
+        # Cache safe completion sinh bởi LLM: key = (loại, prompt chuẩn hoá, violation codes đã sắp xếp)
+        self._safe_completion_cache = TTLCache(
+            max_size=int(os.getenv('SAFE_COMPLETION_CACHE_SIZE', '512')),
+            ttl=float(os.getenv('SAFE_COMPLETION_CACHE_TTL', '3600')),
+        )
+        self.safe_completion_timeout = float(os.getenv('SAFE_COMPLETION_TIMEOUT_MS', '2500')) / 1000
+        self._safe_completion_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='safe-completion')
+        # Giới hạn số lời gọi đang chờ + đang chạy; đầy thì dùng bản tĩnh thay vì xếp hàng thêm
+        self.safe_completion_max_pending = int(os.getenv('SAFE_COMPLETION_MAX_PENDING', '8'))
+        self.prefer_prewarmed_completion = os.getenv('SAFE_COMPLETION_PREFER_PREWARMED', '').lower() in {'1', 'true', 'yes'}
+        self._safe_completion_inflight: Dict[SafeCompletionKey, Future] = {}
+        self._safe_completion_lock = Lock()
+
+        prewarm = (os.getenv('SAFE_COMPLETION_PREWARM') or '').strip()
+        if prewarm and prewarm.lower() not in {'0', 'false', 'no'}:
+            rule_ids = None if prewarm.lower() in {'1', 'true', 'yes', 'all'} else prewarm.split(',')
+            self.prewarm_safe_completions(rule_ids)
+
     def _load_guardrail_config(self) -> Dict[str, str]:
         """Load guardrail configuration from environment variables."""
         config = {}
@@ -53,6 +88,12 @@ class GuardrailedBedrockClient:
         **kwargs: Any,
     ) -> Dict[str, Any]:
 
+        # Pre-flight: kiểm tra prompt bằng policy local trước khi gọi Bedrock
+        body, prompt_text, preflight_violations = self._preflight(body)
+        preflight_action = self._resolve_action(preflight_violations)
+        if preflight_action in {'block', 'safe-completion'}:
+            return self._preflight_response(prompt_text, preflight_violations, preflight_action)
+
         # Build guardrail configuration
         guardrail_params = self._build_guardrail_params(guardrail_id, guardrail_version)
         
@@ -67,11 +108,176 @@ class GuardrailedBedrockClient:
         )
         
         # Apply custom policy checks and process response
-        prompt_text = extract_prompt_from_body(body)
-        processed = self._apply_custom_policies(prompt_text, response)
+        processed = self._apply_custom_policies(prompt_text, response, preflight_violations)
 
         return processed
 
+    def invoke_model_with_response_stream(
+        self,
+        *,
+        model_id: str,
+        body: str,
+        guardrail_id: Optional[str] = None,
+        guardrail_version: Optional[str] = None,
+        **kwargs: Any,
+    ) -> Dict[str, Any]:
+        """
+        Như invoke_model nhưng trả về stream: response['body'] là iterator event Bedrock,
+        text được StreamingGuardrailEvaluator kiểm tra theo chunk trước khi phát.
+        response['guardrail'] / ['guardrail_messages'] hoàn tất khi stream kết thúc.
+        """
+        body, prompt_text, preflight_violations = self._preflight(body)
+        preflight_action = self._resolve_action(preflight_violations)
+        if preflight_action in {'block', 'safe-completion'}:
+            response = self._preflight_response(prompt_text, preflight_violations, preflight_action)
+            safe_text = self._content_text(response['body'].read().decode('utf-8'))
+            response['body'] = iter([
+                self._stream_event({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': safe_text}}),
+                self._stream_event({'type': 'content_block_stop', 'index': 0}),
+                self._stream_event({'type': 'message_stop'}),
+            ])
+            return response
+
+        guardrail_params = self._build_guardrail_params(guardrail_id, guardrail_version)
+        invoke_kwargs = {**kwargs, **guardrail_params}
+        response = self.runtime.invoke_model_with_response_stream(
+            modelId=model_id,
+            body=body,
+            **invoke_kwargs
+        )
+
+        streaming = StreamingGuardrailEvaluator(
+            self.policy_evaluator,
+            prompt_text,
+            holdback=int(os.getenv('STREAM_GUARDRAIL_HOLDBACK', str(DEFAULT_HOLDBACK))),
+            lookbehind=int(os.getenv('STREAM_GUARDRAIL_LOOKBEHIND', str(DEFAULT_LOOKBEHIND))),
+            resolve_action=self._resolve_action,
+        )
+        response['guardrail'] = self._build_guardrail_metadata(preflight_violations, preflight_action, response)
+        response['body'] = self._guarded_stream(response, response.get('body'), streaming, preflight_violations)
+        return response
+
+    def _guarded_stream(
+        self,
+        response: Dict[str, Any],
+        stream: Any,
+        streaming: StreamingGuardrailEvaluator,
+        preflight_violations: List[Any],
+    ) -> Iterator[Dict[str, Any]]:
+        index = 0
+        # Đuôi text thô đủ dài để nhận ra thông báo chặn của AWS dù bị cắt qua nhiều chunk
+        raw_tail = ''
+        aws_blocked = False
+        try:
+            for event in stream or ():
+                payload = self._event_payload(event)
+                kind = payload.get('type') if payload else None
+                if kind == 'content_block_delta' and (payload.get('delta') or {}).get('type') == 'text_delta':
+                    index = payload.get('index', index)
+                    text = payload['delta'].get('text') or ''
+                    raw_tail = (raw_tail + text)[-(len(AWS_BLOCKED_MESSAGE) + len(text)):]
+                    if AWS_BLOCKED_MESSAGE in raw_tail:
+                        aws_blocked = True
+                        break
+                    released = streaming.feed(text)
+                    if streaming.halted:
+                        break
+                    if released:
+                        yield self._text_event(released, index)
+                    continue
+                if kind in {'content_block_stop', 'message_delta', 'message_stop'}:
+                    # Hết block / message: phát nốt phần đang giữ lại
+                    released = streaming.flush()
+                    if streaming.halted:
+                        break
+                    if released:
+                        yield self._text_event(released, index)
+                yield event
+            else:
+                released = streaming.flush()
+                if released:
+                    yield self._text_event(released, index)
+
+            if streaming.halted or aws_blocked:
+                # Dừng sinh tiếp; phần còn lại thay bằng safe completion (như _sanitize_content khi không stream)
+                if hasattr(stream, 'close'):
+                    stream.close()
+                sanitized = self._sanitize_content(
+                    AWS_BLOCKED_MESSAGE if aws_blocked else '',
+                    streaming.violations,
+                    streaming.action,
+                    user_query=streaming.prompt_text,
+                )
+                yield self._text_event(self._content_text(sanitized), index)
+                yield self._stream_event({'type': 'content_block_stop', 'index': index})
+                yield self._stream_event({'type': 'message_stop'})
+        finally:
+            violations = merge_violations(preflight_violations, streaming.violations)
+            action = self._resolve_action(violations)
+            guardrail_info = response['guardrail']
+            guardrail_info.update(self._build_guardrail_metadata(violations, action, response))
+            guardrail_info['stage'] = 'stream'
+            if violations:
+                self._log_violations(guardrail_info)
+                response['guardrail_messages'] = self._format_violation_messages(violations)
+
+    @staticmethod
+    def _event_payload(event: Any) -> Optional[Dict[str, Any]]:
+        chunk = event.get('chunk') if isinstance(event, dict) else None
+        raw = chunk.get('bytes') if isinstance(chunk, dict) else None
+        if raw is None:
+            return None
+        try:
+            payload = json.loads(raw)
+        except (TypeError, ValueError):
+            return None
+        return payload if isinstance(payload, dict) else None
+
+    @staticmethod
+    def _stream_event(payload: Dict[str, Any]) -> Dict[str, Any]:
+        return {'chunk': {'bytes': json.dumps(payload, ensure_ascii=False).encode('utf-8')}}
+
+    def _text_event(self, text: str, index: int) -> Dict[str, Any]:
+        return self._stream_event(
+            {'type': 'content_block_delta', 'index': index, 'delta': {'type': 'text_delta', 'text': text}}
+        )
+
+    @staticmethod
+    def _content_text(content: str) -> str:
+        """Text trong body dạng {"content": [{"type": "text", "text": ...}]} do _sanitize_content tạo."""
+        try:
+            blocks = json.loads(content).get('content') or []
+            return ''.join(block.get('text', '') for block in blocks if isinstance(block, dict))
+        except (TypeError, ValueError, AttributeError):
+            return content
+
+    def _preflight(self, body: str) -> Tuple[str, str, List[Any]]:
+        """
+        Đánh giá prompt trước khi gửi: trả về (body, prompt_text, violations). Nếu có rule
+        redaction (PII) khớp, text trong body được ẩn luôn nên Bedrock không nhận bản gốc.
+        """
+        prompt_text = extract_prompt_from_body(body)
+        violations = self.policy_evaluator.evaluate(prompt_text, '')
+        if any(violation.metadata.get('redaction') for violation in violations):
+            body = map_prompt_in_body(
+                body, lambda text: self.policy_evaluator.apply_redactions(text, violations)
+            )
+            prompt_text = extract_prompt_from_body(body)
+        return body, prompt_text, violations
+
+    def _preflight_response(self, prompt_text: str, violations: List[Any], action: str) -> Dict[str, Any]:
+        """Response dạng invoke_model cho prompt bị chặn ở pre-flight (không gọi model chính)."""
+        sanitized_content = self._sanitize_content('', violations, action, user_query=prompt_text)
+        guardrail_info = self._build_guardrail_metadata(violations, action, {})
+        guardrail_info['stage'] = 'preflight'
+        self._log_violations(guardrail_info)
+        return {
+            'body': io.BytesIO(sanitized_content.encode('utf-8')),
+            'contentType': 'application/json',
+            'guardrail': guardrail_info,
+            'guardrail_messages': self._format_violation_messages(violations),
+        }
+
     def _build_guardrail_params(
         self, 
         guardrail_id: Optional[str] = None, 
@@ -102,7 +308,12 @@ class GuardrailedBedrockClient:
         enabled_flag = os.getenv('ENABLE_GUARDRAILS', '').lower()
         return enabled_flag in {'1', 'true', 'yes'}
 
-    def _apply_custom_policies(self, prompt_text: str, response: Dict[str, Any]) -> Dict[str, Any]:
+    def _apply_custom_policies(
+        self,
+        prompt_text: str,
+        response: Dict[str, Any],
+        prior_violations: Optional[List[Any]] = None,
+    ) -> Dict[str, Any]:
 
         # Extract response body
         body_obj = response.get('body')
@@ -116,6 +327,7 @@ class GuardrailedBedrockClient:
         # Evaluate content against custom policies
         analysis_text = extract_textual_content(raw_text)
         violations = self.policy_evaluator.evaluate(prompt_text, analysis_text)
+        violations = merge_violations(prior_violations or [], violations)
         action = self._resolve_action(violations)
 
         # Apply content modifications based on violations
@@ -152,7 +364,7 @@ class GuardrailedBedrockClient:
     ) -> str:
 
         # Check if AWS Guardrails blocked this request
-        if "Sorry, the model cannot answer this question" in raw_text:
+        if AWS_BLOCKED_MESSAGE in raw_text:
             safe_text = self._generate_aws_blocked_completion(user_query)
             return json.dumps({
                 "content": [{"type": "text", "text": safe_text}]
@@ -190,12 +402,7 @@ class GuardrailedBedrockClient:
         response: Dict[str, Any]
     ) -> Dict[str, Any]:
         
-        violation_codes = []
-        for violation in violations or []:
-            policy_id = violation.policy_id or 'guardrail'
-            rule_id = violation.rule_id or ''
-            code = f"{policy_id}:{rule_id}".rstrip(':')
-            violation_codes.append(code)
+        violation_codes = self._violation_codes(violations)
         
         metadata = {
             'triggered': bool(violations),
@@ -211,6 +418,16 @@ class GuardrailedBedrockClient:
         
         return metadata
 
+    @staticmethod
+    def _violation_codes(violations: Optional[Iterable[Any]]) -> List[str]:
+        violation_codes = []
+        for violation in violations or []:
+            policy_id = violation.policy_id or 'guardrail'
+            rule_id = violation.rule_id or ''
+            code = f"{policy_id}:{rule_id}".rstrip(':')
+            violation_codes.append(code)
+        return violation_codes
+
     def _format_violation_messages(self, violations: List[Any]) -> List[Dict[str, Any]]:
         messages = []
         for violation in violations:
@@ -227,6 +444,7 @@ class GuardrailedBedrockClient:
             'request_id': guardrail_info.get('request_id'),
             'violation_types': guardrail_info.get('violation_codes', []),
             'action': guardrail_info.get('action'),
+            'stage': guardrail_info.get('stage', 'response'),
             'environment': self.environment,
             'timestamp': guardrail_info.get('timestamp'),
         }
@@ -280,7 +498,21 @@ class GuardrailedBedrockClient:
 
         if not self._is_llm_safe_completion_enabled():
             return None
-        
+
+        codes = tuple(sorted(set(self._violation_codes(violations))))
+        # Bản prewarm theo rule: dự phòng khi bản riêng cho prompt quá hạn / không sinh được,
+        # hoặc dùng luôn thay cho bản riêng nếu bật SAFE_COMPLETION_PREFER_PREWARMED
+        prewarmed = self._safe_completion_cache.get(('policy', '', codes))
+        key = ('policy', self._normalize_prompt(user_query), codes)
+        if prewarmed and key[1] and self.prefer_prewarmed_completion:
+            return self._safe_completion_cache.get(key) or prewarmed
+        safe_text = self._cached_safe_completion(
+            key, lambda: self._request_safe_completion_llm(user_query, violations)
+        )
+        return safe_text or prewarmed
+
+    def _request_safe_completion_llm(self, user_query: str, violations: List[Any]) -> Optional[str]:
+        """Gọi model safe completion (đồng bộ); None nếu lỗi hoặc response rỗng."""
         try:
             violation_context = self._build_violation_context(violations)
             model_id = os.getenv('SAFE_COMPLETION_MODEL', 'anthropic.claude-3-haiku-20240307-v1:0')
@@ -361,7 +593,21 @@ class GuardrailedBedrockClient:
 
         if not self._is_llm_safe_completion_enabled():
             return "Xin lỗi, câu hỏi của bạn vi phạm chính sách an toàn. Vui lòng đặt câu hỏi khác."
-        
+
+        safe_text = self._cached_safe_completion(
+            ('aws-blocked', self._normalize_prompt(user_query), ()),
+            lambda: self._request_aws_blocked_completion(user_query),
+        )
+        if safe_text:
+            return safe_text
+        # Bản tĩnh theo nguyên nhân: '' = model trả rỗng; None = lỗi, quá hạn hoặc hàng đợi đầy
+        return AWS_BLOCKED_EMPTY_FALLBACK if safe_text == '' else AWS_BLOCKED_FALLBACK
+
+    def _request_aws_blocked_completion(self, user_query: str) -> Optional[str]:
+        """
+        Gọi model giải thích câu hỏi bị AWS Guardrails chặn; '' nếu response rỗng, None
+        nếu lỗi (cả hai không được cache, caller chọn bản tĩnh tương ứng).
+        """
         try:
             model_id = os.getenv('SAFE_COMPLETION_MODEL', 'anthropic.claude-3-haiku-20240307-v1:0')
 
@@ -417,11 +663,111 @@ class GuardrailedBedrockClient:
                     self.logger.info(f"AWS blocked - LLM safe completion generated ({len(safe_text)} chars)")
                     return safe_text
             
-            return "Câu hỏi của bạn vi phạm chính sách an toàn thực phẩm. Vui lòng tham khảo hướng dẫn an toàn từ Bộ Y tế Việt Nam hoặc WHO."
+            return ''
             
         except Exception as e:
             self.logger.warning(f"AWS blocked completion generation failed: {str(e)}")
-            return "Câu hỏi của bạn vi phạm chính sách an toàn. Vui lòng đặt câu hỏi khác hoặc tham khảo hướng dẫn từ các cơ quan y tế."
+            return None
+
+    def prewarm_safe_completions(self, rule_ids: Optional[Iterable[str]] = None) -> int:
+        """
+        Sinh trước (chạy nền) safe completion cho từng rule block/safe-completion đã biết từ
+        câu hỏi đại diện của rule (`prewarm_prompt` hoặc PREWARM_PROMPT_TEMPLATE), lưu dưới
+        key prompt rỗng; rule_ids giới hạn danh sách (mặc định: tất cả). Trả về số rule đã gửi.
+        """
+        if not self._is_llm_safe_completion_enabled():
+            return 0
+        wanted = {rule_id.strip() for rule_id in rule_ids if rule_id.strip()} if rule_ids is not None else None
+        count = 0
+        for rule in self.policy_evaluator._rules:
+            if rule['action'] not in {'block', 'safe-completion'}:
+                continue
+            if wanted is not None and rule['rule_id'] not in wanted:
+                continue
+            violation = GuardrailViolation(
+                policy_id=rule['policy_id'],
+                policy_name=rule.get('policy_name'),
+                rule_id=rule['rule_id'],
+                action=rule['action'],
+                severity=rule['severity'],
+                message=rule['message'],
+                remediation=rule.get('remediation', ''),
+            )
+            key = ('policy', '', tuple(self._violation_codes([violation])))
+            if key in self._safe_completion_cache:
+                continue
+            prompt = rule.get('prewarm_prompt') or PREWARM_PROMPT_TEMPLATE.format(
+                policy_name=rule.get('policy_name') or rule['policy_id'],
+                rule_id=rule['rule_id'],
+                message=rule['message'],
+            )
+            future = self._submit_safe_completion(
+                key, lambda p=prompt, v=violation: self._request_safe_completion_llm(p, [v])
+            )
+            if future is None:
+                break
+            count += 1
+        return count
+
+    def _cached_safe_completion(
+        self,
+        key: SafeCompletionKey,
+        generate: Callable[[], Optional[str]],
+    ) -> Optional[str]:
+        """
+        Lấy safe completion từ cache hoặc sinh mới. Request trùng key đang chạy dùng chung
+        một lời gọi; quá SAFE_COMPLETION_TIMEOUT_MS thì trả None (caller dùng bản tĩnh),
+        lời gọi vẫn chạy tiếp nền và lưu kết quả cho lần sau. Hàng đợi đã đầy
+        (SAFE_COMPLETION_MAX_PENDING) thì không gọi model mà trả None ngay.
+        """
+        cached = self._safe_completion_cache.get(key)
+        if cached is not None:
+            return cached
+        future = self._submit_safe_completion(key, generate)
+        if future is None:
+            self.logger.info("LLM safe completion queue is full, using static completion")
+            return None
+        try:
+            return future.result(timeout=self.safe_completion_timeout if self.safe_completion_timeout > 0 else None)
+        except FutureTimeoutError:
+            self.logger.info(
+                f"LLM safe completion exceeded {self.safe_completion_timeout:.1f}s deadline, using static completion"
+            )
+            return None
+
+    def _submit_safe_completion(
+        self,
+        key: SafeCompletionKey,
+        generate: Callable[[], Optional[str]],
+    ) -> Optional[Future]:
+        """Future của lời gọi cho key (dùng chung nếu đang chạy); None nếu hàng đợi đã đầy."""
+        with self._safe_completion_lock:
+            future = self._safe_completion_inflight.get(key)
+            if future is None:
+                if len(self._safe_completion_inflight) >= self.safe_completion_max_pending:
+                    return None
+                future = self._safe_completion_executor.submit(self._fill_safe_completion, key, generate)
+                self._safe_completion_inflight[key] = future
+            return future
+
+    def _fill_safe_completion(
+        self,
+        key: SafeCompletionKey,
+        generate: Callable[[], Optional[str]],
+    ) -> Optional[str]:
+        try:
+            safe_text = generate()
+            if safe_text:
+                self._safe_completion_cache.put(key, safe_text)
+            return safe_text
+        finally:
+            with self._safe_completion_lock:
+                self._safe_completion_inflight.pop(key, None)
+
+    @staticmethod
+    def _normalize_prompt(user_query: str) -> str:
+        """Lower-case + gộp khoảng trắng (giữ dấu: 'gà' và 'ga' khác nghĩa)."""
+        return ' '.join((user_query or '').lower().split())
     
     def apply_contextual_grounding(
         self, 
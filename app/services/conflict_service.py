@@ -1,55 +1,226 @@
 from __future__ import annotations
 
 import json
+import os
 import re
 from pathlib import Path
-from typing import Dict, Iterable, List, Optional
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Tuple
 
+from app.utils.aho_corasick import AhoCorasick
+from app.utils.cache import LRUCache
 from app.utils.string_utils import norm_text
 
+if TYPE_CHECKING:
+    from app.services.ontology_service import OntologyService
+
+_WHITESPACE_RE = re.compile(r"\s+")
+# Tách nguyên liệu chính của món dạng "A + B": "Cà (cà tím/cà pháo)" -> cà, cà tím, cà pháo
+_PRIMARY_SPLIT_RE = re.compile(r"[/()]")
+
+
+class _TermMatcher:
+    """
+    So khớp tên nguyên liệu (đã norm_text) với nhiều term, mỗi term thuộc một hoặc nhiều nhóm:
+    - term 1 token <= 2 ký tự: so khớp nguyên tên nguyên liệu (như ^token$);
+    - term còn lại: một automaton Aho-Corasick trên "token token ..." với ranh giới từ
+      ở hai đầu (như r"\b" + r"\s+".join(tokens) + r"\b" trên tên đã gộp khoảng trắng).
+    """
+
+    def __init__(self, terms: Iterable[Tuple[str, int]]) -> None:
+        self._exact_terms: Dict[str, List[int]] = {}
+        phrase_index: Dict[str, int] = {}
+        self._phrase_groups: List[List[int]] = []
+        for term, group in terms:
+            tokens = norm_text(term).split()
+            if not tokens:
+                continue
+            if len(tokens) == 1 and len(tokens[0]) <= 2:
+                self._exact_terms.setdefault(tokens[0], []).append(group)
+                continue
+            phrase = " ".join(tokens)
+            if phrase not in phrase_index:
+                phrase_index[phrase] = len(self._phrase_groups)
+                self._phrase_groups.append([])
+            self._phrase_groups[phrase_index[phrase]].append(group)
+        self._matcher = AhoCorasick(phrase_index)
+
+    def match(self, ing_norm: str) -> set:
+        matched = set(self._exact_terms.get(ing_norm, ()))
+        for _, _, phrase_idx in self._matcher.iter_word_matches(_WHITESPACE_RE.sub(" ", ing_norm)):
+            matched.update(self._phrase_groups[phrase_idx])
+        return matched
+
 
 class ConflictDetectionService:
     """Load curated ingredient conflicts and provide lookup utilities."""
 
-    def __init__(self, data_path: Optional[Path] = None) -> None:
-        self.data_path = data_path or Path("app/data/conflicts/ingredient_conflicts.json")
+    def __init__(
+        self,
+        data_path: Optional[Path] = None,
+        ontology: Optional["OntologyService"] = None,
+        pair_rules_any_dish: Optional[bool] = None,
+    ) -> None:
+        self.data_path = data_path or Path("app/data/conflict/ingredient_conflict.json")
+        self.ontology = ontology
+        # Luật "A + B" mặc định chỉ áp cho món khớp tên như luật khác; bật để cảnh báo
+        # mọi giỏ có cả id(A) và id term, bất kể tên món
+        if pair_rules_any_dish is None:
+            pair_rules_any_dish = os.getenv("CONFLICT_PAIR_ANY_DISH", "").lower() in {"1", "true", "yes"}
+        self.pair_rules_any_dish = pair_rules_any_dish
         self._conflicts: List[Dict[str, object]] = self._load_conflicts()
+        self._compile_rules()
+        self._compile_id_rules()
 
 
-    def check_conflicts(self, dish_name: str, ingredient_names: Iterable[str]) -> List[Dict[str, object]]:
-        dish_norm = norm_text(dish_name)
-        normalized_ingredients = {
-            norm_text(name): name for name in ingredient_names if name
-        }
-        results: List[Dict[str, object]] = []
+    def _compile_rules(self) -> None:
+        """Chuẩn hoá dữ liệu tương khắc một lần khi load: tên món và term của từng entry (norm_text)."""
+        self._dish_keys: List[List[str]] = [
+            [norm_text(d) for d in entry.get("dishes", []) if d] for entry in self._conflicts
+        ]
+        self._term_matcher = _TermMatcher(
+            (candidate, entry_idx)
+            for entry_idx, entry in enumerate(self._conflicts)
+            for candidate in entry.get("conflicts", [])
+        )
+        self._dish_entries = LRUCache(1024)
 
-        for entry in self._conflicts:
-            dishes = [norm_text(d) for d in entry.get("dishes", []) if d]
-            if dishes and not any(d in dish_norm or dish_norm in d for d in dishes):
-                continue
 
-            hits: List[str] = []
-            for candidate in entry.get("conflicts", []):
-                cand_norm = norm_text(candidate)
-                if not cand_norm:
-                    continue
-                tokens = [token for token in cand_norm.split() if token]
-                if not tokens:
+    def _compile_id_rules(self) -> None:
+        """
+        Resolve luật tương khắc sang id qua ontology một lần khi load:
+        - term -> id nguyên liệu: mọi nguyên liệu KB có name_vi khớp term theo đúng luật chuỗi
+          ở trên, cộng id resolve chính xác (tên/synonym) của term và từng phần "a/b" của term;
+        - món "A + B" (chỉ khi pair_rules_any_dish): A (tách theo "/" và ngoặc) -> id nguyên
+          liệu chính, tạo cạnh cặp id(A) -> entry -> id term; món còn lại khớp chính xác tên
+          món KB -> id món -> entry.
+        Không có ontology thì service chỉ so khớp chuỗi như trước.
+        """
+        self._entries_by_ingredient: Dict[str, Tuple[int, ...]] = {}
+        self._pair_entries: Dict[str, Tuple[int, ...]] = {}
+        self._entries_by_dish_id: Dict[str, Tuple[int, ...]] = {}
+        ontology = self.ontology
+        if ontology is None or not self._conflicts:
+            return
+
+        primary_terms: List[Tuple[str, int]] = []
+        entries_by_dish_id: Dict[str, List[int]] = {}
+        for entry_idx, entry in enumerate(self._conflicts):
+            for dish in entry.get("dishes", []):
+                if not dish:
                     continue
-                if len(tokens) == 1 and len(tokens[0]) <= 2:
-                    pattern = re.compile(rf"^{re.escape(tokens[0])}$")
-                else:
-                    pattern = re.compile(r"\b" + r"\s+".join(re.escape(token) for token in tokens) + r"\b")
-                for ing_norm, original in normalized_ingredients.items():
-                    if not ing_norm:
+                if "+" in dish:
+                    if not self.pair_rules_any_dish:
                         continue
-                    if pattern.search(ing_norm):
-                        hits.append(original)
+                    left = dish.split("+", 1)[0]
+                    primary_terms.extend(
+                        (part.strip(), entry_idx) for part in _PRIMARY_SPLIT_RE.split(left) if part.strip()
+                    )
+                    continue
+                dish_id = ontology.find_dish_id(dish, fuzzy=False)
+                if dish_id is not None:
+                    entries_by_dish_id.setdefault(dish_id, []).append(entry_idx)
+
+        # Đóng term / nguyên liệu chính trên toàn bộ tên nguyên liệu KB (một lượt)
+        term_ids: Dict[str, set] = {}
+        primary_ids: Dict[str, set] = {}
+        primary_matcher = _TermMatcher(primary_terms)
+        for ing_id, record in ontology.ingredients.items():
+            ing_norm = norm_text(record.get("name_vi") or "")
+            if not ing_norm:
+                continue
+            for entry_idx in self._term_matcher.match(ing_norm):
+                term_ids.setdefault(ing_id, set()).add(entry_idx)
+            for entry_idx in primary_matcher.match(ing_norm):
+                primary_ids.setdefault(ing_id, set()).add(entry_idx)
+
+        exact_terms: List[Tuple[str, int]] = []
+        for entry_idx, entry in enumerate(self._conflicts):
+            for candidate in entry.get("conflicts", []):
+                exact_terms.append((candidate, entry_idx))
+                if "/" in candidate:
+                    exact_terms.extend((part.strip(), entry_idx) for part in candidate.split("/") if part.strip())
+        for target, terms in ((term_ids, exact_terms), (primary_ids, primary_terms)):
+            matches = ontology.resolve_many(term for term, _ in terms)
+            for (_, entry_idx), match in zip(terms, matches):
+                if match.exact and match.ingredient_id:
+                    target.setdefault(match.ingredient_id, set()).add(entry_idx)
+
+        self._entries_by_ingredient = {k: tuple(sorted(v)) for k, v in term_ids.items()}
+        self._pair_entries = {k: tuple(sorted(v)) for k, v in primary_ids.items()}
+        self._entries_by_dish_id = {k: tuple(v) for k, v in entries_by_dish_id.items()}
+
+
+    def _entries_for_dish(self, dish_norm: str) -> Tuple[int, ...]:
+        entries = self._dish_entries.get(dish_norm)
+        if entries is None:
+            entries = tuple(
+                idx
+                for idx, dishes in enumerate(self._dish_keys)
+                if not dishes or any(d in dish_norm or dish_norm in d for d in dishes)
+            )
+            self._dish_entries.put(dish_norm, entries)
+        return entries
+
 
-            if not hits:
+    def check_conflicts(
+        self,
+        dish_name: str,
+        ingredient_names: Iterable[str],
+        ingredient_ids: Optional[Iterable[Optional[str]]] = None,
+    ) -> List[Dict[str, object]]:
+        """
+        ingredient_ids (tuỳ chọn) song song với ingredient_names. Nguyên liệu có id được kiểm tra
+        bằng phép giao tập id; nguyên liệu không có id (hoặc service không có ontology) so khớp
+        chuỗi với term như trước. Entry vẫn được chọn theo tên món; riêng cặp "A + B" chỉ
+        bỏ qua tên món khi bật pair_rules_any_dish.
+        """
+        names = list(ingredient_names)
+        ids = list(ingredient_ids) if ingredient_ids is not None and self.ontology is not None else []
+        entries = set(self._entries_for_dish(norm_text(dish_name)))
+        if self._entries_by_dish_id and dish_name:
+            dish_id = self.ontology.find_dish_id(dish_name, fuzzy=False)
+            entries.update(self._entries_by_dish_id.get(dish_id, ()))
+
+        hits: Dict[int, set] = {}
+        cart_ids: Dict[str, str] = {}
+        normalized_ingredients: Dict[str, str] = {}
+        for pos, name in enumerate(names):
+            ing_id = ids[pos] if pos < len(ids) else None
+            if ing_id:
+                if not name:
+                    record = self.ontology.get_ingredient(ing_id)
+                    name = record.get("name_vi") if record else ""
+                if name:
+                    cart_ids.setdefault(ing_id, name)
+            elif name:
+                normalized_ingredients[norm_text(name)] = name
+
+        # Nguyên liệu đã resolve: tra entry theo id; cặp "A + B" khi giỏ có cả id của A
+        pair_sources: Dict[int, set] = {}
+        for ing_id, original in cart_ids.items():
+            for entry_idx in self._entries_by_ingredient.get(ing_id, ()):
+                hits.setdefault(entry_idx, set()).add(original)
+            for entry_idx in self._pair_entries.get(ing_id, ()):
+                pair_sources.setdefault(entry_idx, set()).add(original)
+
+        # Fallback: một lượt qua tên nguyên liệu chưa resolve, entry -> các tên bị trùng term
+        for ing_norm, original in normalized_ingredients.items():
+            if not ing_norm:
                 continue
+            for entry_idx in self._term_matcher.match(ing_norm):
+                hits.setdefault(entry_idx, set()).add(original)
+
+        # Cặp chỉ tính khi nguyên liệu bị trùng term khác chính nguyên liệu A
+        for entry_idx, sources in pair_sources.items():
+            if entry_idx in hits and hits[entry_idx] - sources:
+                entries.add(entry_idx)
 
-            unique_hits = sorted(set(hits), key=lambda x: x.lower())
+        results: List[Dict[str, object]] = []
+        for entry_idx in sorted(entries):
+            if entry_idx not in hits:
+                continue
+            entry = self._conflicts[entry_idx]
+            unique_hits = sorted(hits[entry_idx], key=lambda x: x.lower())
             results.append(
                 {
                     "id": entry.get("id"),
@@ -91,7 +262,7 @@ class ConflictDetectionService:
             return []
         if isinstance(payload, list):
             return [entry for entry in payload if isinstance(entry, dict)]
-            return []
+        return []
 
 
 __all__ = ["ConflictDetectionService"]
\ No newline at end of file
@@ -0,0 +1,476 @@
+from __future__ import annotations
+
+import json
+import math
+import os
+from pathlib import Path
+from typing import Dict, Iterable, List, Mapping, Optional, Sequence, Tuple
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import svds
+
+#: Số láng giềng PMI cao nhất giữ cho mỗi nguyên liệu
+NEIGHBOR_TOP_K = 100
+#: Số chiều vector nguyên liệu (truncated SVD của ma trận PPMI)
+EMBEDDING_DIM = 64
+
+#: Phiên bản định dạng thư mục cooccurrence (1: matrix.json/frequency.json, 2: nhị phân)
+FORMAT_VERSION = 2
+#: Tên file ma trận khi metadata.json không ghi "matrix_file" (bản build đầu tiên của định dạng 2)
+BINARY_FILE = "cooccurrence.npz"
+METADATA_FILE = "metadata.json"
+
+
+def read_metadata(path: Path) -> Dict[str, object]:
+    """Nội dung metadata.json của thư mục cooccurrence."""
+    with open(Path(path) / METADATA_FILE, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+class CooccurrenceMatrix:
+    """
+    Ma trận đồng xuất hiện nguyên liệu dạng CSR theo id số nguyên.
+
+    - counts: CSR (nguyên liệu x nguyên liệu); với định dạng JSON cũ mỗi dòng giữ
+      đúng thứ tự khoá như matrix.json (để thứ tự duyệt/tie-break giống bản dict),
+      bản nhị phân sắp theo id số;
+    - frequency: vector tần suất theo id số;
+    - pmi: cùng cấu trúc với counts, giá trị PMI = log(p_xy / (p_x * p_y)) tính
+      một lần khi dùng đến hoặc materialize() (0 khi thiếu tần suất/total), và bản
+      chuyển vị pmi_by_seed để lấy PMI của mọi ứng viên với một seed bằng một lát
+      cắt dòng;
+    - neighbors: top-K láng giềng theo PMI của từng nguyên liệu (lưu sẵn khi
+      build hoặc tính từ counts). Danh sách bị cắt và xếp theo PMI nên thường đầy
+      cặp hiếm (count 1-2); chọn ứng viên theo ngưỡng count phải dùng cooccurring();
+    - embeddings (tuỳ chọn): vector dày mỗi nguyên liệu từ truncated SVD của
+      ma trận PPMI = max(PMI, 0), chuẩn hoá L2; dựng offline khi build.
+
+    PMI từng cặp được tính bằng math.log trên cùng chuỗi phép chia như bản
+    scalar, nên kết quả trùng bit-by-bit với ValidationService._pmi cũ.
+    """
+
+    def __init__(
+        self,
+        ids: Sequence[str],
+        counts: sparse.csr_matrix,
+        frequency: np.ndarray,
+        total: int,
+        neighbors: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None,
+        neighbor_top_k: int = NEIGHBOR_TOP_K,
+        embeddings: Optional[np.ndarray] = None,
+    ) -> None:
+        self.ids: List[str] = list(ids)
+        self.index: Dict[str, int] = {ing_id: i for i, ing_id in enumerate(self.ids)}
+        self.counts = counts
+        self.frequency = frequency
+        self.total = total
+        # PMI và bản chuyển vị dựng lười (materialize() ở service); script build chỉ
+        # cần khi dựng embeddings
+        self._pmi = None
+        self._by_seed = None
+        self.neighbor_indptr, self.neighbor_indices, self.neighbor_counts = (
+            neighbors if neighbors is not None else self._top_neighbors(neighbor_top_k)
+        )
+        self.embeddings = embeddings
+
+    @classmethod
+    def from_dicts(
+        cls,
+        matrix: Mapping[str, Mapping[str, int]],
+        frequency: Mapping[str, int],
+        total: int,
+        neighbors: Optional[Mapping[str, Sequence[Mapping[str, object]]]] = None,
+        neighbor_top_k: int = NEIGHBOR_TOP_K,
+    ) -> "CooccurrenceMatrix":
+        """
+        Dựng từ dữ liệu matrix.json / frequency.json (dict lồng nhau) và, nếu có,
+        neighbors.json; thiếu neighbors thì top-K được tính lại từ ma trận.
+        """
+        index: Dict[str, int] = {}
+        for ing_id in frequency:
+            index.setdefault(ing_id, len(index))
+        for row_id, row in matrix.items():
+            index.setdefault(row_id, len(index))
+            for co_id in row:
+                index.setdefault(co_id, len(index))
+
+        n = len(index)
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        indices: List[int] = []
+        data: List[int] = []
+        rows = {index[row_id]: row for row_id, row in matrix.items()}
+        for i in range(n):
+            row = rows.get(i, {})
+            indices.extend(index[co_id] for co_id in row)
+            data.extend(row.values())
+            indptr[i + 1] = len(indices)
+
+        counts = sparse.csr_matrix(
+            (np.asarray(data, dtype=np.int64), np.asarray(indices, dtype=np.int64), indptr),
+            shape=(n, n),
+        )
+        freq = np.zeros(n, dtype=np.int64)
+        for ing_id, count in frequency.items():
+            freq[index[ing_id]] = count
+
+        neighbor_arrays = None
+        if neighbors is not None:
+            nb_indptr = np.zeros(n + 1, dtype=np.int64)
+            nb_indices: List[int] = []
+            nb_counts: List[int] = []
+            for i, ing_id in enumerate(index):
+                for item in neighbors.get(ing_id, ()):
+                    if item["id"] in index:
+                        nb_indices.append(index[item["id"]])
+                        nb_counts.append(item["count"])
+                nb_indptr[i + 1] = len(nb_indices)
+            neighbor_arrays = (
+                nb_indptr,
+                np.asarray(nb_indices, dtype=np.int64),
+                np.asarray(nb_counts, dtype=np.int64),
+            )
+        return cls(list(index), counts, freq, total, neighbor_arrays, neighbor_top_k)
+
+    @classmethod
+    def empty(cls) -> "CooccurrenceMatrix":
+        return cls([], sparse.csr_matrix((0, 0), dtype=np.int64), np.zeros(0, dtype=np.int64), 0)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def pmi(self) -> sparse.csr_matrix:
+        if self._pmi is None:
+            self._pmi = self._build_pmi()
+        return self._pmi
+
+    @property
+    def pmi_by_seed(self) -> sparse.csr_matrix:
+        if self._by_seed is None:
+            self._by_seed = self._build_by_seed()
+        return self._by_seed[0]
+
+    @property
+    def counts_by_seed(self) -> sparse.csr_matrix:
+        if self._by_seed is None:
+            self._by_seed = self._build_by_seed()
+        return self._by_seed[1]
+
+    def materialize(self) -> "CooccurrenceMatrix":
+        """Dựng sẵn PMI và bản chuyển vị (gọi khi nạp ở service, trước khi nhận request)."""
+        self.pmi_by_seed
+        return self
+
+    def _build_by_seed(self) -> Tuple[sparse.csr_matrix, sparse.csr_matrix]:
+        counts = self.counts
+        # Chuyển vị một lần (data = vị trí + 1) để dùng chung cấu trúc cho pmi và counts
+        positions = sparse.csr_matrix(
+            (np.arange(1, len(counts.data) + 1), counts.indices, counts.indptr), shape=counts.shape
+        ).T.tocsr()
+        order = positions.data - 1
+        return (
+            sparse.csr_matrix((self.pmi.data[order], positions.indices, positions.indptr), shape=counts.shape),
+            sparse.csr_matrix((counts.data[order], positions.indices, positions.indptr), shape=counts.shape),
+        )
+
+    def _build_pmi(self) -> sparse.csr_matrix:
+        counts = self.counts
+        values = np.zeros(len(counts.data), dtype=np.float64)
+        if self.total:
+            rows = np.repeat(np.arange(counts.shape[0]), np.diff(counts.indptr))
+            p_xy = counts.data / self.total
+            p_x = self.frequency[rows] / self.total
+            p_y = self.frequency[counts.indices] / self.total
+            valid = (p_xy > 0) & (p_x > 0) & (p_y > 0)
+            ratio = p_xy[valid] / (p_x[valid] * p_y[valid])
+            values[valid] = np.fromiter(map(math.log, ratio.tolist()), dtype=np.float64, count=len(ratio))
+        # Không sort_indices: giữ thứ tự dòng giống counts
+        return sparse.csr_matrix((values, counts.indices, counts.indptr), shape=counts.shape)
+
+    def _top_neighbors(self, k: int, rows: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        (indptr, indices, counts) của k láng giềng PMI cao nhất mỗi dòng (chỉ các dòng
+        rows nếu có, theo thứ tự đó); hoà điểm giữ thứ tự dòng.
+
+        Xếp theo count / (f_x * f_y) — PMI trừ hằng số log(total) — nên danh sách của
+        một dòng chỉ phụ thuộc count của dòng và tần suất các cột, không đổi khi total
+        đổi; update_cooccurrence nhờ đó chỉ tính lại các dòng bị ảnh hưởng.
+        """
+        counts = self.counts
+        if rows is None:
+            rows = np.arange(counts.shape[0])
+        lengths = np.diff(counts.indptr)[rows]
+        local_indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=local_indptr[1:])
+        local_rows = np.repeat(np.arange(len(rows)), lengths)
+        elements = counts.indptr[rows][local_rows] + np.arange(local_indptr[-1]) - local_indptr[local_rows]
+
+        cols = counts.indices[elements]
+        data = counts.data[elements]
+        denom = self.frequency[rows][local_rows] * self.frequency[cols]
+        # Cặp thiếu tần suất (không xảy ra với build nhất quán) xếp cuối
+        affinity = np.divide(data, denom, out=np.zeros(len(data), dtype=np.float64), where=denom > 0)
+
+        order = np.lexsort((-affinity, local_rows))
+        rank = np.arange(len(order)) - local_indptr[local_rows]
+        keep = order[rank < k]
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(np.minimum(lengths, k), out=indptr[1:])
+        return indptr, cols[keep].astype(np.int64), data[keep].astype(np.int64)
+
+    def refresh_neighbors(
+        self,
+        previous: Tuple[np.ndarray, np.ndarray, np.ndarray],
+        rows: np.ndarray,
+        k: int = NEIGHBOR_TOP_K,
+    ) -> None:
+        """
+        Thay danh sách láng giềng bằng bản previous (cùng k) chỉ tính lại các dòng rows;
+        dòng mới (id số >= số dòng của previous) phải nằm trong rows.
+        """
+        prev_indptr, prev_indices, prev_counts = previous
+        n = len(self.ids)
+        rows = np.unique(np.asarray(rows, dtype=np.int64))
+        fresh_indptr, fresh_indices, fresh_counts = self._top_neighbors(k, rows)
+
+        lengths = np.zeros(n, dtype=np.int64)
+        lengths[:len(prev_indptr) - 1] = np.diff(prev_indptr)
+        lengths[rows] = np.diff(fresh_indptr)
+        stale = np.zeros(len(prev_indptr) - 1, dtype=bool)
+        stale[rows[rows < len(stale)]] = True
+        prev_rows = np.repeat(np.arange(len(stale)), np.diff(prev_indptr))
+        kept = ~stale[prev_rows]
+
+        # Mỗi dòng lấy từ đúng một nguồn -> sắp ổn định theo dòng giữ thứ tự trong dòng
+        row_of = np.concatenate((prev_rows[kept], np.repeat(rows, np.diff(fresh_indptr))))
+        order = np.argsort(row_of, kind="stable")
+        self.neighbor_indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.neighbor_indptr[1:])
+        self.neighbor_indices = np.concatenate((prev_indices[kept], fresh_indices))[order].astype(np.int64)
+        self.neighbor_counts = np.concatenate((prev_counts[kept], fresh_counts))[order].astype(np.int64)
+
+    def build_embeddings(self, dim: int = EMBEDDING_DIM, seed: int = 0) -> Optional[np.ndarray]:
+        """
+        Vector nguyên liệu (n x dim, float32) = U * sqrt(S) từ truncated SVD của PPMI,
+        mỗi dòng chuẩn hoá L2 (dòng không có cặp nào giữ vector 0). None nếu ma trận quá nhỏ.
+        """
+        n = len(self.ids)
+        dim = min(dim, n - 1)
+        ppmi = self.pmi.copy()
+        ppmi.data = np.maximum(ppmi.data, 0.0)
+        ppmi.eliminate_zeros()
+        if dim < 1 or not ppmi.nnz:
+            return None
+        # v0 cố định để build lặp lại cho cùng kết quả
+        v0 = np.random.default_rng(seed).standard_normal(n)
+        u, s, _ = svds(ppmi.astype(np.float64), k=dim, v0=v0)
+        order = np.argsort(-s)
+        vectors = u[:, order] * np.sqrt(s[order])
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        np.divide(vectors, norms, out=vectors, where=norms > 0)
+        return vectors.astype(np.float32)
+
+    def frequency_dict(self) -> Dict[str, int]:
+        """Tần suất theo id chuỗi (bỏ id không có tần suất), theo thứ tự id số."""
+        return {ing_id: count for ing_id, count in zip(self.ids, self.frequency.tolist()) if count}
+
+    def save(self, path: Path, version: int = 1, **metadata) -> Path:
+        """
+        Ghi định dạng nhị phân vào thư mục path: cooccurrence.v<version>.npz (ids,
+        CSR counts, tần suất, top-K láng giềng, total) rồi metadata.json (phiên bản,
+        tên file ma trận + thông tin build). metadata.json được os.replace sau cùng
+        nên reader luôn thấy một cặp nhất quán; chỉ giữ lại file của bản liền trước
+        (cho reader đang đọc dở), các bản cũ hơn bị xoá.
+        """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        matrix_file = f"cooccurrence.v{version}.npz"
+        tmp = path / f".{matrix_file}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez(
+                f,
+                ids=np.asarray(self.ids, dtype=str),
+                indptr=self.counts.indptr.astype(np.int64),
+                indices=self.counts.indices.astype(np.int32),
+                counts=self.counts.data.astype(np.int32),
+                frequency=self.frequency.astype(np.int64),
+                total=np.asarray(self.total, dtype=np.int64),
+                neighbor_indptr=self.neighbor_indptr.astype(np.int64),
+                neighbor_indices=self.neighbor_indices.astype(np.int32),
+                neighbor_counts=self.neighbor_counts.astype(np.int32),
+                **({"embeddings": self.embeddings} if self.embeddings is not None else {}),
+            )
+        os.replace(tmp, path / matrix_file)
+
+        previous = read_metadata(path).get("matrix_file") if (path / METADATA_FILE).exists() else None
+        metadata = {
+            "format_version": FORMAT_VERSION,
+            "version": version,
+            "matrix_file": matrix_file,
+            "total_dishes": self.total,
+            "total_ingredients": int(np.count_nonzero(self.frequency)),
+            "total_pairs": len(self.counts.data),
+            "embedding_dim": self.embeddings.shape[1] if self.embeddings is not None else 0,
+            **metadata,
+        }
+        tmp = path / f".{METADATA_FILE}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(metadata, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, path / METADATA_FILE)
+
+        for old in path.glob("cooccurrence*.npz"):
+            if old.name not in {matrix_file, previous}:
+                old.unlink(missing_ok=True)
+        return path
+
+    @classmethod
+    def load(cls, path: Path) -> "CooccurrenceMatrix":
+        """
+        Đọc thư mục cooccurrence: định dạng nhị phân (format_version 2) nếu có,
+        ngược lại định dạng JSON cũ (matrix.json, frequency.json, neighbors.json tuỳ chọn).
+        """
+        path = Path(path)
+        metadata = read_metadata(path)
+        version = metadata.get("format_version", 1)
+        if version > FORMAT_VERSION:
+            raise ValueError(f"Unsupported cooccurrence format_version {version} in {path}")
+        if version == FORMAT_VERSION:
+            return cls._load_binary(path / metadata.get("matrix_file", BINARY_FILE))
+
+        with open(path / "matrix.json", "r") as f:
+            matrix = json.load(f)
+        with open(path / "frequency.json", "r") as f:
+            frequency = json.load(f)
+        neighbors = None
+        if (path / "neighbors.json").exists():
+            with open(path / "neighbors.json", "r") as f:
+                neighbors = json.load(f)
+        return cls.from_dicts(matrix, frequency, metadata["total_dishes"], neighbors)
+
+    @classmethod
+    def _load_binary(cls, file_path: Path) -> "CooccurrenceMatrix":
+        with np.load(file_path, allow_pickle=False) as data:
+            n = len(data["ids"])
+            counts = sparse.csr_matrix(
+                (data["counts"], data["indices"], data["indptr"]), shape=(n, n)
+            )
+            return cls(
+                data["ids"].tolist(),
+                counts,
+                data["frequency"],
+                int(data["total"]),
+                (data["neighbor_indptr"], data["neighbor_indices"], data["neighbor_counts"]),
+                embeddings=data["embeddings"] if "embeddings" in data.files else None,
+            )
+
+    def pmi_pair(self, id1: str, id2: str) -> float:
+        """PMI của một cặp (giống ValidationService._pmi)."""
+        i = self.index.get(id1)
+        j = self.index.get(id2)
+        if i is None or j is None:
+            return 0.0
+        start, end = self.pmi.indptr[i], self.pmi.indptr[i + 1]
+        hit = np.flatnonzero(self.pmi.indices[start:end] == j)
+        return float(self.pmi.data[start + hit[0]]) if len(hit) else 0.0
+
+    def neighbors(self, ing_id: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """(id số, count, pmi) của các nguyên liệu đồng xuất hiện, theo thứ tự dòng."""
+        i = self.index.get(ing_id)
+        if i is None:
+            empty = np.zeros(0)
+            return empty.astype(np.int64), empty.astype(np.int64), empty
+        start, end = self.counts.indptr[i], self.counts.indptr[i + 1]
+        return (
+            self.counts.indices[start:end],
+            self.counts.data[start:end],
+            self.pmi.data[start:end],
+        )
+
+    def lookup(self, ing_ids: Iterable[str]) -> np.ndarray:
+        """Id chuỗi -> id số; id không có trong ma trận -> len(self) (ô luôn bằng 0)."""
+        missing = len(self.ids)
+        index = self.index
+        return np.fromiter((index.get(i, missing) for i in ing_ids), dtype=np.int64)
+
+    def neighbor_union(self, seed_ids: Iterable[str]) -> np.ndarray:
+        """
+        Id số trong hợp các danh sách láng giềng top-K của seed, theo thứ tự gặp đầu
+        tiên; độ lớn chỉ phụ thuộc số seed x K. Không lọc theo count: cặp count cao bị
+        cắt khỏi top-K sẽ không có mặt (dùng cooccurring(seed_ids, min_count) cho việc đó).
+        """
+        parts = []
+        for sid in seed_ids:
+            s = self.index.get(sid)
+            if s is None:
+                continue
+            start, end = self.neighbor_indptr[s], self.neighbor_indptr[s + 1]
+            parts.append(self.neighbor_indices[start:end])
+        if not parts:
+            return np.zeros(0, dtype=np.int64)
+        merged = np.concatenate(parts)
+        _, first = np.unique(merged, return_index=True)
+        return merged[np.sort(first)]
+
+    def cooccurring(self, seed_ids: Iterable[str], min_count: int = 0) -> np.ndarray:
+        """
+        Id số của mọi nguyên liệu có count > 0 (và >= min_count) với ít nhất một seed —
+        tập duy nhất mà pmi_sum(seed_ids, min_count) có thể khác 0. Duyệt toàn bộ dòng
+        count của seed (không phải danh sách láng giềng đã cắt top-K), theo thứ tự gặp
+        đầu tiên như khi quét matrix[seed] của bản dict.
+        """
+        parts = []
+        for sid in seed_ids:
+            s = self.index.get(sid)
+            if s is None:
+                continue
+            start, end = self.counts.indptr[s], self.counts.indptr[s + 1]
+            cols = self.counts.indices[start:end]
+            if min_count > 0:
+                cols = cols[self.counts.data[start:end] >= min_count]
+            parts.append(cols)
+        if not parts:
+            return np.zeros(0, dtype=np.int64)
+        merged = np.concatenate(parts).astype(np.int64)
+        _, first = np.unique(merged, return_index=True)
+        return merged[np.sort(first)]
+
+    def centroid_scores(self, seed_ids: Iterable[str]) -> Optional[np.ndarray]:
+        """
+        Độ tương đồng (tích vô hướng) giữa vector trung bình của các seed và mọi
+        nguyên liệu: một phép nhân ma trận-vector. Thêm một ô 0 ở cuối cho id ngoài
+        ma trận (như pmi_sum). None nếu không có embeddings hoặc không seed nào có vector.
+        """
+        if self.embeddings is None:
+            return None
+        rows = [i for i in (self.index.get(sid) for sid in seed_ids) if i is not None]
+        if not rows:
+            return None
+        centroid = self.embeddings[rows].mean(axis=0)
+        scores = np.zeros(len(self.ids) + 1, dtype=np.float32)
+        scores[:-1] = self.embeddings @ centroid
+        return scores
+
+    def pmi_sum(self, seed_ids: Iterable[str], min_count: int = 0) -> np.ndarray:
+        """
+        Tổng PMI(ứng viên, seed) trên các seed cho mọi id số (thêm một ô 0 ở cuối
+        cho id ngoài ma trận). Cộng lần lượt từng seed theo thứ tự như sum() cũ;
+        cặp không đồng xuất hiện (hoặc count < min_count) đóng góp 0.
+        """
+        acc = np.zeros(len(self.ids) + 1, dtype=np.float64)
+        by_seed = self.pmi_by_seed
+        for sid in seed_ids:
+            s = self.index.get(sid)
+            if s is None:
+                continue
+            start, end = by_seed.indptr[s], by_seed.indptr[s + 1]
+            cols = by_seed.indices[start:end]
+            values = by_seed.data[start:end]
+            if min_count > 0:
+                mask = self.counts_by_seed.data[start:end] >= min_count
+                cols, values = cols[mask], values[mask]
+            acc[cols] += values
+        return acc
+
+
+__all__ = ["CooccurrenceMatrix", "EMBEDDING_DIM", "FORMAT_VERSION", "NEIGHBOR_TOP_K", "read_metadata"]
@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence
+
+import numpy as np
+from scipy import sparse
+
+
+class DishScores(NamedTuple):
+    """Điểm của một lô giỏ hàng với mọi món; mỗi mảng có shape (số giỏ, số món)."""
+
+    match_count: np.ndarray
+    weighted_score: np.ndarray
+    match_ratio: np.ndarray
+    role_coverage: np.ndarray
+
+
+class DishMatrix:
+    """
+    Engine vector hoá cho search_similar_dishes.
+
+    Dựng từ dish_profiles của OntologyService:
+    - ma trận thưa nhị phân (nguyên liệu x món) và ma trận trọng số importance
+      cùng shape: match_count / matched_importance của một lô giỏ là hai phép
+      nhân (giỏ x nguyên liệu) @ (nguyên liệu x món);
+    - với mỗi role, một ma trận (nguyên liệu x món) đánh dấu nguyên liệu giữ role
+      đó trong món, cùng mask role bắt buộc của từng món -> role_coverage.
+
+    Kết quả bám đúng công thức của bản vòng lặp: weighted_score =
+    matched_importance / total_importance, match_ratio = match_count / số dòng
+    nguyên liệu của món, coverage = |role khớp ∩ role bắt buộc| / |role bắt buộc|.
+    """
+
+    # Số giỏ xử lý mỗi lượt; giới hạn bộ nhớ của các mảng dense (giỏ x món)
+    CHUNK_SIZE = 256
+
+    def __init__(
+        self,
+        dish_ids: Sequence[str],
+        ingredient_counts: Sequence[int],
+        profiles: Dict[str, Dict[str, object]],
+    ) -> None:
+        self.dish_ids = list(dish_ids)
+        self._vocab: Dict[str, int] = {}
+
+        roles: List[str] = sorted(
+            {role for p in profiles.values() for role in p.get("role_map", {}).values()}
+            | {role for p in profiles.values() for role in p.get("required_roles", set())}
+        )
+        self.roles = roles
+        role_pos = {role: i for i, role in enumerate(roles)}
+
+        rows: List[int] = []
+        cols: List[int] = []
+        weights: List[int] = []
+        role_rows: List[List[int]] = [[] for _ in roles]
+        role_cols: List[List[int]] = [[] for _ in roles]
+        n_dishes = len(self.dish_ids)
+        total_importance = np.zeros(n_dishes, dtype=np.float64)
+        required = np.zeros((len(roles), n_dishes), dtype=bool)
+
+        for pos, dish_id in enumerate(self.dish_ids):
+            profile = profiles.get(dish_id, {})
+            total_importance[pos] = profile.get("total_importance", 0)
+            role_map = profile.get("role_map", {})
+            for ing_id, importance in profile.get("importance_map", {}).items():
+                gid = self._vocab.setdefault(ing_id, len(self._vocab))
+                rows.append(gid)
+                cols.append(pos)
+                weights.append(int(importance))
+                role = role_map.get(ing_id)
+                if role is not None:
+                    role_rows[role_pos[role]].append(gid)
+                    role_cols[role_pos[role]].append(pos)
+            for role in profile.get("required_roles", set()):
+                required[role_pos[role], pos] = True
+
+        shape = (len(self._vocab), n_dishes)
+        self._binary = self._csr(rows, cols, np.ones(len(rows), dtype=np.float64), shape)
+        self._weights = self._csr(rows, cols, np.asarray(weights, dtype=np.float64), shape)
+        self._role_matrices = [
+            self._csr(r, c, np.ones(len(r), dtype=np.float64), shape)
+            for r, c in zip(role_rows, role_cols)
+        ]
+        self._required = required
+        self._required_count = required.sum(axis=0)
+        self._total_importance = total_importance
+        self._ingredient_counts = np.asarray(ingredient_counts, dtype=np.float64)
+
+    @staticmethod
+    def _csr(rows, cols, data, shape) -> sparse.csr_matrix:
+        return sparse.csr_matrix(
+            (data, (np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64))),
+            shape=shape,
+        )
+
+    def __len__(self) -> int:
+        return len(self.dish_ids)
+
+    def cart_matrix(self, carts: Sequence[Iterable[str]]) -> sparse.csr_matrix:
+        """Ma trận nhị phân (giỏ x nguyên liệu); id không có trong món nào bị bỏ qua."""
+        rows: List[int] = []
+        cols: List[int] = []
+        for row, cart in enumerate(carts):
+            for ing_id in set(cart):
+                gid = self._vocab.get(ing_id)
+                if gid is not None:
+                    rows.append(row)
+                    cols.append(gid)
+        data = np.ones(len(rows), dtype=np.float64)
+        return self._csr(rows, cols, data, (len(carts), len(self._vocab)))
+
+    def score_many(self, carts: Sequence[Iterable[str]]) -> DishScores:
+        """Điểm dense của cả lô giỏ với mọi món (nên gọi theo từng chunk nhỏ)."""
+        carts_matrix = self.cart_matrix(carts)
+        match_count = (carts_matrix @ self._binary).toarray()
+        matched_importance = (carts_matrix @ self._weights).toarray()
+
+        weighted_score = np.divide(
+            matched_importance,
+            self._total_importance,
+            out=np.zeros_like(matched_importance),
+            where=self._total_importance != 0,
+        )
+        match_ratio = np.divide(
+            match_count,
+            self._ingredient_counts,
+            out=np.zeros_like(match_count),
+            where=self._ingredient_counts != 0,
+        )
+
+        covered = np.zeros_like(match_count)
+        for role_matrix, required in zip(self._role_matrices, self._required):
+            covered += ((carts_matrix @ role_matrix).toarray() > 0) & required
+        role_coverage = np.divide(
+            covered,
+            self._required_count,
+            out=np.ones_like(covered),
+            where=self._required_count != 0,
+        )
+        return DishScores(match_count, weighted_score, match_ratio, role_coverage)
+
+    def top_k_many(
+        self,
+        carts: Sequence[Iterable[str]],
+        min_match: int = 2,
+        role_coverage_threshold: float = 0.5,
+        top_k: Optional[int] = None,
+    ) -> List[List[int]]:
+        """
+        Với mỗi giỏ: vị trí các món đạt min_match và ngưỡng coverage, sắp theo
+        (weighted_score, match_ratio, match_count) giảm dần, hoà điểm theo thứ tự
+        món. top_k=None trả về toàn bộ.
+        """
+        results: List[List[int]] = []
+        has_ingredients = self._ingredient_counts > 0
+        for start in range(0, len(carts), self.CHUNK_SIZE):
+            scores = self.score_many(carts[start:start + self.CHUNK_SIZE])
+            eligible = (
+                has_ingredients
+                & (scores.match_count >= min_match)
+                & (scores.role_coverage >= role_coverage_threshold)
+            )
+            for i in range(eligible.shape[0]):
+                results.append(self._rank(scores, i, np.flatnonzero(eligible[i]), top_k))
+        return results
+
+    @staticmethod
+    def _rank(scores: DishScores, row: int, idx: np.ndarray, top_k: Optional[int]) -> List[int]:
+        weighted = scores.weighted_score[row]
+        if top_k is not None and top_k < len(idx):
+            if top_k <= 0:
+                return []
+            # argpartition chọn top_k theo weighted_score; giữ mọi món hoà với
+            # ngưỡng để lexsort phía sau quyết định thứ tự như bản sort ổn định
+            part = np.argpartition(-weighted[idx], top_k - 1)[:top_k]
+            cutoff = weighted[idx[part]].min()
+            idx = idx[weighted[idx] >= cutoff]
+        order = np.lexsort(
+            (
+                idx,
+                -scores.match_count[row][idx],
+                -scores.match_ratio[row][idx],
+                -weighted[idx],
+            )
+        )
+        ranked = idx[order]
+        if top_k is not None:
+            ranked = ranked[:top_k]
+        return ranked.tolist()
+
+
+__all__ = ["DishMatrix", "DishScores"]
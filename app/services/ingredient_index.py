@@ -0,0 +1,381 @@
+from __future__ import annotations
+
+from collections import Counter
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Dict, FrozenSet, Iterable, List, Mapping, Optional, Sequence, Set, Tuple
+
+from app.services.kb_columns import LazyList
+from app.utils.ngram_index import NgramIndex
+from app.utils.text_match import FuzzyScorer, PreparedText, norm_text, prepare_text
+
+if TYPE_CHECKING:
+    import numpy as np
+
+    from app.services.resolution_cache import ResolutionCache
+
+
+STAGE_NAME = "name"  # Stage A: khớp name_vi
+STAGE_SYNONYM = "synonym"  # Stage B: khớp synonyms
+
+
+@dataclass(frozen=True)
+class IngredientMatch:
+    ingredient_id: Optional[str]
+    score: float
+    stage: Optional[str] = None
+    exact: bool = False  # True nếu trả về từ bảng tra cứu chính xác, không qua fuzzy
+
+
+_NO_MATCH = IngredientMatch(None, 0.0, None)
+
+
+def _prepare_name(ing: dict) -> Optional[PreparedText]:
+    name = ing.get("name_vi") or ""
+    return prepare_text(name) if name else None
+
+
+def _prepare_synonyms(ing: dict) -> List[PreparedText]:
+    return [prepare_text(s) for s in ing.get("synonyms", []) if s]
+
+
+class IngredientIndex:
+    """
+    Index tra cứu nguyên liệu theo tên, dựng một lần khi OntologyService load.
+
+    Giữ sẵn name_vi/synonyms đã chuẩn hoá + tokenize và inverted index
+    token -> vị trí nguyên liệu. Chỉ những ứng viên có chung ít nhất một token
+    với truy vấn mới được chấm fuzzy: ứng viên không chung token nào có
+    token_set_score = 0 nên fuzzy_score <= 0.5, không thể vượt ngưỡng A/B.
+
+    Khi token của truy vấn quá phổ biến (posting list dài hơn shortlist_size),
+    ứng viên lấy từ top-k của index trigram ký tự thay vì toàn bộ posting list,
+    để thời gian resolve gần như không phụ thuộc kích thước KB.
+
+    Trước khi chạy fuzzy, truy vấn được tra trong bảng băm không dấu
+    name_vi / name_normalized -> id (O(1)); chỉ khi trượt mới chấm fuzzy.
+    Khớp chính xác synonym thay thế Stage B (điểm 1.0 luôn thắng Stage B) nhưng
+    vẫn sau Stage A để giữ nguyên thứ tự ưu tiên name_vi > synonyms.
+    Kết quả đi qua đường fuzzy được lưu vào ResolutionCache (nếu có).
+    """
+
+    THRESHOLD_A = 0.70  # ngưỡng cho name_vi
+    THRESHOLD_B = 0.65  # ngưỡng cho synonyms
+    SHORTLIST_SIZE = 128
+    # Tăng khi logic matching/chuẩn hoá thay đổi để vô hiệu hoá cache kết quả cũ
+    RESOLVER_VERSION = 2
+
+    def __init__(
+        self,
+        ingredients: Dict[str, dict],
+        shortlist_size: Optional[int] = None,
+        cache: Optional["ResolutionCache"] = None,
+    ) -> None:
+        self.shortlist_size = shortlist_size or self.SHORTLIST_SIZE
+        self.cache = cache
+        self._ids: List[str] = []
+        self._names: List[Optional[PreparedText]] = []
+        self._synonyms: List[List[PreparedText]] = []
+        self._name_postings: Dict[str, List[int]] = {}
+        self._synonym_postings: Dict[str, List[int]] = {}
+
+        for pos, (ing_id, ing) in enumerate(ingredients.items()):
+            self._ids.append(ing_id)
+
+            entry = _prepare_name(ing)
+            self._names.append(entry)
+            if entry:
+                for token in entry.tokens:
+                    self._name_postings.setdefault(token, []).append(pos)
+
+            syns = _prepare_synonyms(ing)
+            self._synonyms.append(syns)
+            syn_tokens: Set[str] = set()
+            for syn in syns:
+                syn_tokens.update(syn.tokens)
+            for token in syn_tokens:
+                self._synonym_postings.setdefault(token, []).append(pos)
+
+        self._build_exact_lookup(ingredients)
+        self._stats: Counter = Counter()
+
+        # Index trigram: mỗi dòng là một name_vi / một synonym, map về vị trí nguyên liệu
+        self._name_rows: List[int] = [pos for pos, entry in enumerate(self._names) if entry]
+        self._name_ngrams = NgramIndex([self._names[pos].normalized for pos in self._name_rows])
+        self._synonym_rows: List[int] = [
+            pos for pos, syns in enumerate(self._synonyms) for _ in syns
+        ]
+        self._synonym_ngrams = NgramIndex(
+            [syn.normalized for syns in self._synonyms for syn in syns]
+        )
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def materialize(self) -> None:
+        """Dựng trước name/synonym đã chuẩn bị (lười khi load từ snapshot)."""
+        for lazy in (self._names, self._synonyms):
+            if isinstance(lazy, LazyList):
+                lazy.materialize()
+
+    # Thuộc tính được lưu trong KB snapshot (xem kb_snapshot.py); _names/_synonyms
+    # dựng lại lười từ bản ghi nguyên liệu
+    _SNAPSHOT_FIELDS = (
+        "_ids", "_name_postings", "_synonym_postings",
+        "_exact_names", "_exact_synonyms", "_exact_collisions", "_name_rows", "_synonym_rows",
+    )
+
+    def to_snapshot(self) -> Tuple[Dict[str, object], Dict[str, Dict[str, "np.ndarray"]]]:
+        objects = {field: getattr(self, field) for field in self._SNAPSHOT_FIELDS}
+        arrays = {
+            "ingredient_name_ngrams": self._name_ngrams.to_arrays(),
+            "ingredient_synonym_ngrams": self._synonym_ngrams.to_arrays(),
+        }
+        return objects, arrays
+
+    @classmethod
+    def from_snapshot(
+        cls,
+        objects: Dict[str, object],
+        arrays: Dict[str, Dict[str, "np.ndarray"]],
+        ingredients: Mapping[str, dict],
+        shortlist_size: Optional[int] = None,
+        cache: Optional["ResolutionCache"] = None,
+    ) -> "IngredientIndex":
+        index = cls.__new__(cls)
+        index.shortlist_size = shortlist_size or cls.SHORTLIST_SIZE
+        index.cache = cache
+        for field in cls._SNAPSHOT_FIELDS:
+            setattr(index, field, objects[field])
+        ids = index._ids
+        index._names = LazyList(len(ids), lambda pos: _prepare_name(ingredients[ids[pos]]))
+        index._synonyms = LazyList(len(ids), lambda pos: _prepare_synonyms(ingredients[ids[pos]]))
+        index._name_ngrams = NgramIndex.from_arrays(arrays["ingredient_name_ngrams"])
+        index._synonym_ngrams = NgramIndex.from_arrays(arrays["ingredient_synonym_ngrams"])
+        index._stats = Counter()
+        return index
+
+    def _build_exact_lookup(self, ingredients: Dict[str, dict]) -> None:
+        """
+        Bảng tra cứu chính xác (không dấu, lower-case) cho name_vi, name_normalized
+        và synonyms. Một khoá có thể thuộc nhiều nguyên liệu (trùng tên/synonym):
+        chọn giống tie-break của Stage A/B khi điểm bằng 1.0 — chuỗi gốc ngắn hơn,
+        rồi nguyên liệu đứng trước trong KB.
+        """
+        name_keys: Dict[str, List[Tuple[int, int]]] = {}
+        alias_keys: Dict[str, List[Tuple[int, int]]] = {}
+        synonym_keys: Dict[str, List[Tuple[int, int]]] = {}
+
+        for pos, ing in enumerate(ingredients.values()):
+            entry = self._names[pos]
+            if entry and entry.normalized:
+                name_keys.setdefault(entry.normalized, []).append((len(entry.text), pos))
+            alias = norm_text(ing.get("name_normalized"))
+            if alias:
+                alias_keys.setdefault(alias, []).append((len(entry.text) if entry else 0, pos))
+            for syn in self._synonyms[pos]:
+                if syn.normalized:
+                    synonym_keys.setdefault(syn.normalized, []).append((len(syn.text), pos))
+
+        def _pick(keys: Dict[str, List[Tuple[int, int]]]) -> Dict[str, int]:
+            return {key: min(entries)[1] for key, entries in keys.items()}
+
+        def _collisions(keys: Dict[str, List[Tuple[int, int]]]) -> int:
+            return sum(1 for entries in keys.values() if len({pos for _, pos in entries}) > 1)
+
+        # name_vi ưu tiên hơn name_normalized, rồi mới tới synonyms
+        self._exact_names: Dict[str, int] = {**_pick(alias_keys), **_pick(name_keys)}
+        self._exact_synonyms: Dict[str, int] = _pick(synonym_keys)
+        self._exact_collisions = {
+            "name": _collisions(name_keys),
+            "name_normalized": _collisions(alias_keys),
+            "synonym": _collisions(synonym_keys),
+        }
+
+    def stats(self) -> Dict[str, object]:
+        """Bộ đếm hit/miss: bao nhiêu truy vấn phải đi đường fuzzy đắt tiền."""
+        return {
+            "exact_name_hits": self._stats["exact_name_hits"],
+            "exact_synonym_hits": self._stats["exact_synonym_hits"],
+            "fuzzy_lookups": self._stats["fuzzy_lookups"],
+            "fuzzy_name_hits": self._stats["fuzzy_name_hits"],
+            "fuzzy_synonym_hits": self._stats["fuzzy_synonym_hits"],
+            "misses": self._stats["misses"],
+            "cache_hits": self._stats["cache_hits"],
+            "exact_collisions": dict(self._exact_collisions),
+        }
+
+    def _needs_shortlist(self, postings: Dict[str, List[int]], q_tokens: Iterable[str]) -> bool:
+        return sum(len(postings.get(token, ())) for token in q_tokens) > self.shortlist_size
+
+    def _shortlists(
+        self,
+        postings: Dict[str, List[int]],
+        ngrams: NgramIndex,
+        row_positions: List[int],
+        queries: List[Tuple[str, FrozenSet[str]]],
+    ) -> List[Optional[Set[int]]]:
+        """
+        Shortlist trigram cho các truy vấn có token quá phổ biến, chấm cả lô trong
+        một phép nhân ma trận thưa. Truy vấn còn lại trả None (dùng posting list).
+        """
+        wanted = [i for i, (_, q_tokens) in enumerate(queries) if self._needs_shortlist(postings, q_tokens)]
+        result: List[Optional[Set[int]]] = [None] * len(queries)
+        if not wanted:
+            return result
+        top_rows = ngrams.top_k_many([queries[i][0] for i in wanted], self.shortlist_size)
+        for i, rows in zip(wanted, top_rows):
+            result[i] = {row_positions[row] for row in rows}
+        return result
+
+    @staticmethod
+    def _candidates(
+        postings: Dict[str, List[int]],
+        q_tokens: Iterable[str],
+        shortlist: Optional[Set[int]],
+    ) -> List[int]:
+        if shortlist is not None:
+            positions = shortlist
+        else:
+            positions = set()
+            for token in q_tokens:
+                positions.update(postings.get(token, ()))
+        # Duyệt theo thứ tự KB để tie-break giống hệt vòng lặp cũ
+        return sorted(positions)
+
+    def _match_names(self, scorer: FuzzyScorer, candidates: List[int]) -> Tuple[Optional[str], float]:
+        # ---------- Stage A: chỉ xét name_vi ----------
+        q_tokens = scorer.query.tokens
+        best_id = None
+        best_score = -1.0
+        best_extras = 10**9
+        best_len = 10**9
+
+        for pos in candidates:
+            cand = self._names[pos]
+            sc = scorer.score_if_better(cand, best_score)
+            if sc is None:
+                continue
+            extras = len(cand.tokens - q_tokens)  # ít từ dư hơn thì tốt hơn
+            clen = len(cand.text)
+
+            if (sc > best_score) or (sc == best_score and (extras < best_extras or (extras == best_extras and clen < best_len))):
+                best_id, best_score, best_extras, best_len = self._ids[pos], sc, extras, clen
+
+        return best_id, best_score
+
+    def _match_synonyms(self, scorer: FuzzyScorer, candidates: List[int]) -> Tuple[Optional[str], float]:
+        # ---------- Stage B: xét synonyms nếu Stage A không đủ ----------
+        q_tokens = scorer.query.tokens
+        best_id = None
+        best_score = -1.0
+        best_extras = 10**9
+        best_len = 10**9
+
+        for pos in candidates:
+            # lấy synonym tốt nhất cho ingredient này
+            local_best_sc = -1.0
+            local_best_extras = 10**9
+            local_best_len = 10**9
+            for syn in self._synonyms[pos]:
+                # synonym kém hơn cả best toàn cục lẫn best cục bộ thì không ảnh hưởng kết quả
+                sc = scorer.score_if_better(syn, max(best_score, local_best_sc))
+                if sc is None:
+                    continue
+                extras = len(syn.tokens - q_tokens)
+                slen = len(syn.text)
+                if (sc > local_best_sc) or (sc == local_best_sc and (extras < local_best_extras or (extras == local_best_extras and slen < local_best_len))):
+                    local_best_sc, local_best_extras, local_best_len = sc, extras, slen
+
+            if (local_best_sc > best_score) or (local_best_sc == best_score and (local_best_extras < best_extras or (local_best_extras == best_extras and local_best_len < best_len))):
+                best_id, best_score, best_extras, best_len = self._ids[pos], local_best_sc, local_best_extras, local_best_len
+
+        return best_id, best_score
+
+    def resolve_many(self, names: Sequence[str]) -> List[IngredientMatch]:
+        """
+        Resolve cả lô tên nguyên liệu trong một lượt: chuẩn hoá mỗi tên một lần,
+        gộp tên trùng sau chuẩn hoá và chấm shortlist trigram bằng một phép nhân
+        ma trận cho mỗi stage. Kết quả theo đúng thứ tự đầu vào.
+        """
+        queries: List[Tuple[str, FrozenSet[str]]] = []
+        scorers: List[FuzzyScorer] = []
+        slot_of: Dict[str, int] = {}
+        slots: List[Optional[int]] = []
+        for name in names:
+            if not name:
+                slots.append(None)
+                continue
+            q_norm = norm_text(name)
+            if q_norm not in slot_of:
+                slot_of[q_norm] = len(queries)
+                scorer = FuzzyScorer(name)
+                scorers.append(scorer)
+                queries.append((scorer.query.normalized, scorer.query.tokens))
+            slots.append(slot_of[q_norm])
+
+        matches: List[Optional[IngredientMatch]] = [None] * len(queries)
+
+        # Fast path: khớp chính xác name_vi / name_normalized
+        fuzzy: List[int] = []
+        for i, (q_norm, _) in enumerate(queries):
+            pos = self._exact_names.get(q_norm)
+            if pos is not None:
+                matches[i] = IngredientMatch(self._ids[pos], 1.0, STAGE_NAME, exact=True)
+            else:
+                fuzzy.append(i)
+        self._stats["exact_name_hits"] += len(queries) - len(fuzzy)
+
+        # Tên đã resolve ở request/worker trước: bỏ qua fuzzy hoàn toàn
+        if fuzzy and self.cache is not None:
+            cached = self.cache.get_many([queries[i][0] for i in fuzzy])
+            if cached:
+                for i in fuzzy:
+                    matches[i] = cached.get(queries[i][0])
+                fuzzy = [i for i in fuzzy if matches[i] is None]
+                self._stats["cache_hits"] += len(cached)
+        self._stats["fuzzy_lookups"] += len(fuzzy)
+
+        fuzzy_queries = [queries[i] for i in fuzzy]
+        name_shortlists = self._shortlists(self._name_postings, self._name_ngrams, self._name_rows, fuzzy_queries)
+        pending: List[int] = []
+        best_scores: List[float] = [-1.0] * len(queries)
+        for i, (q_norm, q_tokens), shortlist in zip(fuzzy, fuzzy_queries, name_shortlists):
+            candidates = self._candidates(self._name_postings, q_tokens, shortlist)
+            best_id, best_score = self._match_names(scorers[i], candidates)
+            if best_score >= self.THRESHOLD_A:
+                matches[i] = IngredientMatch(best_id, best_score, STAGE_NAME)
+                self._stats["fuzzy_name_hits"] += 1
+                continue
+            # Synonym trùng khớp có điểm 1.0 -> chính là kết quả Stage B
+            pos = self._exact_synonyms.get(q_norm)
+            if pos is not None:
+                matches[i] = IngredientMatch(self._ids[pos], 1.0, STAGE_SYNONYM, exact=True)
+                self._stats["exact_synonym_hits"] += 1
+                continue
+            best_scores[i] = best_score
+            pending.append(i)
+
+        pending_queries = [queries[i] for i in pending]
+        synonym_shortlists = self._shortlists(
+            self._synonym_postings, self._synonym_ngrams, self._synonym_rows, pending_queries
+        )
+        for i, (q_norm, q_tokens), shortlist in zip(pending, pending_queries, synonym_shortlists):
+            candidates = self._candidates(self._synonym_postings, q_tokens, shortlist)
+            best_id, best_score = self._match_synonyms(scorers[i], candidates)
+            if best_score >= self.THRESHOLD_B:
+                matches[i] = IngredientMatch(best_id, best_score, STAGE_SYNONYM)
+                self._stats["fuzzy_synonym_hits"] += 1
+            else:
+                matches[i] = IngredientMatch(None, max(best_scores[i], best_score, 0.0), None)
+                self._stats["misses"] += 1
+
+        if fuzzy and self.cache is not None:
+            self.cache.put_many({queries[i][0]: matches[i] for i in fuzzy})
+
+        return [matches[slot] if slot is not None else _NO_MATCH for slot in slots]
+
+    def resolve(self, name: str) -> Optional[str]:
+        return self.resolve_many([name])[0].ingredient_id
+
+
+__all__ = ["IngredientIndex", "IngredientMatch", "STAGE_NAME", "STAGE_SYNONYM"]
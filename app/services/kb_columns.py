@@ -0,0 +1,336 @@
+"""
+Bảng cột (columnar) cho KB snapshot: bảng chuỗi + cột số nguyên, đều là mảng numpy
+đọc bằng mmap (chỉ đọc, dùng chung page cache giữa các worker).
+
+- StringTable: mọi chuỗi nằm trong một blob UTF-8 + mảng offsets; cột chỉ giữ id int32.
+- encode_records / RecordColumns: dict bản ghi (IngredientRecord, DishRecord...) -> cột
+  theo từng field; list chuỗi và list bản ghi con lưu dạng CSR (indptr + giá trị).
+- LazyMapping / LazyList: API dict / list thông thường, phần tử dựng lười khi truy cập
+  lần đầu rồi giữ lại — khởi động không phải dựng hàng chục nghìn object Python.
+"""
+from __future__ import annotations
+
+import sys
+from collections.abc import Mapping
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Type
+
+import numpy as np
+
+from app.services.kb_records import _MISSING, _Record
+
+#: Mã đặc biệt trong cột chuỗi
+_MISSING_ID = -1
+_NONE_ID = -2
+
+#: Phân tách tên cột của bản ghi con trong cùng nhóm mảng ("ingredients__unit")
+_SEP = "__"
+
+
+class NotColumnar(ValueError):
+    """Bản ghi có field/kiểu không biểu diễn được bằng cột (caller lưu bằng pickle)."""
+
+
+class StringTableBuilder:
+    def __init__(self) -> None:
+        self._ids: Dict[str, int] = {}
+        self._strings: List[str] = []
+
+    def add(self, value: str) -> int:
+        sid = self._ids.get(value)
+        if sid is None:
+            sid = self._ids[value] = len(self._strings)
+            self._strings.append(value)
+        return sid
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        encoded = [s.encode("utf-8") for s in self._strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        return {"blob": np.frombuffer(b"".join(encoded), dtype=np.uint8), "offsets": offsets}
+
+
+class StringTable:
+    """Đọc chuỗi theo id từ blob + offsets; chuỗi đã giải mã được intern và giữ lại."""
+
+    def __init__(self, arrays: Dict[str, np.ndarray]) -> None:
+        self._blob = arrays["blob"]
+        self._offsets = arrays["offsets"]
+        self._decoded: Dict[int, str] = {}
+        self._all: Optional[List[str]] = None
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def materialize(self) -> List[str]:
+        """Giải mã toàn bộ bảng một lần (dùng khi dựng hàng loạt bản ghi)."""
+        if self._all is None:
+            blob = self._blob.tobytes()
+            offsets = self._offsets.tolist()
+            decoded = self._decoded
+            self._all = [
+                decoded.get(sid) or sys.intern(blob[offsets[sid]:offsets[sid + 1]].decode("utf-8"))
+                for sid in range(len(offsets) - 1)
+            ]
+        return self._all
+
+    def __getitem__(self, sid: int) -> str:
+        if self._all is not None:
+            return self._all[sid]
+        value = self._decoded.get(sid)
+        if value is None:
+            start, end = self._offsets[sid], self._offsets[sid + 1]
+            value = self._decoded[sid] = sys.intern(self._blob[start:end].tobytes().decode("utf-8"))
+        return value
+
+
+def _str_id(value: Any, strings: StringTableBuilder) -> int:
+    if value is _MISSING:
+        return _MISSING_ID
+    if value is None:
+        return _NONE_ID
+    if type(value) is str:
+        return strings.add(value)
+    raise NotColumnar(f"unsupported value type {type(value).__name__}")
+
+
+def _column_kind(values: Sequence[Any]) -> str:
+    present = [v for v in values if v is not _MISSING and v is not None]
+    if all(type(v) is str for v in present):
+        return "str"
+    if all(type(v) is int for v in values if v is not _MISSING):
+        return "int"
+    if all(type(v) is tuple and all(type(s) is str for s in v) for v in present):
+        return "strs"
+    if all(type(v) is tuple and all(isinstance(r, _Record) for r in v) for v in present):
+        classes = {type(r) for v in present for r in v}
+        if len(classes) == 1:
+            return "records"
+    raise NotColumnar("mixed value types in column")
+
+
+def encode_records(
+    records: Sequence[_Record],
+    strings: StringTableBuilder,
+) -> Tuple[Dict[str, Any], Dict[str, np.ndarray]]:
+    """
+    Mã hoá danh sách bản ghi cùng lớp thành (schema, cột). Raise NotColumnar nếu có
+    bản ghi chứa field lạ (_extra) hoặc giá trị không thuộc các kiểu hỗ trợ.
+    """
+    classes = {type(r) for r in records}
+    if len(classes) > 1 or any(r._extra is not None for r in records):
+        raise NotColumnar("records with extra fields or mixed classes")
+    record_cls = classes.pop() if classes else None
+
+    schema: Dict[str, Any] = {"record_cls": record_cls, "fields": []}
+    columns: Dict[str, np.ndarray] = {}
+    for field in record_cls._FIELDS if record_cls else ():
+        values = [getattr(r, field) for r in records]
+        kind = _column_kind(values)
+        spec: Dict[str, Any] = {"name": field, "kind": kind}
+        if kind == "str":
+            columns[field] = np.array([_str_id(v, strings) for v in values], dtype=np.int32)
+        elif kind == "int":
+            columns[field] = np.array([0 if v is _MISSING else v for v in values], dtype=np.int64)
+            columns[f"{field}{_SEP}present"] = np.array([v is not _MISSING for v in values], dtype=np.bool_)
+        else:
+            # CSR: giá trị của bản ghi i nằm trong [indptr[i], indptr[i+1]); -1 = field vắng, -2 = None
+            indptr = np.zeros(len(values) + 1, dtype=np.int64)
+            flat: List[Any] = []
+            marker = np.zeros(len(values), dtype=np.int8)
+            for i, v in enumerate(values):
+                if v is _MISSING:
+                    marker[i] = _MISSING_ID
+                elif v is None:
+                    marker[i] = _NONE_ID
+                else:
+                    flat.extend(v)
+                indptr[i + 1] = len(flat)
+            columns[f"{field}{_SEP}indptr"] = indptr
+            columns[f"{field}{_SEP}marker"] = marker
+            if kind == "strs":
+                columns[field] = np.array([strings.add(s) for s in flat], dtype=np.int32)
+            else:
+                child_schema, child_columns = encode_records(flat, strings)
+                spec["schema"] = child_schema
+                for name, column in child_columns.items():
+                    columns[f"{field}{_SEP}{name}"] = column
+        schema["fields"].append(spec)
+    return schema, columns
+
+
+class RecordColumns:
+    """Dựng lại bản ghi từ các cột (mảng có thể là memmap); đọc theo dải dòng bằng slice."""
+
+    def __init__(
+        self,
+        schema: Dict[str, Any],
+        columns: Dict[str, np.ndarray],
+        strings: StringTable,
+    ) -> None:
+        self.record_cls: Type[_Record] = schema["record_cls"]
+        self._strings = strings
+        # np.asarray: view ndarray thường trên cùng vùng mmap (truy cập nhanh hơn lớp memmap)
+        columns = {name: np.asarray(column) for name, column in columns.items()}
+        self._readers: List[Callable[[int, int], List[Any]]] = [
+            self._reader(spec, columns) for spec in schema["fields"]
+        ]
+
+    def _decode_strs(self, ids: List[int]) -> List[Any]:
+        strings = self._strings._all or self._strings
+        return [strings[sid] if sid >= 0 else (_MISSING if sid == _MISSING_ID else None) for sid in ids]
+
+    def _reader(self, spec: Dict[str, Any], columns: Dict[str, np.ndarray]) -> Callable[[int, int], List[Any]]:
+        name, kind = spec["name"], spec["kind"]
+        if kind == "str":
+            column = columns[name]
+            return lambda start, end: self._decode_strs(column[start:end].tolist())
+        if kind == "int":
+            column, present = columns[name], columns[f"{name}{_SEP}present"]
+            return lambda start, end: [
+                v if ok else _MISSING
+                for v, ok in zip(column[start:end].tolist(), present[start:end].tolist())
+            ]
+
+        indptr, marker = columns[f"{name}{_SEP}indptr"], columns[f"{name}{_SEP}marker"]
+        if kind == "strs":
+            values = columns[name]
+            read_items: Callable[[int, int], List[Any]] = (
+                lambda start, end: self._decode_strs(values[start:end].tolist())
+            )
+        else:
+            prefix = f"{name}{_SEP}"
+            child = RecordColumns(
+                spec["schema"],
+                {k[len(prefix):]: v for k, v in columns.items() if k.startswith(prefix)},
+                self._strings,
+            )
+            read_items = child.records
+
+        def read_seqs(start: int, end: int) -> List[Any]:
+            bounds = indptr[start:end + 1].tolist()
+            items = read_items(bounds[0], bounds[-1]) if bounds[-1] > bounds[0] else []
+            base = bounds[0]
+            out: List[Any] = []
+            for i, mark in enumerate(marker[start:end].tolist()):
+                if mark:
+                    out.append(_MISSING if mark == _MISSING_ID else None)
+                else:
+                    out.append(tuple(items[bounds[i] - base:bounds[i + 1] - base]))
+            return out
+
+        return read_seqs
+
+    def records(self, start: int, end: int) -> List[_Record]:
+        """Các bản ghi [start, end)."""
+        if end <= start:
+            return []
+        return [self.record_cls(*values) for values in zip(*(read(start, end) for read in self._readers))]
+
+    def record(self, pos: int) -> _Record:
+        return self.records(pos, pos + 1)[0]
+
+
+class LazyMapping(Mapping):
+    """
+    Mapping chỉ đọc với tập khoá cố định; giá trị của khoá thứ pos = factory(pos),
+    dựng khi truy cập lần đầu rồi giữ lại. Thứ tự duyệt = thứ tự keys.
+    """
+
+    def __init__(
+        self,
+        keys: Sequence[Any],
+        factory: Callable[[int], Any],
+        bulk_factory: Optional[Callable[[int, int], List[Any]]] = None,
+    ) -> None:
+        self._keys = keys
+        self._pos = {key: pos for pos, key in enumerate(keys)}
+        self._factory = factory
+        self._bulk_factory = bulk_factory
+        self._values: Dict[Any, Any] = {}
+
+    def materialize(self) -> None:
+        """Dựng mọi giá trị chưa có (giữ nguyên object đã dựng)."""
+        if len(self._values) == len(self._keys):
+            return
+        if self._bulk_factory is not None:
+            for key, value in zip(self._keys, self._bulk_factory(0, len(self._keys))):
+                self._values.setdefault(key, value)
+        else:
+            for key in self._keys:
+                self[key]
+
+    def __getitem__(self, key: Any) -> Any:
+        value = self._values.get(key, _MISSING)
+        if value is _MISSING:
+            value = self._values[key] = self._factory(self._pos[key])
+        return value
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        return self[key] if key in self._pos else default
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._pos
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(self._keys)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __reduce__(self):
+        # Pickle (vd. write_snapshot từ service đã load snapshot) -> dict thường
+        return (dict, (dict(self.items()),))
+
+
+class LazyList(Sequence):
+    """List chỉ đọc độ dài cố định, phần tử thứ i = factory(i) dựng lười."""
+
+    def __init__(self, length: int, factory: Callable[[int], Any]) -> None:
+        self._values: List[Any] = [_MISSING] * length
+        self._factory = factory
+
+    def __getitem__(self, pos):  # type: ignore[override]
+        if isinstance(pos, slice):
+            return [self[i] for i in range(*pos.indices(len(self)))]
+        value = self._values[pos]
+        if value is _MISSING:
+            value = self._values[pos] = self._factory(pos if pos >= 0 else pos + len(self))
+        return value
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def materialize(self) -> None:
+        for pos in range(len(self._values)):
+            self[pos]
+
+    def __reduce__(self):
+        return (list, (list(self),))
+
+
+def record_table(
+    keys: Sequence[str],
+    schema: Dict[str, Any],
+    columns: Dict[str, np.ndarray],
+    strings: StringTable,
+) -> LazyMapping:
+    """Mapping id -> bản ghi trên các cột của encode_records (keys theo đúng thứ tự đã mã hoá)."""
+    reader = RecordColumns(schema, columns, strings)
+
+    def bulk(start: int, end: int) -> List[_Record]:
+        strings.materialize()
+        return reader.records(start, end)
+
+    return LazyMapping(keys, reader.record, bulk)
+
+
+__all__ = [
+    "LazyList",
+    "LazyMapping",
+    "NotColumnar",
+    "RecordColumns",
+    "StringTable",
+    "StringTableBuilder",
+    "encode_records",
+    "record_table",
+]
@@ -0,0 +1,215 @@
+from __future__ import annotations
+
+import sys
+from typing import Any, Dict, FrozenSet, Iterator, List, Optional, Tuple
+
+
+class _Missing:
+    """Đánh dấu field không có trong bản ghi JSON gốc (khác với giá trị None)."""
+
+    __slots__ = ()
+
+    def __repr__(self) -> str:
+        return "<missing>"
+
+    def __reduce__(self) -> str:
+        return "_MISSING"
+
+
+_MISSING = _Missing()
+
+
+def _intern(value: Any) -> Any:
+    return sys.intern(value) if type(value) is str else value
+
+
+class _Record:
+    """
+    Bản ghi KB gọn (__slots__) thay cho dict JSON, giữ API đọc kiểu dict:
+    get(), [], in, keys(), items(), values(), len(), dict(record), to_dict().
+
+    Field cố định nằm trong slot; khoá lạ (nếu KB có thêm) giữ trong _extra.
+    Chuỗi lặp lại nhiều (id, category, đơn vị, tên nguyên liệu...) được intern
+    nên mọi bản ghi/index dùng chung một object. Bản ghi được chia sẻ giữa các
+    request nên coi là chỉ đọc.
+    """
+
+    __slots__ = ("_extra",)
+
+    _FIELDS: Tuple[str, ...] = ()
+    _FIELD_SET: FrozenSet[str] = frozenset()
+
+    @classmethod
+    def _extra_fields(cls, data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        if cls._FIELD_SET.issuperset(data):
+            return None
+        return {k: v for k, v in data.items() if k not in cls._FIELD_SET}
+
+    def __reduce__(self):
+        return (type(self), tuple(getattr(self, f) for f in self._FIELDS) + (self._extra,))
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if key in self._FIELD_SET:
+            value = getattr(self, key)
+            return default if value is _MISSING else value
+        if self._extra is not None:
+            return self._extra.get(key, default)
+        return default
+
+    def __getitem__(self, key: str) -> Any:
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key: object) -> bool:
+        return self.get(key, _MISSING) is not _MISSING  # type: ignore[arg-type]
+
+    def keys(self) -> List[str]:
+        keys = [f for f in self._FIELDS if getattr(self, f) is not _MISSING]
+        if self._extra:
+            keys.extend(self._extra)
+        return keys
+
+    def values(self) -> List[Any]:
+        return [self[key] for key in self.keys()]
+
+    def items(self) -> List[Tuple[str, Any]]:
+        return [(key, self[key]) for key in self.keys()]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.keys())
+
+    def __len__(self) -> int:
+        return len(self.keys())
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Bản dict thuần (có thể json.dumps), list thay cho tuple."""
+        return {key: _plain(value) for key, value in self.items()}
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, (_Record, dict)):
+            return self.to_dict() == (other.to_dict() if isinstance(other, _Record) else other)
+        return NotImplemented
+
+    __hash__ = None  # type: ignore[assignment]
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+
+def _plain(value: Any) -> Any:
+    if isinstance(value, _Record):
+        return value.to_dict()
+    if isinstance(value, tuple):
+        return [_plain(v) for v in value]
+    return value
+
+
+class IngredientRecord(_Record):
+    """Một dòng của ingredient_knowledge_base.json."""
+
+    __slots__ = ("id", "name_vi", "name_normalized", "name_en", "category", "synonyms", "type")
+    _FIELDS = __slots__
+    _FIELD_SET = frozenset(_FIELDS)
+
+    def __init__(
+        self, id=_MISSING, name_vi=_MISSING, name_normalized=_MISSING, name_en=_MISSING,
+        category=_MISSING, synonyms=_MISSING, type=_MISSING, _extra=None,
+    ) -> None:
+        self.id = id
+        self.name_vi = name_vi
+        self.name_normalized = name_normalized
+        self.name_en = name_en
+        self.category = category
+        self.synonyms = synonyms
+        self.type = type
+        self._extra = _extra
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "IngredientRecord":
+        get = data.get
+        synonyms = get("synonyms", _MISSING)
+        if isinstance(synonyms, list):
+            synonyms = tuple(map(_intern, synonyms))
+        return cls(
+            _intern(get("id", _MISSING)),
+            _intern(get("name_vi", _MISSING)),
+            _intern(get("name_normalized", _MISSING)),
+            get("name_en", _MISSING),
+            _intern(get("category", _MISSING)),
+            synonyms,
+            _intern(get("type", _MISSING)),
+            cls._extra_fields(data),
+        )
+
+
+class DishIngredientRecord(_Record):
+    """Một nguyên liệu trong món (dish["ingredients"][i])."""
+
+    __slots__ = ("ingredient_id", "name_vi", "importance", "category", "quantity", "unit")
+    _FIELDS = __slots__
+    _FIELD_SET = frozenset(_FIELDS)
+
+    def __init__(
+        self, ingredient_id=_MISSING, name_vi=_MISSING, importance=_MISSING,
+        category=_MISSING, quantity=_MISSING, unit=_MISSING, _extra=None,
+    ) -> None:
+        self.ingredient_id = ingredient_id
+        self.name_vi = name_vi
+        self.importance = importance
+        self.category = category
+        self.quantity = quantity
+        self.unit = unit
+        self._extra = _extra
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "DishIngredientRecord":
+        get = data.get
+        return cls(
+            _intern(get("ingredient_id", _MISSING)),
+            _intern(get("name_vi", _MISSING)),
+            get("importance", _MISSING),
+            _intern(get("category", _MISSING)),
+            _intern(get("quantity", _MISSING)),
+            _intern(get("unit", _MISSING)),
+            cls._extra_fields(data),
+        )
+
+
+class DishRecord(_Record):
+    """Một dòng của dish_knowledge_base.json."""
+
+    __slots__ = ("id", "name_vi", "ingredients", "instructions")
+    _FIELDS = __slots__
+    _FIELD_SET = frozenset(_FIELDS)
+
+    def __init__(
+        self, id=_MISSING, name_vi=_MISSING, ingredients=_MISSING, instructions=_MISSING,
+        _extra=None,
+    ) -> None:
+        self.id = id
+        self.name_vi = name_vi
+        self.ingredients = ingredients
+        self.instructions = instructions
+        self._extra = _extra
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "DishRecord":
+        get = data.get
+        ingredients = get("ingredients", _MISSING)
+        if isinstance(ingredients, list):
+            ingredients = tuple(
+                DishIngredientRecord.from_dict(item) if isinstance(item, dict) else item
+                for item in ingredients
+            )
+        return cls(
+            _intern(get("id", _MISSING)),
+            get("name_vi", _MISSING),
+            ingredients,
+            get("instructions", _MISSING),
+            cls._extra_fields(data),
+        )
+
+
+__all__ = ["IngredientRecord", "DishIngredientRecord", "DishRecord"]
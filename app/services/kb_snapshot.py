@@ -0,0 +1,184 @@
+from __future__ import annotations
+
+import gc
+import hashlib
+import json
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+from datetime import datetime
+from pathlib import Path
+from collections.abc import Mapping
+from typing import Dict, Iterable, NamedTuple, Optional
+
+import numpy as np
+
+from app.services.kb_columns import NotColumnar, StringTable, StringTableBuilder, encode_records, record_table
+
+logger = logging.getLogger("ai_service.kb_snapshot")
+
+#: Tăng khi định dạng thư mục snapshot thay đổi
+SNAPSHOT_FORMAT = 2
+
+_MANIFEST = "manifest.json"
+_OBJECTS = "objects.pkl"
+_TABLES = "_tables"
+_STRINGS = "strings"
+
+
+class KBSnapshot(NamedTuple):
+    manifest: Dict[str, object]
+    objects: Dict[str, object]
+    arrays: Dict[str, Dict[str, np.ndarray]]
+    #: Bảng bản ghi theo cột (Mapping id -> bản ghi, dựng lười trên mảng mmap)
+    tables: Dict[str, Mapping]
+
+
+def source_hashes(kb_path: Path, filenames: Iterable[str]) -> Dict[str, str]:
+    """sha1 nội dung từng file nguồn JSON, dùng để phát hiện snapshot cũ."""
+    return {
+        name: hashlib.sha1((Path(kb_path) / name).read_bytes()).hexdigest()
+        for name in filenames
+    }
+
+
+def write_snapshot(
+    snapshot_dir: Path,
+    sources: Dict[str, str],
+    builder_version: str,
+    objects: Dict[str, object],
+    arrays: Dict[str, Dict[str, np.ndarray]],
+    tables: Optional[Dict[str, Mapping]] = None,
+) -> Path:
+    """
+    Ghi snapshot vào snapshot_dir:
+    - manifest.json: phiên bản định dạng / builder, hash các file nguồn;
+    - strings.*.npy + table_<tên>.*.npy: bảng bản ghi (tables) dạng cột trên một bảng
+      chuỗi chung, đọc lại bằng mmap; bảng không mã hoá được theo cột thì vào pickle;
+    - objects.pkl: các index Python còn lại (postings, tra cứu tên...) + schema bảng;
+    - <nhóm>.<tên>.npy: mảng numpy (ma trận thưa...), đọc lại bằng mmap.
+
+    Ghi vào thư mục tạm rồi đổi tên nên worker đang đọc không thấy snapshot dở dang.
+    """
+    snapshot_dir = Path(snapshot_dir)
+    snapshot_dir.parent.mkdir(parents=True, exist_ok=True)
+    tmp_dir = Path(tempfile.mkdtemp(prefix=f".{snapshot_dir.name}-", dir=snapshot_dir.parent))
+    try:
+        # mkdtemp tạo thư mục 0700; snapshot phải đọc được bởi mọi worker
+        os.chmod(tmp_dir, 0o755)
+        arrays = dict(arrays)
+        objects = {**objects, _TABLES: _encode_tables(tables or {}, arrays)}
+        files = []
+        for group, group_arrays in arrays.items():
+            for name, array in group_arrays.items():
+                filename = f"{group}.{name}.npy"
+                np.save(tmp_dir / filename, np.asarray(array), allow_pickle=False)
+                files.append(filename)
+
+        with open(tmp_dir / _OBJECTS, "wb") as f:
+            pickle.dump(objects, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        manifest = {
+            "format": SNAPSHOT_FORMAT,
+            "builder_version": builder_version,
+            "sources": sources,
+            "arrays": sorted(files),
+            "created_at": datetime.now().isoformat(),
+        }
+        with open(tmp_dir / _MANIFEST, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+        old_dir = None
+        if snapshot_dir.exists():
+            old_dir = snapshot_dir.with_name(f".{snapshot_dir.name}-old-{os.getpid()}")
+            os.replace(snapshot_dir, old_dir)
+        os.replace(tmp_dir, snapshot_dir)
+        if old_dir is not None:
+            shutil.rmtree(old_dir, ignore_errors=True)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return snapshot_dir
+
+
+def _encode_tables(tables: Dict[str, Mapping], arrays: Dict[str, Dict[str, np.ndarray]]) -> Dict[str, object]:
+    strings = StringTableBuilder()
+    encoded: Dict[str, object] = {}
+    for name, records in tables.items():
+        try:
+            schema, columns = encode_records(list(records.values()), strings)
+        except NotColumnar as e:
+            logger.warning(f"KB table {name} is not columnar ({e}), storing it in the pickle")
+            encoded[name] = {"records": dict(records)}
+            continue
+        arrays[f"table_{name}"] = columns
+        encoded[name] = {"keys": list(records), "schema": schema}
+    arrays[_STRINGS] = strings.to_arrays()
+    return encoded
+
+
+def _decode_tables(encoded: Dict[str, object], arrays: Dict[str, Dict[str, np.ndarray]]) -> Dict[str, Mapping]:
+    strings = StringTable(arrays[_STRINGS])
+    tables: Dict[str, Mapping] = {}
+    for name, entry in encoded.items():
+        if "records" in entry:
+            tables[name] = entry["records"]
+        else:
+            tables[name] = record_table(entry["keys"], entry["schema"], arrays.get(f"table_{name}", {}), strings)
+    return tables
+
+
+def read_snapshot(
+    snapshot_dir: Path,
+    sources: Dict[str, str],
+    builder_version: str,
+) -> Optional[KBSnapshot]:
+    """
+    Đọc snapshot nếu còn khớp với file nguồn và phiên bản builder; ngược lại
+    trả về None để caller dựng lại từ JSON. Mảng (kể cả bảng bản ghi) được mở bằng
+    mmap chỉ đọc; bản ghi chỉ được dựng thành object Python khi truy cập.
+    Snapshot là artifact build nội bộ (pickle) — không đọc từ nguồn không tin cậy.
+    """
+    snapshot_dir = Path(snapshot_dir)
+    manifest_path = snapshot_dir / _MANIFEST
+    if not manifest_path.exists():
+        return None
+
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if (
+            manifest.get("format") != SNAPSHOT_FORMAT
+            or manifest.get("builder_version") != builder_version
+            or manifest.get("sources") != sources
+        ):
+            logger.info(f"KB snapshot at {snapshot_dir} is stale, falling back to JSON")
+            return None
+
+        arrays: Dict[str, Dict[str, np.ndarray]] = {}
+        for filename in manifest.get("arrays", []):
+            group, name, _ = filename.split(".")
+            arrays.setdefault(group, {})[name] = np.load(
+                snapshot_dir / filename, mmap_mode="r", allow_pickle=False
+            )
+
+        # Tắt GC khi unpickle hàng trăm nghìn object nhỏ (nhanh hơn đáng kể)
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            with open(snapshot_dir / _OBJECTS, "rb") as f:
+                objects = pickle.load(f)
+        finally:
+            if gc_enabled:
+                gc.enable()
+        tables = _decode_tables(objects.pop(_TABLES, {}), arrays)
+    except Exception as e:
+        logger.warning(f"KB snapshot at {snapshot_dir} unreadable, falling back to JSON: {e}")
+        return None
+
+    return KBSnapshot(manifest, objects, arrays, tables)
+
+
+__all__ = ["KBSnapshot", "SNAPSHOT_FORMAT", "read_snapshot", "source_hashes", "write_snapshot"]
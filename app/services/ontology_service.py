@@ -1,6 +1,19 @@
+import heapq
 import json
+import os
+from collections import Counter
 from pathlib import Path
-from typing import Dict, Iterable, List, Optional, Set
+from typing import Dict, FrozenSet, Iterable, List, Optional, Set
+
+from app.services.dish_matrix import DishMatrix
+from app.services.ingredient_index import IngredientIndex, IngredientMatch
+from app.services.kb_columns import LazyList, LazyMapping
+from app.services.kb_records import DishRecord, IngredientRecord
+from app.services.kb_snapshot import KBSnapshot, read_snapshot, source_hashes, write_snapshot
+from app.services.resolution_cache import ResolutionCache
+from app.utils.minhash import MinHashLSH
+from app.utils.ngram_index import NgramIndex
+from app.utils.text_match import FuzzyScorer, PreparedText, norm_text, prepare_text
 
 class OntologyService:
     _instance = None
@@ -45,6 +58,21 @@ class OntologyService:
 
     _PRIMARY_ROLES: Set[str] = {"core_protein", "core_produce", "core_staple"}
     _ROLE_COVERAGE_THRESHOLD: float = 0.5
+    _RESOLUTION_CACHE_PATH = "app/data/cache/ingredient_resolution.sqlite"
+    _KB_FILES = ("ingredient_knowledge_base.json", "dish_knowledge_base.json")
+    _SNAPSHOT_PATH = "app/data/snapshot"
+    #: Tăng khi cấu trúc dựng sẵn lưu trong snapshot thay đổi
+    _SNAPSHOT_VERSION = 3
+    #: Bản ghi nguyên liệu / món lưu dạng cột (kb_columns); profile và tên món đã
+    #: chuẩn bị sẵn cho fuzzy được dựng lười từ bản ghi
+    _SNAPSHOT_TABLES = ("ingredients", "dishes")
+    _SNAPSHOT_FIELDS = (
+        "_dish_ids", "_dish_ingredient_counts", "_dish_postings", "_dish_by_lower",
+        "_dish_by_key", "_dish_name_ids", "dish_categories",
+    )
+    #: Ngưỡng fuzzy_score khi tra tên món không khớp chính xác (sai dấu, gõ nhầm)
+    _DISH_NAME_FUZZY_THRESHOLD: float = 0.85
+    _DISH_NAME_SHORTLIST_SIZE: int = 16
     
     def __new__(cls):
         if not cls._instance:
@@ -64,18 +92,140 @@ class OntologyService:
         # with open(path / "dish_knowledge_base.json", 'r', encoding='utf-8') as f:
         #     self.dishes = {d['id']: d for d in json.load(f)}
 
+        sources = source_hashes(path, self._KB_FILES)
+        cache = self._build_resolution_cache(sources["ingredient_knowledge_base.json"])
+
+        # Snapshot đã biên dịch (app/scripts/compile_kb.py) -> bỏ qua parse JSON + dựng index
+        snapshot_dir = os.getenv("KB_SNAPSHOT_PATH", self._SNAPSHOT_PATH)
+        snapshot = (
+            read_snapshot(Path(snapshot_dir), sources, self._snapshot_builder_version())
+            if snapshot_dir
+            else None
+        )
+        if snapshot is not None:
+            self._restore_snapshot(snapshot, cache)
+        else:
+            self._build_from_json(path, cache)
+        self._kb_sources = sources
+
+        self._dish_matrix: Optional[DishMatrix] = None
+
+        # MinHash/LSH: bộ sinh ứng viên xấp xỉ cho search_similar_dishes (tắt mặc định)
+        self._dish_lsh: Optional[MinHashLSH] = None
+        self._lsh_enabled = os.getenv("SIMILAR_DISHES_LSH", "").lower() in {"1", "true", "yes"}
+        if self._lsh_enabled:
+            self._build_dish_lsh()
+        
+        self._initialized = True
+
+    def _build_from_json(self, path: Path, cache: ResolutionCache) -> None:
+        # Bản ghi gọn (__slots__, chuỗi intern) thay cho dict JSON, API đọc giữ nguyên
         with open(path / "ingredient_knowledge_base.json", "r", encoding="utf-8") as f:
-            self.ingredients = {ing["id"]: ing for ing in json.load(f)}
+            self.ingredients: Dict[str, IngredientRecord] = {
+                rec.id: rec for rec in map(IngredientRecord.from_dict, json.load(f))
+            }
+
+        self.ingredient_index = IngredientIndex(self.ingredients, cache=cache)
 
         with open(path / "dish_knowledge_base.json", "r", encoding="utf-8") as f:
-            self.dishes = {d["id"]: d for d in json.load(f)}
+            self.dishes: Dict[str, DishRecord] = {
+                rec.id: rec for rec in map(DishRecord.from_dict, json.load(f))
+            }
 
         self.dish_profiles: Dict[str, Dict[str, object]] = {}
         for dish_id, dish in self.dishes.items():
             profile = self._build_dish_profile(dish)
             self.dish_profiles[dish_id] = profile
-        
-        self._initialized = True
+
+        self._build_dish_postings()
+        self._build_dish_name_index()
+
+    @classmethod
+    def _snapshot_builder_version(cls) -> str:
+        return f"{cls._SNAPSHOT_VERSION}:resolver-v{IngredientIndex.RESOLVER_VERSION}"
+
+    def _restore_snapshot(self, snapshot: KBSnapshot, cache: ResolutionCache) -> None:
+        objects = snapshot.objects
+        for table in self._SNAPSHOT_TABLES:
+            setattr(self, table, snapshot.tables[table])
+        for field in self._SNAPSHOT_FIELDS:
+            setattr(self, field, objects["ontology"][field])
+        self.dish_profiles = LazyMapping(
+            self._dish_ids, lambda pos: self._build_dish_profile(self.dishes[self._dish_ids[pos]])
+        )
+        self._dish_name_texts = LazyList(
+            len(self._dish_name_ids),
+            lambda pos: prepare_text(self.dishes[self._dish_name_ids[pos]].get("name_vi", "")),
+        )
+        self._dish_name_ngrams = NgramIndex.from_arrays(snapshot.arrays["dish_name_ngrams"])
+        self.ingredient_index = IngredientIndex.from_snapshot(
+            objects["ingredient_index"], snapshot.arrays, self.ingredients, cache=cache
+        )
+
+    def materialize(self) -> None:
+        """
+        Dựng trước mọi bản ghi / profile / tên được dựng lười khi load từ snapshot.
+        Gọi ở master trước khi fork worker (preload) để các worker dùng chung.
+        """
+        for lazy in (self.ingredients, self.dishes, self.dish_profiles, self._dish_name_texts):
+            if isinstance(lazy, (LazyMapping, LazyList)):
+                lazy.materialize()
+        self.ingredient_index.materialize()
+
+    def write_snapshot(self, snapshot_dir: Optional[str] = None) -> Path:
+        """Ghi KB đã dựng (bản ghi, profile, các index) thành snapshot nhị phân."""
+        index_objects, index_arrays = self.ingredient_index.to_snapshot()
+        return write_snapshot(
+            Path(snapshot_dir or os.getenv("KB_SNAPSHOT_PATH") or self._SNAPSHOT_PATH),
+            self._kb_sources,
+            self._snapshot_builder_version(),
+            objects={
+                "ontology": {field: getattr(self, field) for field in self._SNAPSHOT_FIELDS},
+                "ingredient_index": index_objects,
+            },
+            arrays={**index_arrays, "dish_name_ngrams": self._dish_name_ngrams.to_arrays()},
+            tables={table: getattr(self, table) for table in self._SNAPSHOT_TABLES},
+        )
+
+    def _build_resolution_cache(self, kb_hash: str) -> ResolutionCache:
+        # RESOLUTION_CACHE_PATH="" -> chỉ dùng LRU trong process
+        db_path = os.getenv("RESOLUTION_CACHE_PATH", self._RESOLUTION_CACHE_PATH)
+        max_size = int(os.getenv("RESOLUTION_CACHE_SIZE", "10000"))
+        return ResolutionCache(
+            kb_version=f"{kb_hash}:v{IngredientIndex.RESOLVER_VERSION}",
+            max_size=max_size,
+            db_path=db_path or None,
+        )
+
+    def _build_dish_postings(self) -> None:
+        """
+        Inverted index ingredient_id -> [vị trí món] (theo thứ tự trong KB).
+        Mỗi món chỉ xuất hiện một lần trong posting list của mỗi nguyên liệu.
+        """
+        self._dish_ids: List[str] = []
+        self._dish_ingredient_counts: List[int] = []
+        self._dish_postings: Dict[str, List[int]] = {}
+        for pos, (dish_id, dish) in enumerate(self.dishes.items()):
+            dish_ings = [i["ingredient_id"] for i in dish.get("ingredients", [])]
+            self._dish_ids.append(dish_id)
+            self._dish_ingredient_counts.append(len(dish_ings))
+            for ing_id in set(dish_ings):
+                self._dish_postings.setdefault(ing_id, []).append(pos)
+
+    @property
+    def dish_lsh(self) -> MinHashLSH:
+        """Index MinHash/LSH trên tập nguyên liệu của từng món (dựng lười)."""
+        if self._dish_lsh is None:
+            self._build_dish_lsh()
+        return self._dish_lsh
+
+    def _build_dish_lsh(self) -> None:
+        self._dish_lsh = MinHashLSH(
+            [profile.get("importance_map", {}) for profile in
+             (self.dish_profiles.get(dish_id, {}) for dish_id in self._dish_ids)],
+            bands=int(os.getenv("SIMILAR_DISHES_LSH_BANDS", "32")),
+            rows=int(os.getenv("SIMILAR_DISHES_LSH_ROWS", "2")),
+        )
 
     def _build_dish_profile(self, dish: dict) -> Dict[str, object]:
         ingredients = dish.get("ingredients", [])
@@ -125,88 +275,228 @@ class OntologyService:
             .get(ing_id, 1)
         )
     
-    def get_ingredient(self, ing_id: str) -> dict:
+    def get_ingredient(self, ing_id: str) -> Optional[IngredientRecord]:
         return self.ingredients.get(ing_id)
     
-    def get_dish(self, dish_id: str) -> dict:
+    def get_dish(self, dish_id: str) -> Optional[DishRecord]:
         return self.dishes.get(dish_id)
+
+    def resolve_ingredient_id(self, name: str) -> Optional[str]:
+        return self.ingredient_index.resolve(name)
+
+    def resolve_many(self, names: Iterable[str]) -> List[IngredientMatch]:
+        return self.ingredient_index.resolve_many(list(names))
+
+    def resolution_stats(self) -> Dict[str, object]:
+        stats = self.ingredient_index.stats()
+        if self.ingredient_index.cache is not None:
+            stats["cache"] = self.ingredient_index.cache.stats()
+        return stats
     
     def search_similar_dishes(
         self,
         ing_ids: Iterable[str],
         min_match: int = 2,
         role_coverage_threshold: Optional[float] = None,
+        top_k: Optional[int] = None,
+        approximate: Optional[bool] = None,
     ) -> List[dict]:
-        matches: List[dict] = []
+        """
+        Tìm món có chung ít nhất min_match nguyên liệu với giỏ, sắp theo
+        (weighted_score, match_ratio, match_count) giảm dần; món hoà điểm giữ
+        thứ tự trong KB. top_k=None trả về toàn bộ danh sách.
+
+        approximate=True lấy ứng viên từ MinHash/LSH thay vì posting list (mặc
+        định theo SIMILAR_DISHES_LSH); ứng viên vẫn được chấm chính xác nên chỉ
+        recall bị ảnh hưởng.
+        """
         ing_ids_set = set(ing_ids)
         threshold = (
             role_coverage_threshold
             if role_coverage_threshold is not None
             else self._ROLE_COVERAGE_THRESHOLD
         )
-        
-        for dish_id, dish in self.dishes.items():
-            dish_ings = [i["ingredient_id"] for i in dish.get("ingredients", [])]
-            if not dish_ings:
-                continue
+        if approximate is None:
+            approximate = self._lsh_enabled
 
-            matched = ing_ids_set & set(dish_ings)
-            if len(matched) < min_match:
-                continue
+        if approximate:
+            candidates = [
+                pos
+                for pos in sorted(self.dish_lsh.query(ing_ids_set))
+                if len(ing_ids_set.intersection(
+                    self.dish_profiles[self._dish_ids[pos]]["importance_map"]
+                )) >= min_match
+            ]
+        elif min_match > 0:
+            # Chỉ chấm các món có chung nguyên liệu với giỏ (qua posting list)
+            hit_counts: Counter = Counter()
+            for ing_id in ing_ids_set:
+                hit_counts.update(self._dish_postings.get(ing_id, ()))
+            candidates = sorted(pos for pos, n in hit_counts.items() if n >= min_match)
+        else:
+            candidates = range(len(self._dish_ids))
 
-            profile = self.dish_profiles.get(dish_id, {})
-            total_importance = profile.get("total_importance", 0)
-            matched_importance = sum(
-                self._get_importance(dish_id, ing_id) for ing_id in matched
-            )
-            weighted_score = (
-                matched_importance / total_importance
-                if total_importance
-                else 0
+        matches = (
+            match
+            for match in (
+                self._score_dish_match(pos, ing_ids_set, threshold) for pos in candidates
             )
+            if match is not None
+        )
+        sort_key = lambda x: (x["weighted_score"], x["match_ratio"], x["match_count"])
+        if top_k is not None:
+            # heapq.nlargest ổn định như sorted(..., reverse=True)[:top_k]
+            return heapq.nlargest(top_k, matches, key=sort_key)
+        return sorted(matches, key=sort_key, reverse=True)
 
-            required_roles = profile.get("required_roles", set())
-            role_map = profile.get("role_map", {})
-            matched_roles = {role_map[ing_id] for ing_id in matched if ing_id in role_map}
-            coverage = (
-                len(matched_roles & required_roles) / len(required_roles)
-                if required_roles
-                else 1
-            )
+    @staticmethod
+    def _dish_name_key(name: str) -> str:
+        return " ".join(norm_text(name).split())
+
+    def _build_dish_name_index(self) -> None:
+        """
+        Index tên món: dict lower-case (khớp như bản cũ), dict bỏ dấu, và index
+        trigram trên tên bỏ dấu cho tên gần đúng. Trùng tên -> giữ món đầu tiên
+        trong KB. Đồng thời tính sẵn tập category nguyên liệu của từng món.
+        """
+        self._dish_by_lower: Dict[str, str] = {}
+        self._dish_by_key: Dict[str, str] = {}
+        for dish_id, dish in self.dishes.items():
+            name = dish.get("name_vi", "")
+            self._dish_by_lower.setdefault(name.lower(), dish_id)
+            key = self._dish_name_key(name)
+            if key:
+                self._dish_by_key.setdefault(key, dish_id)
+
+        self._dish_name_ids: List[str] = list(self._dish_by_key.values())
+        self._dish_name_texts: List[PreparedText] = [
+            prepare_text(self.dishes[dish_id].get("name_vi", ""))
+            for dish_id in self._dish_name_ids
+        ]
+        self._dish_name_ngrams = NgramIndex(list(self._dish_by_key))
+
+        self.dish_categories: Dict[str, FrozenSet[str]] = {}
+        for dish_id, dish in self.dishes.items():
+            cats: Set[str] = set()
+            for it in dish.get("ingredients", []):
+                ing_data = self.ingredients.get(it.get("ingredient_id"))
+                if ing_data and ing_data.get("category"):
+                    cats.add(ing_data["category"])
+            self.dish_categories[dish_id] = frozenset(cats)
 
-            if coverage < threshold:
-                continue
-
-            matches.append(
-                {
-                    "dish_id": dish_id,
-                    "dish_name": dish.get("name_vi", "Unknown"),
-                    "match_count": len(matched),
-                    "match_ratio": len(matched) / len(dish_ings),
-                    "weighted_score": weighted_score,
-                    "matched_roles": sorted(matched_roles),
-                    "required_roles": sorted(required_roles),
-                    "role_coverage": coverage,
-                }
+    def find_dish_id(self, name: str, fuzzy: bool = False) -> Optional[str]:
+        """
+        Tra id món theo tên: khớp lower-case, rồi khớp bỏ dấu, rồi (chỉ khi fuzzy=True)
+        tên gần nhất có fuzzy_score >= _DISH_NAME_FUZZY_THRESHOLD.
+        """
+        dish_id = self._dish_by_lower.get(name.lower())
+        if dish_id is not None:
+            return dish_id
+
+        key = self._dish_name_key(name)
+        dish_id = self._dish_by_key.get(key)
+        if dish_id is not None or not fuzzy or not key:
+            return dish_id
+
+        scorer = FuzzyScorer(key)
+        best, best_pos = self._DISH_NAME_FUZZY_THRESHOLD, None
+        for pos in sorted(self._dish_name_ngrams.top_k(key, self._DISH_NAME_SHORTLIST_SIZE)):
+            score = scorer.score_if_better(self._dish_name_texts[pos], best)
+            if score is not None and (score > best or best_pos is None):
+                best, best_pos = score, pos
+        return self._dish_name_ids[best_pos] if best_pos is not None else None
+
+    def get_dish_categories(self, name: str) -> FrozenSet[str]:
+        """Tập category nguyên liệu của món (rỗng nếu không tìm thấy món)."""
+        dish_id = self.find_dish_id(name)
+        return self.dish_categories.get(dish_id, frozenset()) if dish_id else frozenset()
+
+    @property
+    def dish_matrix(self) -> DishMatrix:
+        """Engine ma trận thưa (dựng lười khi cần, dùng cho các job batch)."""
+        if self._dish_matrix is None:
+            self._dish_matrix = DishMatrix(
+                self._dish_ids, self._dish_ingredient_counts, self.dish_profiles
             )
+        return self._dish_matrix
 
-        matches.sort(
-            key=lambda x: (
-                x["weighted_score"],
-                x["match_ratio"],
-                x["match_count"],
-            ),
-            reverse=True,
+    def search_similar_dishes_batch(
+        self,
+        carts: List[Iterable[str]],
+        min_match: int = 2,
+        role_coverage_threshold: Optional[float] = None,
+        top_k: Optional[int] = None,
+    ) -> List[List[dict]]:
+        """
+        Bản batch của search_similar_dishes cho nhiều giỏ cùng lúc (job offline):
+        kết quả của từng giỏ giống hệt gọi search_similar_dishes riêng lẻ.
+        """
+        threshold = (
+            role_coverage_threshold
+            if role_coverage_threshold is not None
+            else self._ROLE_COVERAGE_THRESHOLD
+        )
+        cart_sets = [set(cart) for cart in carts]
+        ranked = self.dish_matrix.top_k_many(cart_sets, min_match, threshold, top_k)
+        return [
+            [self._score_dish_match(pos, cart, threshold) for pos in positions]
+            for cart, positions in zip(cart_sets, ranked)
+        ]
+
+    def _score_dish_match(
+        self,
+        pos: int,
+        ing_ids_set: Set[str],
+        threshold: float,
+    ) -> Optional[dict]:
+        ingredient_count = self._dish_ingredient_counts[pos]
+        if not ingredient_count:
+            return None
+
+        dish_id = self._dish_ids[pos]
+        dish = self.dishes[dish_id]
+        profile = self.dish_profiles.get(dish_id, {})
+        importance_map = profile.get("importance_map", {})
+        matched = ing_ids_set.intersection(importance_map)
+
+        total_importance = profile.get("total_importance", 0)
+        matched_importance = sum(int(importance_map.get(ing_id, 1)) for ing_id in matched)
+        weighted_score = (
+            matched_importance / total_importance
+            if total_importance
+            else 0
         )
-        return matches
+
+        required_roles = profile.get("required_roles", set())
+        role_map = profile.get("role_map", {})
+        matched_roles = {role_map[ing_id] for ing_id in matched if ing_id in role_map}
+        coverage = (
+            len(matched_roles & required_roles) / len(required_roles)
+            if required_roles
+            else 1
+        )
+
+        if coverage < threshold:
+            return None
+
+        return {
+            "dish_id": dish_id,
+            "dish_name": dish.get("name_vi", "Unknown"),
+            "match_count": len(matched),
+            "match_ratio": len(matched) / ingredient_count,
+            "weighted_score": weighted_score,
+            "matched_roles": sorted(matched_roles),
+            "required_roles": sorted(required_roles),
+            "role_coverage": coverage,
+        }
     
-    def get_dish_by_name(self, name: str) -> dict:
-        name_lower = name.lower()
-        for dish_id, dish in self.dishes.items():
-            if dish.get('name_vi', '').lower() == name_lower:
-                return {
-                    'dish_name': dish.get('name_vi'),
-                    'ingredients': dish.get('ingredients', []),  # Dùng trực tiếp, đã có quantity/unit
-                    'instructions': dish.get('instructions', '')
-                }
-        return None
\ No newline at end of file
+    def get_dish_by_name(self, name: str, fuzzy: bool = False) -> dict:
+        dish_id = self.find_dish_id(name, fuzzy=fuzzy)
+        if dish_id is None:
+            return None
+        dish = self.dishes[dish_id]
+        return {
+            'dish_name': dish.get('name_vi'),
+            'ingredients': [it.to_dict() for it in dish.get('ingredients', [])],  # đã có quantity/unit
+            'instructions': dish.get('instructions', '')
+        }
\ No newline at end of file
@@ -0,0 +1,59 @@
+"""
+Preload dữ liệu chỉ đọc trong process master trước khi fork worker.
+
+Các singleton (OntologyService, ValidationService) được dựng một lần ở master;
+worker fork ra dùng chung các trang bộ nhớ đó theo copy-on-write. gc.freeze()
+chuyển toàn bộ object hiện có sang thế hệ permanent nên các lần GC trong worker
+không duyệt (và không ghi vào header của) chúng — trang bộ nhớ không bị copy.
+Mảng numpy của KB snapshot được mmap nên dùng chung qua page cache kể cả khi
+worker được spawn thay vì fork.
+
+ShoppingCartPipeline gọi preload_services() khi khởi tạo, nên server tạo pipeline
+ở cấp module (vd. gunicorn --preload) sẽ preload ngay trong master. gc.freeze() chỉ
+chạy khi bật PRELOAD_GC_FREEZE (đặt cho master sắp fork): object bị freeze không bao
+giờ được GC thu hồi, nên với một process (test_rag.py, uvicorn không preload) mỗi lần
+nạp lại KB (vd. ValidationService reload nền) sẽ giữ lại thế hệ cũ.
+"""
+import gc
+import logging
+import os
+from typing import Optional
+
+logger = logging.getLogger("ai_service.preload")
+
+_preloaded = False
+
+
+def preload_services(freeze: Optional[bool] = None, materialize: Optional[bool] = None) -> None:
+    """
+    Dựng trước các service dữ liệu lớn (một lần mỗi process); gọi ở master trước khi
+    fork worker. freeze / materialize mặc định theo PRELOAD_GC_FREEZE và
+    PRELOAD_MATERIALIZE (cùng tắt: chỉ dựng service như khi không preload).
+    """
+    global _preloaded
+    if _preloaded:
+        return
+
+    from app.services.ontology_service import OntologyService
+    from app.services.validation_service import ValidationService
+
+    ontology = OntologyService()
+    ValidationService()
+    _preloaded = True
+
+    if materialize is None:
+        materialize = os.getenv("PRELOAD_MATERIALIZE", "").lower() in {"1", "true", "yes"}
+    if materialize:
+        # Bản ghi/profile đọc từ snapshot được dựng lười -> dựng hết ở master để worker
+        # fork ra dùng chung; worker spawn/một process thì để lười (khởi động nhanh hơn)
+        ontology.materialize()
+
+    if freeze is None:
+        freeze = os.getenv("PRELOAD_GC_FREEZE", "").lower() in {"1", "true", "yes"}
+    if freeze and hasattr(gc, "freeze"):
+        gc.collect()
+        gc.freeze()
+        logger.info(f"Preloaded services, froze {gc.get_freeze_count()} objects")
+
+
+__all__ = ["preload_services"]
@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+import logging
+import os
+import sqlite3
+import weakref
+from pathlib import Path
+from threading import Lock
+from typing import Dict, Iterable, Optional
+
+from app.services.ingredient_index import IngredientMatch
+from app.utils.cache import LRUCache
+
+logger = logging.getLogger("ai_service.resolution_cache")
+
+
+class ResolutionCache:
+    """
+    Cache tên đã chuẩn hoá -> kết quả resolve nguyên liệu.
+
+    Hai tầng: LRU trong process (giới hạn max_size) và một file SQLite tuỳ chọn
+    dùng chung giữa các worker. Mỗi bản ghi gắn với kb_version (hash của
+    ingredient_knowledge_base.json + tham số resolver); khi version đổi, các
+    bản ghi cũ bị xoá lúc mở cache. Worker mới nạp sẵn tối đa max_size bản ghi
+    từ SQLite nên khởi động "ấm".
+    """
+
+    def __init__(
+        self,
+        kb_version: str,
+        max_size: int = 10000,
+        db_path: Optional[str | Path] = None,
+    ) -> None:
+        self.kb_version = kb_version
+        self._memory = LRUCache(max_size)
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = Lock()
+        self._db_path = Path(db_path) if db_path else None
+        self._inherited_db: Optional[sqlite3.Connection] = None
+
+        if self._db_path:
+            self._open(self._db_path)
+            # Kết nối SQLite không được dùng chung qua fork (worker preload từ master)
+            if hasattr(os, "register_at_fork"):
+                after_fork = weakref.WeakMethod(self._reopen_after_fork)
+                os.register_at_fork(after_in_child=lambda: after_fork() and after_fork()())
+
+    def _reopen_after_fork(self) -> None:
+        # Giữ tham chiếu kết nối của process cha để không bị đóng (finalize) trong con.
+        # Lock của LRU trong process được app.utils.cache tạo lại sau fork
+        self._inherited_db, self._db = self._db, None
+        self._db_lock = Lock()
+        if self._db_path and self._inherited_db is not None:
+            self._open(self._db_path, preload=False)
+
+    def _open(self, db_path: Path, preload: bool = True) -> None:
+        try:
+            db_path.parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(str(db_path), timeout=5.0, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS resolutions ("
+                " kb_version TEXT NOT NULL,"
+                " name TEXT NOT NULL,"
+                " ingredient_id TEXT,"
+                " score REAL NOT NULL,"
+                " stage TEXT,"
+                " exact INTEGER NOT NULL DEFAULT 0,"
+                " PRIMARY KEY (kb_version, name))"
+            )
+            # Invalidate: KB hoặc resolver đổi -> bỏ toàn bộ kết quả cũ
+            db.execute("DELETE FROM resolutions WHERE kb_version != ?", (self.kb_version,))
+            db.commit()
+            rows = db.execute(
+                "SELECT name, ingredient_id, score, stage, exact FROM resolutions"
+                " WHERE kb_version = ? ORDER BY rowid DESC LIMIT ?",
+                (self.kb_version, self._memory.max_size if preload else 0),
+            ).fetchall()
+        except sqlite3.Error as e:
+            logger.warning(f"Resolution cache disabled ({db_path}): {e}")
+            return
+
+        self._db = db
+        for name, ing_id, score, stage, exact in reversed(rows):
+            self._memory.put(name, IngredientMatch(ing_id, score, stage, bool(exact)))
+
+    def get_many(self, names: Iterable[str]) -> Dict[str, IngredientMatch]:
+        found: Dict[str, IngredientMatch] = {}
+        missing = []
+        for name in names:
+            match = self._memory.get(name)
+            if match is not None:
+                found[name] = match
+            else:
+                missing.append(name)
+
+        if missing and self._db is not None:
+            placeholders = ",".join("?" * len(missing))
+            try:
+                with self._db_lock:
+                    rows = self._db.execute(
+                        "SELECT name, ingredient_id, score, stage, exact FROM resolutions"
+                        f" WHERE kb_version = ? AND name IN ({placeholders})",
+                        (self.kb_version, *missing),
+                    ).fetchall()
+            except sqlite3.Error as e:
+                logger.warning(f"Resolution cache read failed: {e}")
+                rows = []
+            for name, ing_id, score, stage, exact in rows:
+                match = IngredientMatch(ing_id, score, stage, bool(exact))
+                self._memory.put(name, match)
+                found[name] = match
+
+        return found
+
+    def put_many(self, matches: Dict[str, IngredientMatch]) -> None:
+        if not matches:
+            return
+        self._memory.update(matches.items())
+        if self._db is None:
+            return
+        rows = [
+            (self.kb_version, name, m.ingredient_id, m.score, m.stage, int(m.exact))
+            for name, m in matches.items()
+        ]
+        try:
+            with self._db_lock:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO resolutions"
+                    " (kb_version, name, ingredient_id, score, stage, exact)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+                self._db.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"Resolution cache write failed: {e}")
+
+    def stats(self) -> Dict[str, object]:
+        return {**self._memory.stats(), "persistent": self._db is not None}
+
+
+__all__ = ["ResolutionCache"]
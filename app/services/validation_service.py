@@ -1,7 +1,17 @@
-import json
-import math
+import heapq
+import logging
+import os
+import threading
+import time
 from collections import defaultdict
 from pathlib import Path
+from typing import Dict, List, NamedTuple
+
+import numpy as np
+
+from app.services.cooccurrence import METADATA_FILE, CooccurrenceMatrix
+
+logger = logging.getLogger("ai_service.validation_service")
 
 class ValidationService:
     _instance = None
@@ -16,22 +26,95 @@ class ValidationService:
         if self._initialized:
             return
         
-        path = Path("app/data/cooccurrence")
-        self.matrix = defaultdict(lambda: defaultdict(int))
-        self.frequency = defaultdict(int)
-        self.total = 0
+        self._path = Path("app/data/cooccurrence")
+        # (ma trận, tần suất) được thay cả cụm bằng một phép gán khi có phiên bản mới
+        self._state = (CooccurrenceMatrix.empty(), defaultdict(int))
+        self._stamp = self._metadata_stamp()
         
         try:
-            with open(path / "matrix.json", 'r') as f:
-                self.matrix = defaultdict(lambda: defaultdict(int), json.load(f))
-            with open(path / "frequency.json", 'r') as f:
-                self.frequency = defaultdict(int, json.load(f))
-            with open(path / "metadata.json", 'r') as f:
-                self.total = json.load(f)['total_dishes']
+            # Định dạng nhị phân (build_cooccurrence) hoặc matrix.json/frequency.json cũ
+            self._state = self._load_state()
         except:
             pass
+
+        # Kiểm tra phiên bản mới (update_cooccurrence) tối đa mỗi reload_interval giây; 0 = tắt
+        self.reload_interval = float(os.getenv("COOCCURRENCE_RELOAD_INTERVAL", "30"))
+        self._last_check = time.monotonic()
+        self._reload_lock = threading.Lock()
+        self._reloading = False
+
+        # Chế độ gợi ý mặc định: "pmi" | "embedding"
+        self.suggestion_mode = os.getenv("SUGGESTION_MODE", "pmi").lower()
+
+        # Cache mảng ứng viên cho ing_map (thường luôn là OntologyService.ingredients)
+        self._candidate_cache = None
         
         self._initialized = True
+
+    @property
+    def cooccurrence(self) -> CooccurrenceMatrix:
+        return self._state[0]
+
+    @property
+    def frequency(self):
+        return self._state[1]
+
+    @property
+    def total(self) -> int:
+        return self._state[0].total
+
+    def _load_state(self):
+        # PMI dựng ngay khi nạp (thread nền khi reload), không để request đầu tiên trả
+        cooccurrence = CooccurrenceMatrix.load(self._path).materialize()
+        return cooccurrence, defaultdict(int, cooccurrence.frequency_dict())
+
+    def _metadata_stamp(self):
+        # metadata.json được os.replace ở mỗi phiên bản -> inode/mtime đổi
+        try:
+            st = os.stat(self._path / METADATA_FILE)
+        except OSError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def _current_state(self):
+        """Trạng thái hiện tại; nếu đến hạn thì kiểm tra phiên bản mới và nạp ở nền (không chặn request)."""
+        if self.reload_interval > 0:
+            now = time.monotonic()
+            if now - self._last_check >= self.reload_interval:
+                self._last_check = now
+                self.reload(block=False)
+        return self._state
+
+    def reload(self, block: bool = True) -> bool:
+        """
+        Nạp lại ma trận nếu metadata.json đã đổi. block=False: nạp trong thread nền,
+        request vẫn dùng bản cũ cho đến khi bản mới dựng xong rồi được thay một lần.
+        Trả về True nếu đã bắt đầu (hoặc hoàn tất) một lần nạp.
+        """
+        stamp = self._metadata_stamp()
+        if stamp is None or stamp == self._stamp:
+            return False
+        with self._reload_lock:
+            if self._reloading:
+                return False
+            self._reloading = True
+        if block:
+            self._reload(stamp)
+        else:
+            threading.Thread(target=self._reload, args=(stamp,), name="cooccurrence-reload", daemon=True).start()
+        return True
+
+    def _reload(self, stamp) -> None:
+        try:
+            state = self._load_state()
+            self._state = state
+            self._stamp = stamp
+            logger.info(f"Co-occurrence matrix reloaded ({len(state[0])} ingredients, {state[0].total} dishes)")
+        except Exception as e:
+            # Giữ bản cũ; lần kiểm tra sau thử lại
+            logger.warning(f"Co-occurrence reload failed, keeping current version: {e}")
+        finally:
+            self._reloading = False
     
     def check_missing(self, required: list, user: list = None) -> dict:
         required_ids = {ing['id']: ing for ing in required}
@@ -57,30 +140,60 @@ class ValidationService:
         }
     
     def _suggest(self, ing_ids: list) -> list:
-        if not self.total:
+        cooc, _ = self._current_state()
+        if not cooc.total:
             return []
         
-        candidates = defaultdict(float)
-        for ing_id in ing_ids:
-            for co_id, count in self.matrix[ing_id].items():
-                if co_id not in ing_ids and count >= 3:
-                    candidates[co_id] += self._pmi(ing_id, co_id)
-        
-        top = sorted(candidates.items(), key=lambda x: x[1], reverse=True)[:3]
-        return [{'id': i, 'score': round(s, 2)} for i, s in top]
+        # Ứng viên: mọi cặp count >= 3 trong dòng count đầy đủ của seed (danh sách láng
+        # giềng top-K bị cặp hiếm chiếm chỗ nên không dùng được), điểm = tổng PMI với mọi seed
+        cols = cooc.cooccurring(ing_ids, min_count=3)
+        seed_cols = cooc.lookup(ing_ids)
+        cols = cols[~np.isin(cols, seed_cols)]
+        if not len(cols):
+            return []
+        scores = cooc.pmi_sum(ing_ids, min_count=3)[cols]
+        top = np.argsort(-scores, kind='stable')[:3]
+        return [{'id': cooc.ids[cols[i]], 'score': round(float(scores[i]), 2)} for i in top]
     
     def _pmi(self, id1: str, id2: str) -> float:
-        if id1 not in self.frequency or id2 not in self.frequency:
-            return 0.0
-        
-        co = self.matrix[id1].get(id2, 0)
-        p_xy = co / self.total if self.total else 0
-        p_x = self.frequency[id1] / self.total
-        p_y = self.frequency[id2] / self.total
-        
-        if p_xy > 0 and p_x > 0 and p_y > 0:
-            return math.log(p_xy / (p_x * p_y))
-        return 0.0
+        return self.cooccurrence.pmi_pair(id1, id2)
+
+    def _candidate_arrays(self, ing_map, cooc, frequency) -> "_Candidates":
+        """Ứng viên cho ing_map, cache theo object (và phiên bản ma trận)."""
+        source = ing_map if ing_map else frequency
+        cached = self._candidate_cache
+        if cached is not None and cached[0] is source and cached[1] == len(source) and cached[2] is cooc:
+            return cached[3]
+
+        candidate_ids = list(source.keys())
+        category_codes = {}
+        codes = np.fromiter(
+            (
+                category_codes.setdefault(ing_map.get(cid, {}).get('category'), len(category_codes))
+                for cid in candidate_ids
+            ),
+            dtype=np.int64,
+            count=len(candidate_ids),
+        )
+        # id số trong ma trận -> vị trí ứng viên (-1: không phải ứng viên); ô cuối cho id ngoài ma trận
+        matrix_to_pos = np.full(len(cooc) + 1, -1, dtype=np.int64)
+        matrix_ids = cooc.lookup(candidate_ids)
+        in_matrix = matrix_ids < len(cooc)
+        matrix_to_pos[matrix_ids[in_matrix]] = np.flatnonzero(in_matrix)
+        category_positions = {
+            code: np.flatnonzero(codes == code).tolist() for code in category_codes.values()
+        }
+        candidates = _Candidates(
+            ids=candidate_ids,
+            positions={cid: i for i, cid in enumerate(candidate_ids)},
+            matrix_ids=matrix_ids,
+            matrix_to_pos=matrix_to_pos,
+            cat_codes=codes,
+            category_codes=category_codes,
+            category_positions=category_positions,
+        )
+        self._candidate_cache = (source, len(source), cooc, candidates)
+        return candidates
     
     def suggest_ingredients(
         self,
@@ -89,32 +202,108 @@ class ValidationService:
         ban_ids=None,
         top_k=5,
         ingredients=None,
+        mode=None,
     ):
+        """
+        Gợi ý top_k nguyên liệu cho giỏ seed_ids.
+
+        mode="pmi" (mặc định, SUGGESTION_MODE): 0.7 * PMI trung bình + 0.3 * prior
+        category trên các nguyên liệu đồng xuất hiện với seed, bù bằng ứng viên không
+        đồng xuất hiện (chỉ có prior).
+        mode="embedding": độ tương đồng giữa vector trung bình của giỏ và mọi nguyên
+        liệu (embeddings PPMI/SVD); category và ban_ids là mask. Rơi về "pmi" khi
+        ma trận không có embeddings hoặc không seed nào có vector.
+        """
         allowed_categories = set(allowed_categories or [])
         ban_ids = set(ban_ids or [])
         ing_map = ingredients or {}
 
+        cooc, frequency = self._current_state()
+
         # Ứng viên: ưu tiên từ ing_map; nếu trống, fallback sang tần suất (PMI)
-        candidate_ids = list(ing_map.keys()) if ing_map else list(self.frequency.keys())
+        candidates = self._candidate_arrays(ing_map, cooc, frequency)
+        seeds = list(seed_ids)
+        if not seeds or not candidates.ids or top_k <= 0:
+            return []
+
+        allowed_codes = None
+        if allowed_categories:
+            allowed_codes = [
+                code for cat, code in candidates.category_codes.items() if cat in allowed_categories
+            ]
+
+        positions = candidates.positions
+        excluded = {positions[cid] for cid in ban_ids.union(seeds) if cid in positions}
+
+        if (mode or self.suggestion_mode) == 'embedding':
+            similarity = cooc.centroid_scores(seeds)
+            if similarity is not None:
+                return self._rank_by_embedding(candidates, similarity, allowed_codes, excluded, top_k)
+
+        # 1) Ứng viên đồng xuất hiện với ít nhất một seed: điểm PMI đầy đủ. Dùng toàn bộ
+        # dòng count của seed chứ không chỉ láng giềng top-K, để cặp ngoài top-K (kể cả
+        # PMI âm) vẫn nhận đúng điểm thay vì rơi xuống phần bù 0.3
+        cols = cooc.cooccurring(seeds)
+        pos = candidates.matrix_to_pos[cols]
+        valid = pos >= 0
+        cols, pos = cols[valid], pos[valid]
+        pmi_avg = cooc.pmi_sum(seeds)[cols] / len(seeds)
+        if allowed_codes is None:
+            prior = np.ones(len(pos), dtype=np.float64)
+        else:
+            prior = np.isin(candidates.cat_codes[pos], allowed_codes).astype(np.float64)
+        scores = 0.7 * pmi_avg + 0.3 * prior
+
+        ranked = [
+            (score, p)
+            for score, p in zip(scores.tolist(), pos.tolist())
+            if score > 0 and p not in excluded
+        ]
+
+        # 2) Bù bằng ứng viên không đồng xuất hiện với seed nào (count = 0 -> chỉ có
+        # prior category), theo thứ tự ứng viên
+        prior_score = 0.7 * 0.0 + 0.3 * 1.0
+        excluded.update(pos.tolist())
+        if allowed_codes is None:
+            stream = range(len(candidates.ids))
+        else:
+            stream = heapq.merge(*(candidates.category_positions[code] for code in allowed_codes))
+        filled = 0
+        for p in stream:
+            if filled >= top_k:
+                break
+            if p not in excluded:
+                ranked.append((prior_score, p))
+                filled += 1
 
-        candidates = {}
-        for cid in candidate_ids:
-            if cid in ban_ids or cid in seed_ids:
-                continue
+        # Điểm giảm dần, hoà điểm giữ thứ tự ứng viên (như sorted(reverse=True) ổn định)
+        ranked.sort(key=lambda item: (-item[0], item[1]))
+        return [{'id': candidates.ids[p], 'score': round(score, 2)} for score, p in ranked[:top_k]]
 
-            cat = ing_map.get(cid, {}).get('category')
-            cat_ok = (not allowed_categories) or (cat in allowed_categories)
+    @staticmethod
+    def _rank_by_embedding(candidates, similarity, allowed_codes, excluded, top_k):
+        scores = similarity[candidates.matrix_ids]
+        mask = scores > 0
+        if allowed_codes is not None:
+            mask &= np.isin(candidates.cat_codes, allowed_codes)
+        if excluded:
+            mask[list(excluded)] = False
 
-            pmi_vals = [self._pmi(cid, sid) for sid in seed_ids if cid != sid]
-            if not pmi_vals:
-                continue
-            pmi_avg = sum(pmi_vals) / len(pmi_vals)
+        hits = np.flatnonzero(mask)
+        if len(hits) > top_k:
+            hits = hits[np.argpartition(-scores[hits], top_k - 1)[:top_k]]
+        # Điểm giảm dần, hoà điểm theo thứ tự ứng viên
+        hits = hits[np.lexsort((hits, -scores[hits]))]
+        return [{'id': candidates.ids[i], 'score': round(float(scores[i]), 2)} for i in hits]
 
-            prior = 1.0 if cat_ok else 0.0
-            score = 0.7 * pmi_avg + 0.3 * prior
 
-            if score > 0:
-                candidates[cid] = score
+class _Candidates(NamedTuple):
+    """Mảng ứng viên gợi ý dựng sẵn cho một ing_map."""
 
-        top = sorted(candidates.items(), key=lambda x: x[1], reverse=True)[:top_k]
-        return [{'id': i, 'score': round(s, 2)} for i, s in top]
\ No newline at end of file
+    ids: List[str]
+    positions: Dict[str, int]
+    matrix_ids: np.ndarray          # vị trí -> id số trong ma trận (len(ma trận) nếu không có)
+    matrix_to_pos: np.ndarray       # id số trong ma trận -> vị trí (-1 nếu không phải ứng viên)
+    cat_codes: np.ndarray           # vị trí -> mã category
+    category_codes: Dict[object, int]
+    category_positions: Dict[int, List[int]]
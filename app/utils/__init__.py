@@ -1,5 +1,16 @@
 # utils/__init__.py
-from .text_match import strip_accents, norm_text, tokenize, token_set_score, fuzzy_score, unique
+from .text_match import (
+    strip_accents,
+    norm_text,
+    tokenize,
+    token_set_score,
+    fuzzy_score,
+    PreparedText,
+    prepare_text,
+    FuzzyScorer,
+    unique,
+)
+from .ngram_index import char_ngrams, NgramIndex
 from .string_utils import norm_text as norm_text_simple, similarity_ratio
 from .number_utils import parse_number, parse_quantity
 from .json_utils import (
@@ -16,7 +27,13 @@ __all__ = [
     "tokenize",
     "token_set_score",
     "fuzzy_score",
+    "PreparedText",
+    "prepare_text",
+    "FuzzyScorer",
     "unique",
+    # ngram_index exports
+    "char_ngrams",
+    "NgramIndex",
     # string_utils exports
     "similarity_ratio",
     # number_utils exports
@@ -0,0 +1,89 @@
+# utils/aho_corasick.py
+from __future__ import annotations
+
+from collections import deque
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+__all__ = [
+    "AhoCorasick",
+    "is_word_char",
+]
+
+
+def is_word_char(ch: str) -> bool:
+    """Giống \\w của re với chuỗi Unicode: chữ/số (isalnum) hoặc '_'."""
+    return ch.isalnum() or ch == "_"
+
+
+class AhoCorasick:
+    """
+    Automaton Aho-Corasick: tìm mọi lần xuất hiện (kể cả chồng lấn) của nhiều
+    pattern trong một lượt duyệt văn bản, O(len(text) + số kết quả).
+
+    Pattern được so khớp nguyên văn (phân biệt hoa thường); caller tự chuẩn hoá
+    pattern và văn bản theo cùng một cách. Pattern trùng nhau vẫn giữ chỉ số riêng.
+    """
+
+    def __init__(self, patterns: Iterable[str]) -> None:
+        self.patterns: List[str] = list(patterns)
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[Tuple[int, ...]] = [()]
+
+        for idx, pattern in enumerate(self.patterns):
+            if not pattern:
+                continue
+            node = 0
+            for ch in pattern:
+                nxt = self._goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[node][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(())
+                node = nxt
+            self._out[node] += (idx,)
+
+        # BFS dựng fail link; output của node gộp luôn output theo chuỗi fail
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self._goto[node].items():
+                queue.append(nxt)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0)
+                self._out[nxt] += self._out[self._fail[nxt]]
+
+    def __len__(self) -> int:
+        return len(self.patterns)
+
+    def iter_matches(self, text: str) -> Iterator[Tuple[int, int, int]]:
+        """(start, end, chỉ số pattern) của mọi lần xuất hiện, theo thứ tự vị trí kết thúc."""
+        goto, fail, out, patterns = self._goto, self._fail, self._out, self.patterns
+        node = 0
+        for pos, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]:
+                end = pos + 1
+                for idx in out[node]:
+                    yield end - len(patterns[idx]), end, idx
+
+    def iter_word_matches(self, text: str) -> Iterator[Tuple[int, int, int]]:
+        """
+        Như iter_matches nhưng chỉ giữ lần xuất hiện có ranh giới từ ở hai đầu,
+        đúng ngữ nghĩa r"\\b" + pattern + r"\\b" của re (ký tự ngoài chuỗi coi như không phải \\w).
+        """
+        last = len(text)
+        for start, end, idx in self.iter_matches(text):
+            before = start > 0 and is_word_char(text[start - 1])
+            if before == is_word_char(text[start]):
+                continue
+            after = end < last and is_word_char(text[end])
+            if after == is_word_char(text[end - 1]):
+                continue
+            yield start, end, idx
@@ -0,0 +1,113 @@
+"""
+Cache utilities shared by services.
+"""
+import os
+import time
+import weakref
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Dict, Hashable, Iterable, Optional
+
+__all__ = [
+    "LRUCache",
+    "TTLCache",
+]
+
+_MISSING = object()
+
+# Mọi cache đang sống; lock của chúng được tạo lại trong process con sau fork
+_LIVE_CACHES: "weakref.WeakSet[LRUCache]" = weakref.WeakSet()
+
+
+def _reset_locks_after_fork() -> None:
+    # Thread khác của process cha có thể đang giữ lock đúng lúc fork -> con bị kẹt mãi
+    for cache in list(_LIVE_CACHES):
+        cache._lock = Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_locks_after_fork)
+
+
+class LRUCache:
+    """LRU cache có giới hạn kích thước, an toàn khi dùng từ nhiều thread."""
+
+    def __init__(self, max_size: int = 1024) -> None:
+        self.max_size = max(0, int(max_size))
+        self._data: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        _LIVE_CACHES.add(self)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+    def get(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        with self._lock:
+            value = self._data.get(key, _MISSING)
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        if not self.max_size:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def update(self, items: Iterable) -> None:
+        for key, value in items:
+            self.put(key, value)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class TTLCache(LRUCache):
+    """LRUCache có thời hạn: entry quá `ttl` giây coi như không có (ttl <= 0: không hết hạn)."""
+
+    def __init__(self, max_size: int = 1024, ttl: float = 3600.0) -> None:
+        super().__init__(max_size)
+        self.ttl = float(ttl)
+
+    def __contains__(self, key: Hashable) -> bool:
+        entry = self._data.get(key)
+        return entry is not None and not self._expired(entry[0])
+
+    def get(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and self._expired(entry[0]):
+                del self._data[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        super().put(key, (time.monotonic(), value))
+
+    def _expired(self, stored_at: float) -> bool:
+        return self.ttl > 0 and time.monotonic() - stored_at > self.ttl
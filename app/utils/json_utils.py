@@ -3,13 +3,14 @@ JSON utility functions for parsing and extracting data from various sources.
 """
 import json
 import boto3
-from typing import Dict, Any, Optional
+from typing import Callable, Dict, Any, Optional
 
 __all__ = [
     "read_json_from_s3_uri",
     "parse_json_content",
     "extract_textual_content",
     "extract_prompt_from_body",
+    "map_prompt_in_body",
 ]
 
 # Initialize S3 client
@@ -112,3 +113,34 @@ def extract_prompt_from_body(body: str) -> str:
                     prompt_parts.append(content)
     
     return '\n'.join(prompt_parts)
+
+
+def map_prompt_in_body(body: str, transform: Callable[[str], str]) -> str:
+    """
+    Áp transform lên đúng các đoạn text mà extract_prompt_from_body đọc ('prompt',
+    text trong 'messages'), trả về body JSON mới; body không phải JSON giữ nguyên.
+    """
+    try:
+        payload = json.loads(body)
+    except (json.JSONDecodeError, TypeError):
+        return body
+    if not isinstance(payload, dict):
+        return body
+
+    if isinstance(payload.get('prompt'), str):
+        payload['prompt'] = transform(payload['prompt'])
+
+    messages = payload.get('messages')
+    if isinstance(messages, list):
+        for message in messages:
+            if not isinstance(message, dict):
+                continue
+            content = message.get('content')
+            if isinstance(content, list):
+                for part in content:
+                    if isinstance(part, dict) and part.get('type') == 'text' and part.get('text'):
+                        part['text'] = transform(str(part['text']))
+            elif isinstance(content, str):
+                message['content'] = transform(content)
+
+    return json.dumps(payload, ensure_ascii=False)
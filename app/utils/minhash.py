@@ -0,0 +1,91 @@
+# utils/minhash.py
+from __future__ import annotations
+
+import zlib
+from typing import Dict, Iterable, List, Sequence, Set
+
+import numpy as np
+
+__all__ = [
+    "MinHashLSH",
+]
+
+# Số nguyên tố > 2^32 - hệ số a < 2^31 và x < 2^32 nên a*x + b không tràn uint64
+_PRIME = np.uint64(4294967311)
+
+
+def _hash_tokens(tokens: Iterable[str]) -> np.ndarray:
+    # crc32 ổn định giữa các process (khác với hash() của Python)
+    return np.fromiter(
+        {zlib.crc32(t.encode("utf-8")) for t in tokens if t}, dtype=np.uint64
+    )
+
+
+class MinHashLSH:
+    """
+    MinHash + LSH banding cho tập token (vd. tập ingredient_id của món).
+
+    Mỗi tập được tóm tắt bằng bands * rows giá trị min-hash; hai tập có độ tương
+    đồng Jaccard s rơi chung ít nhất một bucket với xác suất 1 - (1 - s^rows)^bands.
+    Tăng bands / giảm rows -> recall cao hơn nhưng nhiều ứng viên hơn.
+    Dùng làm bộ sinh ứng viên: kết quả vẫn phải được chấm lại chính xác.
+    """
+
+    def __init__(
+        self,
+        token_sets: Sequence[Iterable[str]],
+        bands: int = 32,
+        rows: int = 2,
+        seed: int = 1,
+    ) -> None:
+        if bands <= 0 or rows <= 0:
+            raise ValueError("bands and rows must be positive")
+        self.bands = bands
+        self.rows = rows
+        rng = np.random.default_rng(seed)
+        num_perm = bands * rows
+        self._a = rng.integers(1, 1 << 31, size=num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, 1 << 32, size=num_perm, dtype=np.uint64)
+
+        self._buckets: List[Dict[bytes, List[int]]] = [{} for _ in range(bands)]
+        self._size = len(token_sets)
+
+        # Ghép mọi tập thành một mảng rồi lấy min theo từng đoạn (reduceat)
+        hashed = [_hash_tokens(tokens) for tokens in token_sets]
+        positions = [pos for pos, h in enumerate(hashed) if len(h)]
+        if not positions:
+            return
+        values = np.concatenate([hashed[pos] for pos in positions])
+        offsets = np.cumsum([0] + [len(hashed[pos]) for pos in positions[:-1]])
+        permuted = (self._a[:, None] * values[None, :] + self._b[:, None]) % _PRIME
+        signatures = np.minimum.reduceat(permuted, offsets, axis=1).T
+
+        for pos, signature in zip(positions, signatures):
+            for band, key in enumerate(self._band_keys(signature)):
+                self._buckets[band].setdefault(key, []).append(pos)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+        raw = signature.tobytes()
+        width = self.rows * signature.itemsize
+        return [raw[i * width:(i + 1) * width] for i in range(self.bands)]
+
+    def signature(self, tokens: Iterable[str]) -> np.ndarray:
+        """Chữ ký MinHash (bands * rows giá trị) của một tập token."""
+        values = _hash_tokens(tokens)
+        if not len(values):
+            return np.empty(0, dtype=np.uint64)
+        permuted = (self._a[:, None] * values[None, :] + self._b[:, None]) % _PRIME
+        return permuted.min(axis=1)
+
+    def query(self, tokens: Iterable[str]) -> Set[int]:
+        """Vị trí các tập rơi chung ít nhất một bucket với tập truy vấn."""
+        signature = self.signature(tokens)
+        if not len(signature):
+            return set()
+        candidates: Set[int] = set()
+        for band, key in enumerate(self._band_keys(signature)):
+            candidates.update(self._buckets[band].get(key, ()))
+        return candidates
@@ -0,0 +1,133 @@
+# utils/ngram_index.py
+from __future__ import annotations
+
+from typing import Dict, List, Sequence, Set, Tuple
+
+import numpy as np
+from scipy import sparse
+
+__all__ = [
+    "char_ngrams",
+    "NgramIndex",
+]
+
+
+def char_ngrams(text: str, n: int = 3) -> Set[str]:
+    """Tập n-gram ký tự của chuỗi (đã chuẩn hoá), có đệm khoảng trắng hai đầu."""
+    if not text:
+        return set()
+    padded = f" {text} "
+    if len(padded) <= n:
+        return {padded}
+    return {padded[i:i + n] for i in range(len(padded) - n + 1)}
+
+
+class NgramIndex:
+    """
+    Index n-gram ký tự cho một danh sách chuỗi đã chuẩn hoá.
+
+    Lưu ma trận thưa (n-gram x dòng) nhị phân; điểm của truy vấn với mọi dòng
+    là hệ số Dice 2*|Q∩C| / (|Q| + |C|) tính bằng một phép nhân vector-ma trận
+    chỉ chạm vào posting list của các n-gram có trong truy vấn.
+    """
+
+    def __init__(self, texts: Sequence[str], n: int = 3) -> None:
+        self.n = n
+        self._vocab: Dict[str, int] = {}
+
+        rows: List[int] = []
+        cols: List[int] = []
+        sizes = np.zeros(len(texts), dtype=np.int32)
+        for row, text in enumerate(texts):
+            grams = char_ngrams(text, n)
+            sizes[row] = len(grams)
+            for gram in grams:
+                gid = self._vocab.setdefault(gram, len(self._vocab))
+                rows.append(gid)
+                cols.append(row)
+
+        data = np.ones(len(rows), dtype=np.int32)
+        self._matrix = sparse.csr_matrix(
+            (data, (np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64))),
+            shape=(len(self._vocab), len(texts)),
+        )
+        self._sizes = sizes
+
+    def __len__(self) -> int:
+        return self._matrix.shape[1]
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        """Trạng thái index dưới dạng mảng numpy (để ghi snapshot .npy)."""
+        return {
+            "n": np.array([self.n], dtype=np.int32),
+            "vocab": np.array(list(self._vocab), dtype=str),
+            "indptr": self._matrix.indptr,
+            "indices": self._matrix.indices,
+            "sizes": self._sizes,
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> "NgramIndex":
+        """Dựng lại index từ to_arrays() (mảng có thể là memmap chỉ đọc)."""
+        index = cls.__new__(cls)
+        index.n = int(arrays["n"][0])
+        index._vocab = {gram: gid for gid, gram in enumerate(arrays["vocab"].tolist())}
+        indices = arrays["indices"]
+        index._matrix = sparse.csr_matrix(
+            (np.ones(len(indices), dtype=np.int32), indices, arrays["indptr"]),
+            shape=(len(index._vocab), len(arrays["sizes"])),
+        )
+        index._sizes = arrays["sizes"]
+        return index
+
+    def _query_matrix(self, queries: Sequence[str]) -> Tuple[sparse.csr_matrix, np.ndarray]:
+        rows: List[int] = []
+        cols: List[int] = []
+        sizes = np.zeros(len(queries), dtype=np.int32)
+        for row, query in enumerate(queries):
+            grams = char_ngrams(query, self.n)
+            sizes[row] = len(grams)
+            for gram in grams:
+                gid = self._vocab.get(gram)
+                if gid is not None:
+                    rows.append(row)
+                    cols.append(gid)
+        data = np.ones(len(rows), dtype=np.int32)
+        matrix = sparse.csr_matrix(
+            (data, (np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64))),
+            shape=(len(queries), len(self._vocab)),
+        )
+        return matrix, sizes
+
+    def scores_many(self, queries: Sequence[str]) -> sparse.csr_matrix:
+        """
+        Điểm Dice của cả lô truy vấn với mọi dòng trong một phép nhân ma trận thưa
+        (truy vấn x n-gram) @ (n-gram x dòng). Chỉ lưu các cặp có điểm > 0.
+        """
+        query_matrix, query_sizes = self._query_matrix(queries)
+        shared = (query_matrix @ self._matrix).tocsr()
+        shared.sort_indices()
+        counts = np.diff(shared.indptr)
+        denom = np.repeat(query_sizes, counts) + self._sizes[shared.indices]
+        dice = 2.0 * shared.data / denom
+        return sparse.csr_matrix((dice, shared.indices, shared.indptr), shape=shared.shape)
+
+    def scores(self, query: str) -> np.ndarray:
+        """Điểm Dice giữa truy vấn (đã chuẩn hoá) và mọi dòng."""
+        return self.scores_many([query]).toarray().ravel()
+
+    def top_k_many(self, queries: Sequence[str], k: int) -> List[List[int]]:
+        """Với mỗi truy vấn: vị trí k dòng có điểm cao nhất (bỏ qua điểm 0), không sắp xếp."""
+        scores = self.scores_many(queries)
+        result: List[List[int]] = []
+        for i in range(len(queries)):
+            start, end = scores.indptr[i], scores.indptr[i + 1]
+            hit = scores.indices[start:end]
+            if len(hit) > k:
+                hit = hit[np.argpartition(scores.data[start:end], -k)[-k:]]
+            result.append(hit.tolist())
+        return result
+
+    def top_k(self, query: str, k: int) -> List[int]:
+        """Vị trí k dòng có điểm cao nhất (bỏ qua dòng điểm 0), không sắp xếp."""
+        return self.top_k_many([query], k)[0]
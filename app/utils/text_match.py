@@ -3,8 +3,10 @@ from __future__ import annotations
 
 import re
 import unicodedata
+from collections import Counter
 from difflib import SequenceMatcher
-from typing import Iterable, List, Set, Optional
+from functools import lru_cache
+from typing import FrozenSet, Iterable, List, NamedTuple, Set, Optional
 
 __all__ = [
     "strip_accents",
@@ -12,23 +14,79 @@ __all__ = [
     "tokenize",
     "token_set_score",
     "fuzzy_score",
+    "PreparedText",
+    "prepare_text",
+    "FuzzyScorer",
     "unique",
 ]
 
 _WORD_SPLIT_RE = re.compile(r"\W+")
 
+# Bảng dịch dựng sẵn: chữ tiếng Việt dựng sẵn (NFC) -> chữ không dấu, và xoá mọi
+# dấu kết hợp (combining) nên chuỗi dạng NFD cũng chỉ cần một lượt translate.
+# "đ"/"Đ" không tách được bằng NFKD nên được map tay sang "d"/"D". Ký tự còn lại
+# ngoài ASCII (ký tự tương thích, chữ Latin khác...) vẫn đi qua NFKD như trước.
+_VIETNAMESE_LETTERS = (
+    "àáảãạăằắẳẵặâầấẩẫậèéẻẽẹêềếểễệìíỉĩịòóỏõọôồốổỗộơờớởỡợùúủũụưừứửữựỳýỷỹỵ"
+)
+
+
+def _nfkd_strip(s: str) -> str:
+    nfkd = unicodedata.normalize("NFKD", s)
+    return "".join(ch for ch in nfkd if not unicodedata.combining(ch))
+
+
+# Mọi ký tự combining của unicodedata đều nằm dưới U+20000
+_ACCENT_TABLE = {
+    cp: None for cp in range(0x20000) if unicodedata.combining(chr(cp))
+}
+_ACCENT_TABLE.update({
+    ord(ch): _nfkd_strip(ch)
+    for ch in _VIETNAMESE_LETTERS + _VIETNAMESE_LETTERS.upper()
+})
+_ACCENT_TABLE.update({ord("đ"): "d", ord("Đ"): "D"})
+
+_MEMO_MAX_LEN = 64  # chỉ memo chuỗi ngắn (tên nguyên liệu, từ khoá...)
+
+
+def _strip_accents(s: str) -> str:
+    if s.isascii():
+        return s
+    out = s.translate(_ACCENT_TABLE)
+    if out.isascii():
+        return out
+    # Còn ký tự ngoài bảng (ký tự tương thích, chữ Latin khác...) -> NFKD fallback
+    return unicodedata.normalize("NFKD", out).translate(_ACCENT_TABLE)
+
+
+@lru_cache(maxsize=8192)
+def _strip_accents_memo(s: str) -> str:
+    return _strip_accents(s)
+
+
+@lru_cache(maxsize=8192)
+def _norm_text_memo(s: str) -> str:
+    return _strip_accents(s).lower().strip()
+
 
 def strip_accents(s: Optional[str]) -> str:
-    """Loại bỏ dấu/diacritics khỏi chuỗi. Trả về '' nếu đầu vào là None."""
+    """Loại bỏ dấu/diacritics khỏi chuỗi (kể cả đ -> d). Trả về '' nếu đầu vào là None."""
     if s is None:
         return ""
-    nfkd = unicodedata.normalize("NFKD", str(s))
-    return "".join(ch for ch in nfkd if not unicodedata.combining(ch))
+    s = str(s)
+    if len(s) <= _MEMO_MAX_LEN:
+        return _strip_accents_memo(s)
+    return _strip_accents(s)
 
 
 def norm_text(s: Optional[str]) -> str:
     """Chuẩn hoá: bỏ dấu, lower-case, trim."""
-    return strip_accents(s).lower().strip()
+    if s is None:
+        return ""
+    s = str(s)
+    if len(s) <= _MEMO_MAX_LEN:
+        return _norm_text_memo(s)
+    return _strip_accents(s).lower().strip()
 
 
 def tokenize(s: Optional[str]) -> List[str]:
@@ -65,6 +123,86 @@ def fuzzy_score(a: Optional[str], b: Optional[str]) -> float:
     return 0.5 * s1 + 0.5 * s2
 
 
+class PreparedText(NamedTuple):
+    """Chuỗi đã chuẩn hoá + tokenize sẵn, dùng lại được cho nhiều lần chấm điểm."""
+
+    text: str
+    normalized: str
+    tokens: FrozenSet[str]
+
+
+def prepare_text(s: Optional[str]) -> PreparedText:
+    text = "" if s is None else str(s)
+    return PreparedText(text, norm_text(text), frozenset(tokenize(text)))
+
+
+def _ratio(matches: int, length: int) -> float:
+    # Giống difflib._calculate_ratio để cận trên khớp tuyệt đối với SequenceMatcher
+    return 2.0 * matches / length if length else 1.0
+
+
+class FuzzyScorer:
+    """
+    Chấm fuzzy_score / token_set_score của một truy vấn cố định với nhiều ứng viên.
+
+    Truy vấn chỉ được chuẩn hoá + tokenize một lần; ứng viên là PreparedText lấy
+    từ index. Kết quả bằng đúng fuzzy_score(query, cand.text) và
+    token_set_score(query, cand.text).
+
+    score_if_better() dùng cận trên real_quick_ratio/quick_ratio của
+    SequenceMatcher để bỏ qua ứng viên chắc chắn không đạt tới điểm tốt nhất hiện tại.
+    """
+
+    def __init__(self, query: Optional[str]) -> None:
+        self.query = prepare_text(query)
+        self._chars = Counter(self.query.normalized)
+
+    def token_set_score(self, cand: PreparedText) -> float:
+        A = self.query.tokens
+        B = cand.tokens
+        if not A or not B:
+            return 0.0
+        return 2.0 * len(A & B) / (len(A) + len(B))
+
+    def score(self, cand: PreparedText) -> float:
+        na = self.query.normalized
+        nb = cand.normalized
+        if not na and not nb:
+            return 0.0
+        s1 = SequenceMatcher(None, na, nb).ratio()
+        s2 = self.token_set_score(cand)
+        return 0.5 * s1 + 0.5 * s2
+
+    def score_if_better(self, cand: PreparedText, best: float) -> Optional[float]:
+        """
+        Trả về điểm của ứng viên, hoặc None nếu chắc chắn điểm < best
+        (ứng viên bằng điểm best vẫn được chấm để giữ tie-break của caller).
+        """
+        na = self.query.normalized
+        nb = cand.normalized
+        if not na and not nb:
+            return 0.0 if 0.0 >= best else None
+        s2 = self.token_set_score(cand)
+        length = len(na) + len(nb)
+
+        # real_quick_ratio: chỉ dựa trên độ dài
+        if 0.5 * _ratio(min(len(na), len(nb)), length) + 0.5 * s2 < best:
+            return None
+
+        # quick_ratio: số ký tự chung (không quan tâm thứ tự)
+        avail = dict(self._chars)
+        matches = 0
+        for ch in nb:
+            n = avail.get(ch, 0)
+            if n > 0:
+                avail[ch] = n - 1
+                matches += 1
+        if 0.5 * _ratio(matches, length) + 0.5 * s2 < best:
+            return None
+
+        return 0.5 * SequenceMatcher(None, na, nb).ratio() + 0.5 * s2
+
+
 def unique(items: Iterable[str]) -> List[str]:
     """
     Giữ thứ tự xuất hiện, loại trùng (so sánh lower-case). Bỏ item rỗng/None.
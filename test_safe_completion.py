@@ -0,0 +1,72 @@
+import io
+import json
+import threading
+import time
+
+import pytest
+
+from app.services.bedrock_client import (
+    AWS_BLOCKED_EMPTY_FALLBACK,
+    AWS_BLOCKED_FALLBACK,
+    GuardrailedBedrockClient,
+)
+
+
+class _FakeRuntime:
+    """Bedrock runtime giả: trả text (hoặc content rỗng / lỗi) sau delay giây."""
+
+    def __init__(self, text='safe answer', delay=0.0, error=None):
+        self.text = text
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def invoke_model(self, modelId, body, **kwargs):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.delay)
+        if self.error:
+            raise self.error
+        content = [{'type': 'text', 'text': self.text}] if self.text else []
+        return {'body': io.BytesIO(json.dumps({'content': content}).encode('utf-8'))}
+
+
+@pytest.fixture
+def make_client(monkeypatch):
+    monkeypatch.setenv('ENABLE_LLM_SAFE_COMPLETION', 'true')
+    monkeypatch.delenv('SAFE_COMPLETION_PREWARM', raising=False)
+
+    def make(runtime, timeout_ms=500, max_pending=8):
+        monkeypatch.setenv('SAFE_COMPLETION_TIMEOUT_MS', str(timeout_ms))
+        monkeypatch.setenv('SAFE_COMPLETION_MAX_PENDING', str(max_pending))
+        return GuardrailedBedrockClient(runtime_client=runtime)
+
+    return make
+
+
+def test_aws_blocked_uses_llm_text(make_client):
+    client = make_client(_FakeRuntime('Giải thích an toàn'))
+    assert client._generate_aws_blocked_completion('câu hỏi') == 'Giải thích an toàn'
+
+
+def test_aws_blocked_timeout_falls_back(make_client):
+    runtime = _FakeRuntime(delay=0.5)
+    client = make_client(runtime, timeout_ms=50)
+    started = time.monotonic()
+    assert client._generate_aws_blocked_completion('câu hỏi') == AWS_BLOCKED_FALLBACK
+    assert time.monotonic() - started < 0.4
+
+
+def test_aws_blocked_queue_full_falls_back_without_calling_model(make_client):
+    runtime = _FakeRuntime()
+    client = make_client(runtime, max_pending=0)
+    assert client._generate_aws_blocked_completion('câu hỏi') == AWS_BLOCKED_FALLBACK
+    assert runtime.calls == 0
+
+
+def test_aws_blocked_per_cause_messages(make_client):
+    empty = make_client(_FakeRuntime(text=''))
+    assert empty._generate_aws_blocked_completion('câu hỏi') == AWS_BLOCKED_EMPTY_FALLBACK
+    failing = make_client(_FakeRuntime(error=RuntimeError('boom')))
+    assert failing._generate_aws_blocked_completion('câu hỏi') == AWS_BLOCKED_FALLBACK
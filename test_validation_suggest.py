@@ -0,0 +1,97 @@
+import math
+import random
+from collections import defaultdict
+from itertools import combinations
+
+import pytest
+
+from app.services.cooccurrence import NEIGHBOR_TOP_K, CooccurrenceMatrix
+from app.services.validation_service import ValidationService
+
+
+def _skewed_kb(seed: int = 0):
+    """
+    KB lệch: mỗi seed đi kèm rất nhiều nguyên liệu hiếm (xuất hiện 1 lần -> PMI rất cao,
+    chiếm hết top-K láng giềng) và vài nguyên liệu phổ biến đồng xuất hiện >= 3 lần.
+    """
+    rnd = random.Random(seed)
+    seeds = [f"S{i:02d}" for i in range(4)]
+    common = [f"C{i:02d}" for i in range(12)]
+    dishes = []
+    rare = 0
+    for s in seeds:
+        for _ in range(NEIGHBOR_TOP_K + 50):
+            dishes.append([s, f"R{rare:04d}"])
+            rare += 1
+        for c in rnd.sample(common, 6):
+            for _ in range(rnd.randint(3, 8)):
+                dishes.append([s, c] + rnd.sample(common, 2))
+    for _ in range(200):
+        dishes.append(rnd.sample(common, 3))
+
+    matrix = defaultdict(lambda: defaultdict(int))
+    frequency = defaultdict(int)
+    for dish in dishes:
+        dish = sorted(set(dish))
+        for ing in dish:
+            frequency[ing] += 1
+        for a, b in combinations(dish, 2):
+            matrix[a][b] += 1
+            matrix[b][a] += 1
+    return seeds, common, matrix, frequency, len(dishes)
+
+
+def _baseline_suggest(ing_ids, matrix, frequency, total):
+    """Bản quét dict gốc của ValidationService._suggest."""
+
+    def pmi(id1, id2):
+        if id1 not in frequency or id2 not in frequency:
+            return 0.0
+        co = matrix[id1].get(id2, 0)
+        p_xy = co / total if total else 0
+        p_x = frequency[id1] / total
+        p_y = frequency[id2] / total
+        if p_xy > 0 and p_x > 0 and p_y > 0:
+            return math.log(p_xy / (p_x * p_y))
+        return 0.0
+
+    candidates = defaultdict(float)
+    for ing_id in ing_ids:
+        for co_id, count in matrix[ing_id].items():
+            if co_id not in ing_ids and count >= 3:
+                candidates[co_id] += pmi(ing_id, co_id)
+    top = sorted(candidates.items(), key=lambda x: x[1], reverse=True)[:3]
+    return [{'id': i, 'score': round(s, 2)} for i, s in top]
+
+
+@pytest.fixture
+def service_with_kb():
+    seeds, common, matrix, frequency, total = _skewed_kb()
+    service = ValidationService()
+    saved = (service._state, service.reload_interval)
+    cooc = CooccurrenceMatrix.from_dicts(matrix, frequency, total).materialize()
+    service._state = (cooc, defaultdict(int, cooc.frequency_dict()))
+    service.reload_interval = 0
+    yield service, seeds, common, matrix, frequency, total
+    service._state, service.reload_interval = saved
+
+
+def test_neighbor_lists_are_filled_by_rare_pairs(service_with_kb):
+    service, seeds, common, *_ = service_with_kb
+    cooc = service.cooccurrence
+    common_cols = set(cooc.lookup(common).tolist())
+    for s in cooc.lookup(seeds):
+        listed = cooc.neighbor_indices[cooc.neighbor_indptr[s]:cooc.neighbor_indptr[s + 1]]
+        assert len(listed) == NEIGHBOR_TOP_K
+        assert not common_cols & set(listed.tolist())
+
+
+def test_suggest_matches_dict_scan(service_with_kb):
+    service, seeds, common, matrix, frequency, total = service_with_kb
+    rnd = random.Random(1)
+    pool = seeds + common
+    carts = [[s] for s in seeds] + [rnd.sample(pool, rnd.randint(1, 6)) for _ in range(200)]
+    for cart in carts:
+        expected = _baseline_suggest(cart, matrix, frequency, total)
+        assert service._suggest(cart) == expected
+    assert any(_baseline_suggest([s], matrix, frequency, total) for s in seeds)